@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+"""
+一括変換
+=========================================
+
+多数の文書を変換する。
+
+文書毎に markdown.Markdown と全ての拡張を作り直す代わりに、Converter は拡張を一
+度だけ構築した Markdown を使い回し、文書毎には md.reset() と文書の位置
+(base_path, full_path) の切り替えだけを行う。convert_all はこれをプロセスプール
+の各ワーカーで一つずつ持ち、結果を入力の順番通りに返す。
+
+    >>> jobs = [batch.Job('site/reference/vector.md', 'reference', 'reference/vector.md')]
+    >>> for result in batch.convert_all(jobs, options, processes=8):
+    ...     write(result.full_path, result.html)
+
+コマンドラインからは以下の様に使う。options は Converter のオプションを JSON で
+書いたファイルである。
+
+    $ python -m markdown_to_html.batch --config options.json --source-dir site --output out
+
+--manifest を指定すると、前回の変換から出力が変わらないページの変換を省略する
+(manifest を参照)。--source-dir で変換した場合は、存在しなくなったページの記録を
+削除する。jobs ファイルで一部のページだけを変換した場合は、--prune を指定しなけ
+れば他のページの記録を残す。
+
+    $ python -m markdown_to_html.batch --source-dir site --output out --link-index site --manifest out/.manifest.json
+
+--deferred-links を指定すると、変換中はリンク先を確認せず、全てのページを変換し
+た後に変換したページの集合に対してまとめて確認する。存在しないページへのリンクを
+含むページだけ、出力を links.patch_html で書き換える。結果は変換したページのディ
+レクトリを --link-index に指定した場合と同じである。
+
+    $ python -m markdown_to_html.batch --source-dir site --output out --deferred-links
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import markdown
+from markdown.extensions.codehilite import CodeHiliteExtension
+
+from . import commit
+from . import defined_words
+from . import html_attribute
+from . import links
+from . import manifest
+from . import mark
+from . import mathjax
+from . import meta
+from . import qualified_fenced_code
+from . import sponsor
+
+
+# Converter のオプションの既定値
+DEFAULT_OPTIONS = {
+    'base_url': 'https://cpprefjp.github.io',
+    'extension': '.html',
+    'use_relative_link': False,
+    'use_static_image': False,
+    'image_repo': 'cpprefjp/image',
+    # 定義語の辞書 (defined_words)
+    'defined_words': {},
+    # 全てのコードブロックに適用する修飾 (qualified_fenced_code)
+    'global_qualify_list': '',
+    # ハイライト結果のキャッシュのパス (空の場合は使わない)
+    'highlight_cache': '',
+    # 定義語の辞書のキャッシュを置くディレクトリ (空の場合は使わない)
+    'cache_dir': '',
+    # CodeHiliteExtension の設定 (None の場合はハイライトしない)
+    'codehilite': {},
+    # 追加する拡張
+    'extensions': ['markdown.extensions.tables'],
+    # リンク先の存在確認に使うパスの集合 (None の場合は確認しない)
+    'hrefs': None,
+    # 真の場合、リンク先を確認せずに ConversionResult.links に記録する。全ての変
+    # 換の後に validate_links で確認する (hrefs は使わない)
+    'deferred_links': False,
+}
+
+
+# 変換する文書
+Job = collections.namedtuple('Job', ['source_path', 'base_path', 'full_path'])
+
+
+# 文書の変換結果
+#
+# full_path       Job.full_path
+# html            変換結果 (error の場合は None)
+# meta            md._meta_result
+# example_codes   md._example_codes
+# mathjax         md._mathjax_enabled
+# diagnostics     この文書のリンクの診断情報 (links.LinkDiagnostic のリスト)
+# link_targets    この文書のサイト内リンクのリンク先 (links.LinkGraph.targets)
+# expires         スポンサーの掲載期限により変換結果が変わる時刻。なければ None
+#                 (md._sponsor_next_expiry)
+# error           変換に失敗した場合の例外の情報。成功した場合は None
+# links           deferred_links の場合、この文書のサイト内リンク (links.LinkRecord
+#                 のリスト)。それ以外は None
+ConversionResult = collections.namedtuple('ConversionResult', [
+    'full_path', 'html', 'meta', 'example_codes', 'mathjax', 'diagnostics',
+    'link_targets', 'expires', 'error', 'links'], defaults=(None,))
+
+
+class Converter(object):
+    """拡張を一度だけ構築した Markdown で文書を順に変換する"""
+
+    def __init__(self, options=None):
+        self.options = dict(DEFAULT_OPTIONS)
+        if options:
+            self.options.update(options)
+        options = self.options
+
+        self._attribute = html_attribute.AttributeExtension(
+            base_url=options['base_url'],
+            extension=options['extension'],
+            use_relative_link=options['use_relative_link'],
+            use_static_image=options['use_static_image'],
+            image_repo=options['image_repo'])
+        self._sponsor = sponsor.SponsorExtension()
+        self._defined_words = defined_words.DefinedWordExtension(
+            base_url=options['base_url'],
+            extension=options['extension'],
+            dict=options['defined_words'],
+            cache_dir=options['cache_dir'])
+
+        extensions = [
+            meta.MetaExtension(),
+            mathjax.MathJaxExtension(),
+            mark.MarkExtension(),
+            commit.CommitExtension(),
+            self._sponsor,
+            qualified_fenced_code.QualifiedFencedCodeExtension(
+                options['global_qualify_list'],
+                highlight_cache=options['highlight_cache'] or None),
+        ]
+        if options['codehilite'] is not None:
+            extensions.append(CodeHiliteExtension(**options['codehilite']))
+        extensions.extend(options['extensions'])
+        extensions.append(self._attribute)
+        extensions.append(self._defined_words)
+
+        self.md = markdown.Markdown(extensions=extensions)
+        self.md._html_attribute_hrefs = options['hrefs']
+
+    def convert(self, text, base_path, full_path, now=None):
+        """text を変換する
+
+        now (timezone 付きの datetime) を指定すると、スポンサーの掲載期限をその時
+        刻で判断する。
+        """
+        md = self.md
+        md.reset()
+        self._attribute.set_document(base_path, full_path)
+        self._defined_words.set_document(base_path, full_path)
+        self._sponsor.set_clock(None if now is None else lambda: now)
+
+        diagnostics = links.LinkDiagnostics()
+        graph = links.LinkGraph(self.options['extension'])
+        table = links.LinkTable() if self.options['deferred_links'] else None
+        md._html_attribute_diagnostics = diagnostics
+        md._html_attribute_link_graph = graph
+        md._html_attribute_link_table = table
+        try:
+            html = md.convert(text)
+        finally:
+            md._html_attribute_diagnostics = None
+            md._html_attribute_link_graph = None
+            md._html_attribute_link_table = None
+
+        return ConversionResult(
+            full_path, html,
+            getattr(md, '_meta_result', {}),
+            md._example_codes,
+            getattr(md, '_mathjax_enabled', False),
+            diagnostics.records(),
+            graph.targets(full_path),
+            getattr(md, '_sponsor_next_expiry', None),
+            None,
+            list(table.links(full_path)) if table is not None else None)
+
+    def convert_job(self, job):
+        """job を変換する。例外は ConversionResult.error に格納して返す"""
+        try:
+            with open(job.source_path, encoding='utf-8') as f:
+                text = f.read()
+            return self.convert(text, job.base_path, job.full_path)
+        except Exception:
+            return ConversionResult(job.full_path, None, {}, [], False, [], [], None, traceback.format_exc())
+
+
+_worker_converter = None
+
+
+def _init_worker(options):
+    global _worker_converter
+    _worker_converter = Converter(options)
+
+
+def _convert_job(job):
+    return _worker_converter.convert_job(job)
+
+
+def convert_all(jobs, options=None, processes=None, chunksize=4):
+    """jobs を変換し、結果を jobs の順番通りに一つずつ返す
+
+    processes が 1 の場合は現在のプロセスで変換する。それ以外の場合は processes
+    個 (None の場合は CPU の数) のワーカーで並列に変換する。各ワーカーは Converter
+    を一つだけ構築する。
+    """
+    if processes == 1:
+        converter = Converter(options)
+        for job in jobs:
+            yield converter.convert_job(job)
+        return
+
+    with multiprocessing.Pool(processes, _init_worker, (options,)) as pool:
+        for result in pool.imap(_convert_job, jobs, chunksize):
+            yield result
+
+
+def validate_links(results, index, extension, diagnostics=None):
+    """deferred_links で変換した results のリンクを index に対してまとめて確認する
+
+    results は (full_path, ConversionResult.links) の列である。span にすべきリン
+    クをページ毎に {full_path: [LinkRecord, ...]} の形で返す。HTML は
+    links.patch_html で書き換える。
+    """
+    table = links.LinkTable()
+    for full_path, records in results:
+        if records:
+            table.set_page(full_path, records)
+    return table.validate(index, extension, diagnostics)
+
+
+def find_jobs(source_dir):
+    """source_dir 以下の全ての .md ファイルを変換する Job を作る"""
+    jobs = []
+    for dirpath, dirnames, filenames in os.walk(source_dir):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith('.'))
+        for filename in sorted(filenames):
+            if not filename.endswith('.md'):
+                continue
+            source_path = os.path.join(dirpath, filename)
+            full_path = os.path.relpath(source_path, source_dir).replace(os.sep, '/')
+            jobs.append(Job(source_path, os.path.dirname(full_path), full_path))
+    return jobs
+
+
+def read_jobs(path):
+    """JSON Lines 形式 ({"source": ..., "base_path": ..., "full_path": ...}) の Job の一覧を読む"""
+    jobs = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                job = json.loads(line)
+                jobs.append(Job(job['source'], job['base_path'], job['full_path']))
+    return jobs
+
+
+def output_path(output, full_path, extension):
+    """ページ full_path の変換結果を書き出すパスを返す"""
+    return os.path.join(output, links.remove_md(full_path, extension))
+
+
+def _write_file(path, text):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert markdown documents in batch.')
+    parser.add_argument('jobs', nargs='?', help='JSON Lines file of {"source", "base_path", "full_path"}')
+    parser.add_argument('--source-dir', help='convert all .md files under this directory')
+    parser.add_argument('--config', help='JSON file of converter options')
+    parser.add_argument('--output', required=True, help='output directory')
+    parser.add_argument('--link-index', help='check internal links against the .md files under this directory')
+    parser.add_argument('--deferred-links', action='store_true',
+                        help='check internal links against the converted pages after converting them all')
+    parser.add_argument('--diagnostics-json', help='write link diagnostics to this JSON file')
+    parser.add_argument('--manifest', help='skip pages whose output is unchanged since the build recorded in this file')
+    parser.add_argument('--prune', action='store_true',
+                        help='drop manifest records of pages not in the jobs file (implied by --source-dir)')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    if (args.jobs is None) == (args.source_dir is None):
+        parser.error('specify either a jobs file or --source-dir')
+    if args.deferred_links and (args.link_index or args.manifest):
+        parser.error('--deferred-links cannot be used with --link-index or --manifest')
+
+    options = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            options.update(json.load(f))
+    extension = options.get('extension', DEFAULT_OPTIONS['extension'])
+    if args.link_index:
+        options['hrefs'] = links.LinkIndex.from_directory(args.link_index, extension)
+    if args.deferred_links:
+        options['hrefs'] = None
+        options['deferred_links'] = True
+
+    jobs = read_jobs(args.jobs) if args.jobs else find_jobs(args.source_dir)
+    all_pages = [job.full_path for job in jobs]
+
+    diagnostics = links.LinkDiagnostics()
+    build_manifest = None
+    if args.manifest:
+        index = options.get('hrefs')
+        if index is not None and not isinstance(index, links.LinkIndex):
+            index = options['hrefs'] = links.LinkIndex(index, extension)
+        fingerprint = manifest.config_fingerprint(dict(DEFAULT_OPTIONS, **options))
+        build_manifest = manifest.Manifest.load(args.manifest, fingerprint)
+        if args.source_dir or args.prune:
+            # 一部のページだけの jobs ファイルでは、他のページの記録を残す
+            build_manifest.prune(job.full_path for job in jobs)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        digests = {}
+        pending = []
+        for job in jobs:
+            try:
+                digest = digests[job.full_path] = manifest.file_digest(job.source_path)
+            except OSError:
+                pending.append(job)
+                continue
+            if (build_manifest.is_up_to_date(job.full_path, digest, index, now) and
+                    os.path.exists(output_path(args.output, job.full_path, extension))):
+                for d in build_manifest.diagnostics(job.full_path):
+                    diagnostics.record(d.page, d.href, d.resolved, d.kind)
+            else:
+                pending.append(job)
+        sys.stderr.write('{0} of {1} pages are up to date.\n'.format(len(jobs) - len(pending), len(jobs)))
+        jobs = pending
+
+    failed = 0
+    deferred = []
+    for result in convert_all(jobs, options, args.processes):
+        if result.error is not None:
+            failed += 1
+            sys.stderr.write('Error: [{0}]\n{1}'.format(result.full_path, result.error))
+            if build_manifest is not None:
+                build_manifest.remove(result.full_path)
+            continue
+        for d in result.diagnostics:
+            diagnostics.record(d.page, d.href, d.resolved, d.kind)
+        _write_file(output_path(args.output, result.full_path, extension), result.html)
+        if result.links is not None:
+            deferred.append((result.full_path, result.links))
+        if build_manifest is not None and result.full_path in digests:
+            build_manifest.update(
+                result.full_path, digests[result.full_path], result.expires,
+                result.link_targets, options.get('hrefs'), result.diagnostics)
+
+    if args.deferred_links:
+        # 変換した全てのページ (jobs) を存在するページとして確認し、存在しないリ
+        # ンクを含むページの出力だけを書き換える
+        index = links.LinkIndex(frozenset(links.page_path(page, extension) for page in all_pages), extension)
+        for page, records in validate_links(deferred, index, extension, diagnostics).items():
+            path = output_path(args.output, page, extension)
+            with open(path, encoding='utf-8') as f:
+                html = f.read()
+            _write_file(path, links.patch_html(html, records))
+
+    if build_manifest is not None:
+        build_manifest.save(args.manifest)
+
+    if args.diagnostics_json:
+        diagnostics.write_json(args.diagnostics_json)
+    else:
+        diagnostics.write_report()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -15,7 +15,8 @@
 import re
 
 from markdown.extensions import Extension
-from markdown.preprocessors import Preprocessor
+
+from . import line_syntax
 
 
 def replace_commit_line(line: str) -> str:
@@ -35,28 +36,26 @@ def replace_commit_line(line: str) -> str:
 
 class CommitExtension(Extension):
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         pre = CommitPreprocessor(md)
 
         md.registerExtension(self)
-        md.preprocessors.add('commit', pre, ">normalize_whitespace")
+        line_syntax.register(md, pre, 'commit', 40)
+
 
+class CommitPreprocessor(line_syntax.LineSyntaxProcessor):
 
-class CommitPreprocessor(Preprocessor):
+    keyword = 'commit'
 
     def __init__(self, md):
-        Preprocessor.__init__(self, md)
+        line_syntax.LineSyntaxProcessor.__init__(self, md)
         self._markdown = md
 
-    def run(self, lines):
-        new_lines = []
+    def reset(self):
         self._markdown._meta_result = {}
 
-        for line in lines:
-            new_line = replace_commit_line(line)
-            new_lines.append(new_line)
-
-        return new_lines
+    def run_line(self, line):
+        return replace_commit_line(line)
 
 
 def makeExtension(**kwargs):
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+常駐変換プロセス
+=========================================
+
+Python の起動、markdown や pygments の読み込み、拡張の構築を変換の度に行う代わ
+りに、一度起動したプロセスで変換の要求を受け付け続ける。定義語の辞書、
+global_qualify_list、リンク先の索引、Pygments のハイライタなどは起動時に一度だけ
+構築する (batch.Converter)。
+
+要求と応答は一行に一つの JSON (NDJSON) で、標準入出力または Unix ドメインソケッ
+トでやり取りする。応答を待たずに次の要求を送ってよい。応答は要求と同じ順番で返
+す。
+
+    $ python -m markdown_to_html.daemon --config options.json --link-index site
+    {"id": 1, "full_path": "reference/vector.md", "source": "site/reference/vector.md"}
+    {"id": 1, "html": "...", "meta": {...}, "example_codes": [...], "diagnostics": [...], ...}
+    {"op": "stats"}
+    {"op": "stats", "jobs": 1, "errors": 0, "latency_ms": {"p50": 12.1, ...}, ...}
+
+変換の要求は以下の値を持つ。
+
+* id : 応答にそのまま返す値 (省略可)
+* full_path : 文書のパス (必須)
+* base_path : 文書のディレクトリ (省略すると full_path から求める)
+* text または source : 文書の内容、またはそれを読むファイルのパス
+* now : スポンサーの掲載期限の判断に用いる時刻 (ISO 8601、省略可)
+
+応答は id, full_path, html, meta, example_codes, mathjax, diagnostics,
+link_targets, expires, error, elapsed_ms を持つ。error は失敗した場合の例外の情
+報で、成功した場合は null である。elapsed_ms は変換そのものに掛かった時間である。
+
+その他に以下の要求がある。
+
+* {"op": "stats"} : それまでの応答の件数と待ち時間の統計を返す
+* {"op": "shutdown"} : 以降の要求を読まずに終了する
+
+不明な op には {"id": ..., "error": "unknown op: ..."} を返す。--socket で指定し
+たパスで他のデーモンが接続を受け付けている場合は起動しない。
+"""
+
+import argparse
+import collections
+import datetime
+import errno
+import json
+import multiprocessing
+import os
+import queue
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+import traceback
+
+from . import batch
+from . import links
+
+
+# 起動時に変換して Pygments の字句解析器などを読み込んでおく文書
+WARM_UP_TEXT = '''# warm up
+
+```cpp example
+#include <iostream>
+
+int main() { std::cout << "hello" << std::endl; }
+```
+'''
+
+
+def _parse_request(line):
+    try:
+        request = json.loads(line)
+        if not isinstance(request, dict):
+            raise ValueError('request must be a JSON object')
+    except ValueError as e:
+        return {'op': 'invalid', 'error': 'invalid request: {0}'.format(e)}
+    request.setdefault('op', 'convert')
+    return request
+
+
+def handle_request(converter, request):
+    """変換の要求 request を処理し、応答を返す"""
+    response = {'id': request.get('id'), 'full_path': request.get('full_path')}
+    start = time.perf_counter()
+    try:
+        full_path = request['full_path']
+        base_path = request.get('base_path')
+        if base_path is None:
+            base_path = os.path.dirname(full_path)
+        text = request.get('text')
+        if text is None:
+            with open(request['source'], encoding='utf-8') as f:
+                text = f.read()
+        now = request.get('now')
+        if now is not None:
+            now = datetime.datetime.fromisoformat(now)
+
+        result = converter.convert(text, base_path, full_path, now)
+        response.update(
+            html=result.html,
+            meta=result.meta,
+            example_codes=result.example_codes,
+            mathjax=result.mathjax,
+            diagnostics=[d.to_dict() for d in result.diagnostics],
+            link_targets=result.link_targets,
+            expires=result.expires.isoformat() if result.expires is not None else None,
+            error=None)
+    except Exception:
+        response['error'] = traceback.format_exc()
+    response['elapsed_ms'] = (time.perf_counter() - start) * 1000.0
+    return response
+
+
+_worker_converter = None
+
+
+def _init_worker(options):
+    global _worker_converter
+    _worker_converter = batch.Converter(options)
+    warm_up(_worker_converter)
+
+
+def _unknown_op(request):
+    return {'id': request.get('id'), 'error': 'unknown op: {0}'.format(request['op'])}
+
+
+def _handle_request(request):
+    if request['op'] != 'convert':
+        return _unknown_op(request)
+    return handle_request(_worker_converter, request)
+
+
+def warm_up(converter):
+    converter.convert(WARM_UP_TEXT, '', 'warm_up.md')
+
+
+class LatencyStats(object):
+    """応答の待ち時間の統計
+
+    待ち時間は要求を読み込んでから応答を書き出すまでの時間である。百分位数は直近
+    の window 件から求める。複数のスレッドから同時に record を呼び出してもよい。
+    """
+
+    def __init__(self, window=10000):
+        self._lock = threading.Lock()
+        self._started = time.monotonic()
+        self._samples = collections.deque(maxlen=window)
+        self.jobs = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, latency_ms, error=False):
+        with self._lock:
+            self._samples.append(latency_ms)
+            self.jobs += 1
+            if error:
+                self.errors += 1
+            self.total_ms += latency_ms
+            if latency_ms > self.max_ms:
+                self.max_ms = latency_ms
+
+    def to_dict(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            uptime = time.monotonic() - self._started
+
+            def percentile(p):
+                if not samples:
+                    return None
+                return samples[min(len(samples) - 1, int(len(samples) * p / 100.0))]
+
+            return {
+                'jobs': self.jobs,
+                'errors': self.errors,
+                'uptime_s': uptime,
+                'jobs_per_s': self.jobs / uptime if uptime > 0 else None,
+                'latency_ms': {
+                    'mean': self.total_ms / self.jobs if self.jobs else None,
+                    'p50': percentile(50),
+                    'p90': percentile(90),
+                    'p99': percentile(99),
+                    'max': self.max_ms,
+                },
+            }
+
+
+class _Finished(object):
+    """既に得られた応答。multiprocessing の AsyncResult と同じく get() で返す"""
+
+    def __init__(self, response):
+        self._response = response
+
+    def get(self):
+        return self._response
+
+
+class Daemon(object):
+    """変換の要求を処理する
+
+    processes が 1 の場合は現在のプロセスの Converter で順に変換する。それ以外の
+    場合は processes 個 (None の場合は CPU の数) のワーカーで並列に変換する。どち
+    らの場合も、応答は接続毎に要求と同じ順番で返す。
+    """
+
+    def __init__(self, options=None, processes=1):
+        self.stats = LatencyStats()
+        self._lock = threading.Lock()
+        self._converter = None
+        self._pool = None
+        # 一つの接続で応答を待っている要求の数の上限
+        self.max_pending = 2 * (processes or os.cpu_count() or 1)
+        if processes == 1:
+            self._converter = batch.Converter(options)
+            warm_up(self._converter)
+        else:
+            self._pool = multiprocessing.Pool(processes, _init_worker, (options,))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+    def _submit(self, request):
+        if self._pool is not None:
+            return self._pool.apply_async(_handle_request, (request,))
+        # ソケットの場合は複数の接続から呼び出される
+        with self._lock:
+            return _Finished(handle_request(self._converter, request))
+
+    def _respond(self, stamp, request, result):
+        op = request['op']
+        if op == 'convert':
+            try:
+                response = result.get()
+            except Exception:
+                response = {'id': request.get('id'), 'full_path': request.get('full_path'),
+                            'error': traceback.format_exc()}
+            self.stats.record((time.perf_counter() - stamp) * 1000.0, response['error'] is not None)
+            return response
+        if op == 'stats':
+            return dict(self.stats.to_dict(), op='stats')
+        if op == 'shutdown':
+            return {'op': 'shutdown'}
+        if op == 'invalid':
+            return {'id': None, 'error': request['error']}
+        return _unknown_op(request)
+
+    def _write_responses(self, pending, write, failed):
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            response = self._respond(*item)
+            if failed:
+                # 書き込めなくなった後も、読み込み側が止まらないように取り出し続ける
+                continue
+            try:
+                write(json.dumps(response, ensure_ascii=False, default=str) + '\n')
+            except (OSError, ValueError):
+                failed.append(True)
+
+    def serve(self, lines, write):
+        """lines の各行の要求を処理し、応答を一行ずつ write に渡す
+
+        要求は応答を待たずに続けて送ってよい。lines は呼び出したスレッドで読み、
+        変換の要求は読んだ順にワーカーに渡す。応答は別のスレッドが要求の順番に
+        write に渡す。応答を待っている要求が max_pending 個になると、応答が返る
+        まで次の要求を読まない。そのため、一つの接続が多数の要求を送っても、他の
+        接続の要求がワーカーに渡されるのを妨げない。
+
+        shutdown の要求を受け取った場合は True を返す。
+        """
+        pending = queue.Queue(self.max_pending)
+        failed = []
+        writer = threading.Thread(target=self._write_responses, args=(pending, write, failed))
+        writer.start()
+        shutdown = False
+        try:
+            for line in lines:
+                if failed:
+                    break
+                if not line.strip():
+                    continue
+                request = _parse_request(line)
+                stamp = time.perf_counter()
+                result = self._submit(request) if request['op'] == 'convert' else None
+                pending.put((stamp, request, result))
+                if request['op'] == 'shutdown':
+                    shutdown = True
+                    break
+        finally:
+            pending.put(None)
+            writer.join()
+        return shutdown
+
+
+class _StreamRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        daemon = self.server.daemon
+
+        def write(data):
+            self.wfile.write(data.encode('utf-8'))
+            self.wfile.flush()
+
+        lines = (line.decode('utf-8') for line in self.rfile)
+        if daemon.serve(lines, write):
+            threading.Thread(target=self.server.shutdown, daemon=True).start()
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _remove_stale_socket(path):
+    """path に残っている、接続を受け付けていないソケットを削除する
+
+    path がソケットでない場合や、他のプロセスが接続を受け付けている場合は OSError
+    を送出する。
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise OSError(errno.EEXIST, 'not a socket', path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        # 終了したデーモンが残したソケット
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        return
+    finally:
+        sock.close()
+    raise OSError(errno.EADDRINUSE, 'another daemon is listening', path)
+
+
+def serve_socket(daemon, path):
+    """Unix ドメインソケット path で要求を受け付ける。接続毎に一つのスレッドで処理する"""
+    _remove_stale_socket(path)
+    server = _UnixServer(path, _StreamRequestHandler)
+    server.daemon = daemon
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def serve_stdio(daemon, output):
+    """標準入力から要求を読み、応答を output に書き出す"""
+    def write(data):
+        output.write(data)
+        output.flush()
+
+    daemon.serve(sys.stdin, write)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert markdown documents requested as NDJSON.')
+    parser.add_argument('--config', help='JSON file of converter options')
+    parser.add_argument('--link-index', help='check internal links against the .md files under this directory')
+    parser.add_argument('--socket', help='listen on this Unix domain socket instead of stdin/stdout')
+    parser.add_argument('-j', '--processes', type=int, default=1, help='number of worker processes')
+    args = parser.parse_args(argv)
+
+    options = {}
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            options.update(json.load(f))
+    extension = options.get('extension', batch.DEFAULT_OPTIONS['extension'])
+    if args.link_index:
+        options['hrefs'] = links.LinkIndex.from_directory(args.link_index, extension)
+
+    if args.socket:
+        try:
+            _remove_stale_socket(args.socket)
+        except OSError as e:
+            sys.stderr.write('Error: {0}\n'.format(e))
+            return 1
+
+    daemon = Daemon(options, args.processes)
+    try:
+        if args.socket:
+            serve_socket(daemon, args.socket)
+        else:
+            serve_stdio(daemon, sys.stdout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
+        sys.stderr.write(json.dumps(daemon.stats.to_dict()) + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -115,22 +115,38 @@ markdown.postprocessors を用いることにしたので必ずしも xml.etree.
   は Treeprocessor ではできない。仕方がないので Postprocessor で処理することに
   した。
 
+* html_tree の HTML 木構造段階に登録している。HTML の解析と文字列化はこ
+  の段階でまとめて一度だけ行われ、html_attribute の AttributePostprocessor と同
+  じ木を共有する。定義語のリンクにも URL の調整やリンク先の存在確認が適用される
+  ように、AttributePostprocessor (priority=10) より先 (priority=20) に実行する。
+
 """
 
+import collections
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+
 from markdown.extensions import Extension
-from markdown.postprocessors import Postprocessor
 
 import regex as re
 
 import xml.etree.ElementTree as etree
 
-# リンク・コード・タイトルなどの内部は自動リンクの対象としない。除外タグ判定用正規表現
-_RE_EXCLUDED_TAGS = re.compile(r'^(?:a|code|pre|kbd|dfn|h1)$', re.IGNORECASE)
+from . import html_tree
+
+# リンク・コード・タイトルなどの内部は自動リンクの対象としない。除外タグ (小文字)
+_EXCLUDED_TAGS = {'a', 'code', 'pre', 'kbd', 'dfn', 'h1'}
 
 # 自動リンク対象を英単語境界に一致させる必要があるかの判定用正規表現
 _RE_WBEG = re.compile(r'^[\p{Ll}\p{Lu}_0-9]')
 _RE_WEND = re.compile(r'[\p{Ll}\p{Lu}_0-9]$')
 
+# 英単語を構成する文字の判定用正規表現
+_RE_WORD_CHAR = re.compile(r'[\p{Ll}\p{Lu}_0-9]')
+
 # ソース名 (.md) からHTML名 (.html) に置換する時に使う正規表現
 _RE_LINK_EXTENSION = re.compile(r'^([^?#]+?)(?:\.md)([?#]|$)')
 
@@ -138,17 +154,129 @@ _RE_LINK_EXTENSION = re.compile(r'^([^?#]+?)(?:\.md)([?#]|$)')
 _RE_LINK_SCHEME = re.compile(r'^[a-zA-Z0-9]+:')
 
 
-def _quoteWordForRegex(word):
-    ret = re.escape(word)
-    if _RE_WBEG.match(word):
-        ret = r'(?<=^|[^\p{Ll}\p{Lu}_0-9])' + ret
-    if _RE_WEND.search(word):
-        ret = ret + r'(?=$|[^\p{Ll}\p{Lu}_0-9])'
-    return ret
+class DefinedWordMatcher(object):
+    """定義語の一覧から本文中の定義語を検索する (Aho-Corasick 法)
+
+    全ての定義語から Aho-Corasick のオートマトンを構築し、文字列長に対して線形時
+    間で検索する。定義語の数に制限はない [1]。一致の規則は、定義語を逆順に並べた
+    正規表現の選択 "不定値|不定|..." と同じである。
+
+    * 左から順に重ならない一致を探す。同じ位置から始まる一致が複数ある場合は最
+      も長いものを優先する (例えば本文中の "不定値" は "[不定]値" ではなく "[不
+      定値]" になる)。
 
+    * 定義語が英単語文字 (\\p{Ll}, \\p{Lu}, _, 0-9) で始まる (終わる) 場合は、
+      直前 (直後) が英単語文字でない位置でだけ一致する。
+
+    - [1] https://github.com/cpprefjp/site_generator/issues/72
+    """
+
+    def __init__(self, words):
+        self._goto = [{}]
+        self._fail = [0]
+        self._word = [None]
+        self._wbeg = [False]
+        self._wend = [False]
+        self._dict_link = [0]
+
+        first_chars = set()
+        for word in words:
+            if len(word) == 0:
+                continue
+            first_chars.add(word[0])
+            node = 0
+            for ch in word:
+                next_node = self._goto[node].get(ch)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][ch] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._word.append(None)
+                    self._wbeg.append(False)
+                    self._wend.append(False)
+                    self._dict_link.append(0)
+                node = next_node
+            self._word[node] = word
+            self._wbeg[node] = _RE_WBEG.match(word) is not None
+            self._wend[node] = _RE_WEND.search(word) is not None
+
+        # 失敗遷移と、失敗遷移を辿って最初に見つかる定義語の終端 (dict_link) を
+        # 幅優先で設定する。
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                f = self._goto[f].get(ch, 0)
+                self._fail[child] = f
+                self._dict_link[child] = f if self._word[f] is not None else self._dict_link[f]
+
+        # 状態が根にある間は、定義語の先頭文字が現れる位置まで読み飛ばす。
+        if first_chars:
+            self._re_first = re.compile('[%s]' % ''.join(re.escape(ch) for ch in sorted(first_chars)))
+        else:
+            self._re_first = None
+
+    def _accepts(self, text, beg, end, node):
+        if self._wbeg[node] and beg > 0 and _RE_WORD_CHAR.match(text, beg - 1):
+            return False
+        if self._wend[node] and end < len(text) and _RE_WORD_CHAR.match(text, end):
+            return False
+        return True
+
+    def finditer(self, text):
+        """text 中の定義語の一致 (開始位置, 終了位置) を順に列挙する"""
+        if self._re_first is None:
+            return
 
-class DefinedWordTreeprocessor(Postprocessor):
-    """A postprocessor for Python-Markdown to create links of defined words."""
+        goto = self._goto
+        fail = self._fail
+        word = self._word
+        dict_link = self._dict_link
+
+        # 各開始位置に対する最長の一致の終了位置
+        longest = {}
+        node = 0
+        i = 0
+        n = len(text)
+        while i < n:
+            if node == 0:
+                m = self._re_first.search(text, i)
+                if m is None:
+                    break
+                i = m.start()
+            ch = text[i]
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            i += 1
+
+            k = node if word[node] is not None else dict_link[node]
+            while k:
+                beg = i - len(word[k])
+                if longest.get(beg, 0) < i and self._accepts(text, beg, i, k):
+                    longest[beg] = i
+                k = dict_link[k]
+
+        end = 0
+        for beg in sorted(longest):
+            if beg >= end:
+                end = longest[beg]
+                yield beg, end
+
+
+class DefinedWordDictionary(object):
+    """定義語の辞書を解決し、検索用の DefinedWordMatcher と共に保持する
+
+    リダイレクトの解決やリンクの変換を施した辞書 (entries) は元の辞書の複製であ
+    り、構築後は読み取り専用として扱う。同じ内容の辞書・base_url・extension に対
+    しては get_dictionary によってプロセス全体で一つの DefinedWordDictionary が
+    共有される。
+    """
 
     def _resolveWordProperty(self, word, prop):
         if prop in self._dict[word]:
@@ -186,40 +314,155 @@ class DefinedWordTreeprocessor(Postprocessor):
                     link = self.base_url + link
                 entry['resolved_link'] = link
 
+    def __init__(self, words, base_url, extension):
+        self.base_url = base_url
+        self.extension = extension
+        self._dict = {word: dict(entry) if isinstance(entry, dict) else entry for word, entry in words.items()}
+        self._resolveDictionary()
+        self.matcher = DefinedWordMatcher(self._dict.keys())
+
+    @property
+    def entries(self):
+        return self._dict
+
+
+# 構築済みの DefinedWordDictionary (fingerprint → DefinedWordDictionary)
+_dictionary_cache = {}
+_DICTIONARY_CACHE_SIZE = 8
+
+# 同じ words オブジェクトからの取得 (id(words) → (words, base_url, extension, DefinedWordDictionary))。
+# words への参照を持つので id が再利用されることはない
+_identity_cache = {}
+
+# pickle の形式の版。DefinedWordDictionary の構造を変えた場合に上げる
+_DICTIONARY_FORMAT = 1
+_CODE_VERSION = None
+
+
+def _code_version():
+    """このモジュールのソースと regex の版のハッシュ値
+
+    pickle のキーに含め、照合の処理やクラスの構造が変わった後に古いコードが保存
+    した辞書を読み込まないようにする。
+    """
+    global _CODE_VERSION
+    if _CODE_VERSION is None:
+        with open(__file__, 'rb') as f:
+            source = f.read()
+        data = b'\0'.join([source, getattr(re, '__version__', '').encode('utf-8')])
+        _CODE_VERSION = hashlib.sha1(data).hexdigest()
+    return _CODE_VERSION
+
+
+def _fingerprint(words, base_url, extension):
+    # Note: リダイレクトの解決結果は辞書の順序に依存し得るので sort_keys はしない
+    data = json.dumps([words, base_url, extension], ensure_ascii=False)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _cache_key(words, base_url, extension):
+    data = '%d:%s:%s' % (_DICTIONARY_FORMAT, _code_version(), _fingerprint(words, base_url, extension))
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _loadDictionary(path):
+    """保存した辞書を読み込む。読み込めない場合や型が異なる場合は None を返す"""
+    try:
+        with open(path, 'rb') as f:
+            dictionary = pickle.load(f)
+    except Exception:
+        return None
+    if not isinstance(dictionary, DefinedWordDictionary):
+        return None
+    return dictionary
+
+
+def _saveDictionary(path, dictionary):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(dictionary, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def get_dictionary(words, base_url, extension, cache_dir=''):
+    """words, base_url, extension に対応する DefinedWordDictionary を取得する
+
+    一度構築した結果はプロセス内でキャッシュされる。cache_dir が指定されている場
+    合はその下に pickle として保存し、新しいプロセスでも構築を省略する。
+
+    同じ words オブジェクトで呼び出した場合は、内容を比べずに前回の結果を返す。
+    words を書き換えた場合は別のオブジェクトとして渡すこと。
+    """
+    hit = _identity_cache.get(id(words))
+    if hit is not None and hit[0] is words and hit[1] == base_url and hit[2] == extension:
+        return hit[3]
+
+    key = _fingerprint(words, base_url, extension)
+    dictionary = _dictionary_cache.get(key)
+    if dictionary is not None:
+        _remember(_identity_cache, id(words), (words, base_url, extension, dictionary))
+        return dictionary
+
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, 'defined_words-%s.pickle' % _cache_key(words, base_url, extension))
+        dictionary = _loadDictionary(path)
+    if dictionary is None:
+        dictionary = DefinedWordDictionary(words, base_url, extension)
+        if path is not None:
+            _saveDictionary(path, dictionary)
+
+    _remember(_dictionary_cache, key, dictionary)
+    _remember(_identity_cache, id(words), (words, base_url, extension, dictionary))
+    return dictionary
+
+
+def _remember(cache, key, value):
+    if key not in cache and len(cache) >= _DICTIONARY_CACHE_SIZE:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+
+class DefinedWordTreeprocessor(html_tree.HtmlTreeProcessor):
+    """A tree processor for Python-Markdown to create links of defined words."""
+
     def __init__(self, md, config):
-        Postprocessor.__init__(self, md)
+        html_tree.HtmlTreeProcessor.__init__(self, md)
         self._markdown = md
 
         self.config = config
         self.base_url = self.config['base_url']
         self.base_path = self.config['base_path']
         self.extension = self.config['extension']
-        self._dict = self.config['dict']
-
-        if len(self._dict) > 0:
-            # Note: regex には 500 個の制限があるらしい (以下参照)。
-            # https://github.com/cpprefjp/site_generator/issues/72
-            # https://github.com/cpprefjp/markdown_to_html/commit/fb18c87b48c6290dd6ba00141ecb2f5dc8aba930
-            if len(self._dict) > 500:
-                raise Exception("Too many defined words: count = %d must not be greater than 500" % len(self._dict))
-            # Note: できるだけ長い一致を優先させるため逆ソートしてから正規表現にす
-            # る。例えば "不定|不定値" ではなく "不定値|不定" になるようにしないと、
-            # 本文中の "不定値" に対して "[不定値]" とリンク付けされて欲しいが "[不
-            # 定]値" とリンク付けされてしまう。
-            self.re_defined_words = re.compile(r'|'.join([_quoteWordForRegex(key) for key in sorted(self._dict.keys(), reverse=True)]), re.MULTILINE)
-
-            self._resolveDictionary()
+        html_tree.set_document(md, self.config['full_path'])
+        self._dict = {}
+
+        if len(self.config['dict']) > 0:
+            dictionary = get_dictionary(self.config['dict'], self.base_url, self.extension, self.config['cache_dir'])
+            self._dict = dictionary.entries
+            self._matcher = dictionary.matcher
+
+    def set_document(self, base_path, full_path):
+        """Set the location of the document to be converted next"""
+        self.config['base_path'] = base_path
+        self.config['full_path'] = full_path
+        self.base_path = base_path
+        html_tree.set_document(self._markdown, full_path)
 
     def _convertText(self, text):
         new_text = None
         ins = []
         pos = 0
         prev = None
-        for m in self.re_defined_words.finditer(text):
-            word = m.group(0)
-            if word not in self._dict:
-                continue
-            left = text[pos:m.start()]
+        for beg, end in self._matcher.finditer(text):
+            word = text[beg:end]
+            left = text[pos:beg]
             if prev is not None:
                 prev.tail = left
             else:
@@ -235,7 +478,7 @@ class DefinedWordTreeprocessor(Postprocessor):
             a.text = word
             ins.append(a)
 
-            pos = m.end()
+            pos = end
             prev = a
 
         left = text[pos:]
@@ -246,53 +489,49 @@ class DefinedWordTreeprocessor(Postprocessor):
 
         return new_text, ins
 
-    def _recurseElement(self, elem):
-        if elem.tag is etree.Comment or elem.tag is etree.ProcessingInstruction:
-            return
-        if _RE_EXCLUDED_TAGS.match(elem.tag):
-            return
+    def _convertElement(self, elem):
+        """elem.text と子要素の tail を変換する
 
-        insertions = []
+        新しい子要素の並びを一度に組み立て、挿入があった場合だけスライス代入で
+        置き換える (elem.insert を挿入毎に呼ぶと子要素の数に対して二乗の時間が
+        掛かる)。変換前の子要素の一覧を返す。
+        """
+        children = list(elem)
+        new_children = []
 
         if elem.text is not None:
             elem.text, ins = self._convertText(elem.text)
-        else:
-            ins = []
-        insertions.append(ins)
+            new_children.extend(ins)
 
-        for e in elem:
-            self._recurseElement(e)
+        for e in children:
+            new_children.append(e)
             if e.tail is not None:
                 e.tail, ins = self._convertText(e.tail)
-            else:
-                ins = []
-            insertions.append(ins)
-
-        for i, ins in reversed(list(enumerate(insertions))):
-            for e in reversed(ins):
-                elem.insert(i, e)
+                new_children.extend(ins)
+
+        if len(new_children) != len(children):
+            elem[:] = new_children
+        return children
+
+    def _convertTree(self, root):
+        # Note: 深い文書で再帰の上限に達しないようにスタックで辿る。
+        stack = [root]
+        while stack:
+            elem = stack.pop()
+            tag = elem.tag
+            if tag is etree.Comment or tag is etree.ProcessingInstruction:
+                continue
+            if tag.lower() in _EXCLUDED_TAGS:
+                continue
+            children = self._convertElement(elem)
+            stack.extend(reversed(children))
 
-    def run(self, text):
-        """Construct ElementTree, convert and re-serialize it"""
+    def run(self, root):
+        """Convert the defined words in the shared HTML tree"""
         if len(self._dict) == 0:
             return
 
-        try:
-            md = self._markdown
-            text = '<{tag}>{text}</{tag}>'.format(tag=md.doc_tag, text=text)
-            root = etree.fromstring(text)
-            self._recurseElement(root)
-            output = etree.tostring(root, encoding="unicode", method="xml")
-            beg = output.index('<%s>' % md.doc_tag) + len(md.doc_tag) + 2
-            end = output.rindex('</%s>' % md.doc_tag)
-            return output[beg:end].strip()
-        except etree.ParseError as e:
-            lineno = e.position[0]
-            xs = text.split('\n')[lineno - 5:lineno + 5]
-            print('[Parse Error : {0}]'.format(self.config['full_path']))
-            for x, n in zip(xs, range(lineno - 5, lineno + 5)):
-                print('{0:5d} {1}'.format(n + 1, x))
-            raise
+        self._convertTree(root)
 
 
 class DefinedWordExtension(Extension):
@@ -311,17 +550,27 @@ class DefinedWordExtension(Extension):
                           "the extension of the generated HTML files"],
             'dict': [{"不適格": "/implementation-compliance.md"},
                      "dictionary that maps a defined word to a link"],
+            'cache_dir': ['',
+                          "directory to store the compiled dictionary (disabled if empty)"],
         }
 
         for key, value in kwargs.items():
             if key in self.config:
                 self.setConfig(key, value)
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         """Add DefinedWordTreeprocessor to Markdown instance."""
         proc = DefinedWordTreeprocessor(md, self.getConfigs())
-        md.postprocessors.register(proc, 'defined_words', 1)
+        html_tree.register(md, proc, 'defined_words', 20)
         md.registerExtension(self)
+        self._processor = proc
+
+    def set_document(self, base_path, full_path):
+        """Switch to another document without rebuilding the extension."""
+        self.setConfig('base_path', base_path)
+        self.setConfig('full_path', full_path)
+        if getattr(self, '_processor', None) is not None:
+            self._processor.set_document(base_path, full_path)
 
 
 def makeExtension(**kwargs):
@@ -1,29 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import xml.etree.ElementTree as etree
+
 import markdown
-from markdown.util import etree
+from markdown.treeprocessors import Treeprocessor
 
 
 class FooterExtension(markdown.Extension):
     """Footer Extension."""
-    def __init__(self, configs):
+    def __init__(self, configs=(), **kwargs):
         # デフォルトの設定
         self.config = {
-            'url': [None, 'URL'],
+            'url': ['', 'URL'],
         }
+        super().__init__(**kwargs)
 
         # ユーザ設定で上書き
         for key, value in configs:
             self.setConfig(key, value)
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         footer = FooterTreeprocessor()
         footer.config = self.getConfigs()
         md.registerExtension(self)
-        md.treeprocessors.add('footer', footer, '_begin')
+        # inline (20) より前
+        md.treeprocessors.register(footer, 'footer', 25)
 
 
-class FooterTreeprocessor(markdown.treeprocessors.Treeprocessor):
+class FooterTreeprocessor(Treeprocessor):
     """Build and append footnote div to end of document."""
     def _make_footer(self):
         footer = etree.Element('footer')
@@ -3,16 +3,19 @@
 markdown から変換した HTML に属性を追加する
 """
 
+import collections
+import functools
 import posixpath
 import re
-import sys
 
 import markdown
 from markdown import postprocessors
-from markdown import serializers
 
 import xml.etree.ElementTree as etree
 
+from . import html_tree
+from . import links
+
 HTML_TAGS = {
     'a',
     'abbr',
@@ -124,18 +127,115 @@ HTML_TAGS = {
     'wbr',
 }
 
+RE_URL_HASH = re.compile(r'#.*')
+
+# 文書を跨いで共有する URL 解決結果のキャッシュの大きさ
+LINK_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def _relpath(path, start):
+    return posixpath.relpath(path, start)
+
+
+# a 要素の href の解決結果
+#
+# href          書き換え後の絶対 URL
+# href_path     href から # 以降を除いたもの
+# relative_href 相対リンクを使う場合の href (現在の文書へのリンクを除く)
+# check_href    存在確認に使うサイト内パス (# 以降を除く)。確認しない場合は None
+# target        target 属性の値。設定しない場合は None
+ResolvedLink = collections.namedtuple('ResolvedLink', ['href', 'href_path', 'relative_href', 'check_href', 'target'])
+
+
+def _make_resolved_link(href, check_href, target, url_base, url_current_base):
+    if href.startswith(url_base):
+        relative_href = _relpath(href, url_current_base)
+    else:
+        relative_href = href
+    if check_href is not None:
+        check_href = RE_URL_HASH.sub('', check_href)
+    return ResolvedLink(href, RE_URL_HASH.sub('', href), relative_href, check_href, target)
+
+
+@functools.lru_cache(maxsize=LINK_CACHE_SIZE)
+def _resolve_link(base_url, base_path, extension, url):
+    """ページ内リンク以外の href を解決する
+
+    結果は現在の文書の位置 (full_path) に依存しないので、同じ base_path を持つ
+    文書の間で共有される。
+    """
+    url_base = base_url + '/'
+    url_current_base = url_base + base_path.strip('/')
+
+    target = None
+    check_href = None
+    href = url
+    if url.startswith('http://') or url.startswith('https://'):
+        # 絶対パス
+        base_url_body = base_url.split('//', 2)[1]
+        url_body = url.split('//', 2)[1]
+        # 別ドメインの場合は別タブで開く
+        if not url_body.startswith(base_url_body):
+            target = '_blank'
+        else:
+            check_href = url_body[len(base_url_body):]
+    elif url.startswith('/'):
+        # サイト内絶対パス
+        href = links.remove_md(base_url + url, extension)
+        check_href = links.remove_md(url, extension)
+    elif url.startswith('mailto:'):
+        # メール
+        pass
+    else:
+        # サイト内相対パス
+        paths = []
+        for p in base_path.strip('/').split('/') + url.split('/'):
+            if p == '':
+                continue
+            elif p == '.':
+                continue
+            elif p == '..':
+                paths = paths[:-1]
+            else:
+                paths.append(p)
+        href = links.remove_md(base_url + '/' + '/'.join(paths), extension)
+        check_href = links.remove_md('/' + '/'.join(paths), extension)
+    return _make_resolved_link(href, check_href, target, url_base, url_current_base)
+
+
+def link_cache_info():
+    """URL 解決のキャッシュの統計 (hits, misses, maxsize, currsize) を返す"""
+    return _resolve_link.cache_info()
+
 
 class SafeRawHtmlPostprocessor(postprocessors.Postprocessor):
 
     HTML_TAG_RE = re.compile(r'^\<\/?([a-zA-Z0-9]+)[^\>]*\>$')
+    PLACEHOLDER_RE = re.compile(r'([0-9]+)'.join(map(re.escape, markdown.util.HTML_PLACEHOLDER.split('%s'))))
 
     def run(self, text):
-        for i in range(self.markdown.htmlStash.html_counter):
-            html = self.markdown.htmlStash.rawHtmlBlocks[i]
-            # if not safe:
-            #     html = self.escape(html)
-            text = text.replace(self.markdown.htmlStash.get_placeholder(i), html)
-        return text
+        # 一度の走査で置換する。i 番目の HTML に含まれるプレースホルダは、i よ
+        # り後の番号のものだけを展開する。
+        count = self.md.htmlStash.html_counter
+        if count == 0:
+            return text
+        blocks = self.md.htmlStash.rawHtmlBlocks
+        expanded = [None] * count
+
+        def expand(index, html):
+            def repl(m):
+                k = int(m.group(1))
+                if k <= index or k >= count or m.group(1) != str(k):
+                    return m.group(0)
+                if expanded[k] is None:
+                    # if not safe:
+                    #     html = self.escape(html)
+                    expanded[k] = expand(k, blocks[k])
+                return expanded[k]
+            return self.PLACEHOLDER_RE.sub(repl, html)
+
+        return expand(-1, text)
 
     def escape(self, html):
         # html tag
@@ -156,22 +256,40 @@ class SafeRawHtmlPostprocessor(postprocessors.Postprocessor):
         return html.replace('"', '&quot;')
 
 
-class AttributePostprocessor(postprocessors.Postprocessor):
+class AttributePostprocessor(html_tree.HtmlTreeProcessor):
 
     def __init__(self, md, config):
-        postprocessors.Postprocessor.__init__(self, md)
+        html_tree.HtmlTreeProcessor.__init__(self, md)
         self._markdown = md
 
         self.config = config
-        self.re_url_hash = re.compile(r'#.*$')
-        self.url_base = self.config['base_url'].strip('/') + '/'
-        self.url_current = self.url_base + self._remove_md(self.config['full_path'])
-        self.url_current_base = self.url_base + self.config['base_path'].strip('/')
+        self.base_url = self.config['base_url'].strip('/')
+        self.url_base = self.base_url + '/'
+        self.set_document(self.config['base_path'], self.config['full_path'])
 
         image_repo = self.config['image_repo']
         self.re_url_github_image = re.compile(r'^https?://(?:raw.github.com/%s/master|github.com/%s/raw)/' % (image_repo, image_repo))
         self.image_base = 'https://raw.githubusercontent.com/%s/master/' % image_repo
 
+        # 木を一度だけ走査し、タグ名に対応する処理を呼び出す
+        self._handlers = {
+            'table': self._add_border_table,
+            'a': self._adjust_link,
+            'img': self._resolve_image_src,
+        }
+        self._link_count = 0
+        self._deferred_links = None
+        self._link_targets = None
+        self._index = None
+
+    def set_document(self, base_path, full_path):
+        """変換する文書の位置を設定する"""
+        self.config['base_path'] = base_path
+        self.config['full_path'] = full_path
+        self.url_current = self.url_base + self._remove_md(full_path)
+        self.url_current_base = self.url_base + base_path.strip('/')
+        html_tree.set_document(self._markdown, full_path)
+
     def _iterate(self, elements, f):
         f(elements)
         for child in elements:
@@ -185,190 +303,128 @@ class AttributePostprocessor(postprocessors.Postprocessor):
             e.text = text
 
     def _add_border_table(self, element):
-        if element.tag == 'table':
-            element.attrib['border'] = '1'
-            element.attrib['bordercolor'] = '#888'
-            element.attrib['style'] = 'border-collapse:collapse'
+        element.attrib['border'] = '1'
+        element.attrib['bordercolor'] = '#888'
+        element.attrib['style'] = 'border-collapse:collapse'
 
     def _remove_md(self, url):
-        # サイト内絶対パスで末尾に .md があった場合、取り除く
-        # （github のプレビューとの互換性のため）
-        # その後、指定があればその拡張子を追加する
-        matched = re.match('([^#]*)\\.md(#.*)?$', url)
-        if matched:
-            url = matched.group(1)
-            if self.config['extension']:
-                url = url + self.config['extension']
-            anchor = matched.group(2)
-            if anchor is not None:
-                url = url + anchor
-        return url
-
-    def _to_absolute_url(self, element):
-        if element.tag == 'a' and 'href' in element.attrib:
-            base_url = self.config['base_url'].strip('/')
-            base_paths = self.config['base_path'].strip('/').split('/')
-            full_path = self.config['full_path']
-
-            check_href = None
-
-            url = element.attrib['href']
-            if url.startswith('http://') or url.startswith('https://'):
-                # 絶対パス
-                base_url_body = base_url.split('//', 2)[1]
-                url_body = url.split('//', 2)[1]
-                # 別ドメインの場合は別タブで開く
-                if not url_body.startswith(base_url_body):
-                    element.attrib['target'] = '_blank'
-                else:
-                    check_href = url_body[len(base_url_body):]
-            elif url.startswith('/'):
-                # サイト内絶対パス
-                element.attrib['href'] = base_url + url
-                element.attrib['href'] = self._remove_md(element.attrib['href'])
-                check_href = self._remove_md(url)
-            elif url.startswith('#'):
-                # ページ内リンク
-                element.attrib['href'] = base_url + '/' + self._remove_md(full_path) + url
-                check_href = '/' + self._remove_md(full_path)
-            elif url.startswith('mailto:'):
-                # メール
-                pass
+        return links.remove_md(url, self.config['extension'])
+
+    def _resolve_link(self, url):
+        if url.startswith('#'):
+            # ページ内リンク
+            href = self.base_url + '/' + self._remove_md(self.config['full_path']) + url
+            check_href = '/' + self._remove_md(self.config['full_path'])
+            return _make_resolved_link(href, check_href, None, self.url_base, self.url_current_base)
+        return _resolve_link(self.base_url, self.config['base_path'], self.config['extension'], url)
+
+    def _to_absolute_url(self, element, link):
+        url = element.attrib['href']
+        element.attrib['href'] = link.href
+        if link.target is not None:
+            element.attrib['target'] = link.target
+
+        check_href = link.check_href
+        if check_href is None:
+            return
+
+        if self._link_targets is not None:
+            self._link_targets.add(links.link_target(check_href, self.config['extension']))
+
+        if self._deferred_links is not None:
+            # リンク先の確認はビルドの最後に LinkTable.validate でまとめて行う
+            self._deferred_links.append(links.LinkRecord(self._link_count, url, check_href, link.href))
+            return
+
+        index = self._index
+        if index is not None:
+            # パスの存在チェック
+            problem = index.check(check_href)
+            if problem is not None:
+                kind, resolved = problem
+                diagnostics = getattr(self._markdown, '_html_attribute_diagnostics', None)
+                links.report(diagnostics, self.config['full_path'], url, resolved, kind)
+                element.tag = 'span'
+
+    def _link_index(self):
+        hrefs = getattr(self._markdown, '_html_attribute_hrefs', None)
+        if hrefs is None or isinstance(hrefs, links.LinkIndex):
+            return hrefs
+        # パスの集合が直接設定されている場合
+        return links.LinkIndex(hrefs, self.config['extension'])
+
+    def _to_relative_url(self, element, link):
+        if element.tag == 'a':
+            if link.href_path == self.url_current:
+                element.attrib['href'] = link.href[len(self.url_current):]
             else:
-                # サイト内相対パス
-                paths = []
-                for p in base_paths + url.split('/'):
-                    if p == '':
-                        continue
-                    elif p == '.':
-                        continue
-                    elif p == '..':
-                        paths = paths[:-1]
-                    else:
-                        paths.append(p)
-                element.attrib['href'] = base_url + '/' + '/'.join(paths)
-                element.attrib['href'] = self._remove_md(element.attrib['href'])
-                check_href = self._remove_md('/' + '/'.join(paths))
-
-            if hasattr(self._markdown, '_html_attribute_hrefs') and self._markdown._html_attribute_hrefs is not None:
-                # パスの存在チェック
-                if check_href is not None:
-                    check_href = re.sub('#.*', '', check_href)
-                    if check_href.endswith('.nolink'):
-                        # そのうち作られるはずだけど、まだリンク先のファイルが存在していないケース
-                        if self._remove_md(check_href.replace('.nolink', '')) in self._markdown._html_attribute_hrefs:
-                            # .nolink マークされていたけど、実際はもうこのファイルは作られているっぽいケース
-                            # .nolink を外すこと
-                            sys.stderr.write('Warning: [nolinked {full_path}] href "{url} ({check_href})" found.\n'.format(**locals()))
-                            element.tag = 'span'
-                        else:
-                            # このファイルを作るように促す
-                            check_href = check_href.replace('.nolink', '')
-                            sys.stdout.write('Note: You can create {check_href} for {full_path}.\n'.format(**locals()))
-                            element.tag = 'span'
-                    else:
-                        # .nolink でない、普通のファイル
-                        if check_href not in self._markdown._html_attribute_hrefs:
-                            sys.stderr.write('Warning: [{full_path}] href "{url} ({check_href})" not found.\n'.format(**locals()))
-                            element.tag = 'span'
-
-    def _to_relative_url(self, element):
-        if element.tag == 'a' and 'href' in element.attrib:
-            href = element.attrib['href']
-            if self.re_url_hash.sub("", href) == self.url_current:
-                element.attrib['href'] = href[len(self.url_current):]
-            elif href.startswith(self.url_base):
-                element.attrib['href'] = posixpath.relpath(href, self.url_current_base)
+                element.attrib['href'] = link.relative_href
 
     def _resolve_image_src(self, element):
-        if element.tag == 'img' and 'src' in element.attrib:
+        if 'src' in element.attrib:
             src = element.attrib['src']
             src = self.re_url_github_image.sub(self.image_base, src, count=1)
             if self.config['use_static_image'] and src.startswith(self.image_base):
                 src = 'static/image/' + src[len(self.image_base):]
                 if self.config['use_relative_link']:
-                    src = posixpath.relpath(self.url_base + src, self.url_current_base)
+                    src = _relpath(self.url_base + src, self.url_current_base)
                 else:
                     src = '/' + src
             element.attrib['src'] = src
 
-    def _adjust_url(self, element):
-        self._to_absolute_url(element)
+    def _adjust_link(self, element):
+        if 'href' not in element.attrib:
+            return
+        link = self._resolve_link(element.attrib['href'])
+        self._to_absolute_url(element, link)
 
         # 一旦絶対パスに統一してから相対パスに変換する
         if self.config['use_relative_link']:
-            self._to_relative_url(element)
+            self._to_relative_url(element, link)
 
-        self._resolve_image_src(element)
+        self._link_count += 1
 
     def _add_meta(self, element):
         body = etree.Element('div', itemprop="articleBody")
+        children = []
         after_h1 = False
-        for e in list(element):
+        for e in element:
             if e.tag == 'h1':
                 e.attrib['itemprop'] = 'name'
                 after_h1 = True
+                children.append(e)
             elif after_h1:
                 body.append(e)
-                element.remove(e)
-        element.append(body)
-
-    def _tohtml(self, element):
-        # Note: 以下の様に etree.tostring(method="xml") を用いると
-        # <span></span> や <td></td> が <span /> や <td /> になってしまう。また、
-        # HTML 属性の順序が保持されない。
-        #
-        # return etree.tostring(element, encoding="unicode", method="xml")
-
-        # Note: 代わりに etree.tostring(method="html") を用いると、今度は <img
-        # /> や <br /> が <img> や <br> になってしまい好ましくない。またこの時
-        # も HTML 属性の順序が保持されない。
-        #
-        # return etree.tostring(element, encoding="unicode", method="html")
-
-        # 今は代わりに以下のようにして markdown.serializers の内部変数
-        # markdown.serializers.RE_AMP を一時的に書き換えることによって期待する
-        # 動作を得ている。これは markdown.serializers の内部実装に依存している
-        # ので、markdown.serializers の上流で内部実装に変更があると動かなくなる
-        # 可能性があることに注意する。
-        old_RE_AMP = serializers.RE_AMP
-        try:
-            serializers.RE_AMP = re.compile(r'&')
-            output = self._markdown.serializer(element)
-        finally:
-            serializers.RE_AMP = old_RE_AMP
-        return output
+            else:
+                children.append(e)
+        children.append(body)
+        element[:] = children
+
+    def run(self, root):
+        # 文書中の href を持つ a 要素の通し番号と、確認を後回しにしたリンク
+        table = getattr(self._markdown, '_html_attribute_link_table', None)
+        self._link_count = 0
+        self._deferred_links = [] if table is not None else None
+        # このページからのリンク先 (ページを追加・削除した時の再変換に使う)
+        graph = getattr(self._markdown, '_html_attribute_link_graph', None)
+        self._link_targets = set() if graph is not None else None
+        # リンク先の索引は文書毎に一度だけ求める
+        self._index = self._link_index()
 
-    def run(self, text):
-        text = '<{tag}>{text}</{tag}>'.format(tag=self._markdown.doc_tag, text=text)
-        try:
-            root = etree.fromstring(text)
-        except etree.ParseError as e:
-            lineno = e.position[0]
-            xs = text.split('\n')[lineno - 5:lineno + 5]
-            print('[Parse Error : {0}]'.format(self.config['full_path']))
-            for x, n in zip(xs, range(lineno - 5, lineno + 5)):
-                print('{0:5d} {1}'.format(n + 1, x))
-            raise
         # self._iterate(root, self._add_color_code)
-        self._iterate(root, self._add_border_table)
-        self._iterate(root, self._adjust_url)
+        handlers = self._handlers
+        for element in root.iter():
+            handler = handlers.get(element.tag)
+            if handler is not None:
+                handler(element)
         self._add_meta(root)
 
-        output = self._tohtml(root)
-        if self._markdown.stripTopLevelTags:
-            try:
-                start = output.index('<%s>' % self._markdown.doc_tag) + len(self._markdown.doc_tag) + 2
-                end = output.rindex('</%s>' % self._markdown.doc_tag)
-                output = output[start:end].strip()
-            except ValueError:
-                if output.strip().endswith('<%s />' % self._markdown.doc_tag):
-                    # We have an empty document
-                    output = ''
-                else:
-                    # We have a serious problem
-                    raise ValueError('Markdown failed to strip top-level tags. Document=%r' % output.strip())
-        return output
+        if table is not None:
+            table.set_page(self.config['full_path'], self._deferred_links)
+            self._deferred_links = None
+        if graph is not None:
+            graph.set_page(self.config['full_path'], self._link_targets)
+            self._link_targets = None
 
 
 class AttributeExtension(markdown.Extension):
@@ -387,10 +443,18 @@ class AttributeExtension(markdown.Extension):
 
         super().__init__(**kwargs)
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         attr = AttributePostprocessor(md, self.getConfigs())
-        md.postprocessors.add('html_attribute', attr, '_end')
-        md.postprocessors['raw_html'] = SafeRawHtmlPostprocessor(md)
+        html_tree.register(md, attr, 'html_attribute', 10)
+        md.postprocessors.register(SafeRawHtmlPostprocessor(md), 'raw_html', 30)
+        self._processor = attr
+
+    def set_document(self, base_path, full_path):
+        """拡張を作り直さずに、次に変換する文書の base_path と full_path を設定する"""
+        self.setConfig('base_path', base_path)
+        self.setConfig('full_path', full_path)
+        if getattr(self, '_processor', None) is not None:
+            self._processor.set_document(base_path, full_path)
 
 
 def makeExtension(**kwargs):
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+HTML の木構造の文字列化
+=========================================
+
+xml.etree.ElementTree の要素を HTML 文字列に変換する。
+
+markdown.serializers と同じ出力を生成するが、'&' は実体参照の一部であっても常に
+'&amp;' に変換する。モジュール大域の状態は書き換えないので、複数のスレッドから同
+時に呼び出してもよい。
+
+* <span></span> や <td></td> はそのまま出力する
+* xhtml の場合、<br /> や <img /> などの空要素は自己終了タグで出力する
+* 属性は名前の順に並べ替えて出力する (markdown.serializers 3.3 と同じ)。要素に
+  設定された順番は保たれない
+
+    >>> element = etree.fromstring('<p>a &amp;amp; b<br /><span></span></p>')
+    >>> print(html_serializer.to_html_string(element, 'xhtml'))
+    <p>a &amp;amp; b<br /><span></span></p>
+"""
+
+from markdown import serializers
+
+from xml.etree.ElementTree import Comment
+from xml.etree.ElementTree import ProcessingInstruction
+from xml.etree.ElementTree import QName
+
+
+HTML_EMPTY = frozenset(serializers.HTML_EMPTY)
+
+
+def _escape_cdata(text):
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def _escape_attrib(text):
+    text = _escape_cdata(text)
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    return text
+
+
+def _serialize(write, elem, format):
+    tag = elem.tag
+    text = elem.text
+    if tag is Comment:
+        write('<!--%s-->' % _escape_cdata(text))
+    elif tag is ProcessingInstruction:
+        write('<?%s?>' % _escape_cdata(text))
+    elif tag is None:
+        if text:
+            write(_escape_cdata(text))
+        for e in elem:
+            _serialize(write, e, format)
+    else:
+        namespace_uri = None
+        if isinstance(tag, QName):
+            if tag.text[:1] == '{':
+                namespace_uri, tag = tag.text[1:].split('}', 1)
+            else:
+                raise ValueError('QName objects must define a tag.')
+        write('<' + tag)
+        items = elem.items()
+        if items:
+            # 並べ替えはモジュールの説明を参照
+            for k, v in sorted(items):
+                if isinstance(k, QName):
+                    k = k.text
+                if isinstance(v, QName):
+                    v = v.text
+                else:
+                    v = _escape_attrib(v)
+                if k == v and format == 'html':
+                    # 論理属性
+                    write(' %s' % v)
+                else:
+                    write(' {}="{}"'.format(k, v))
+        if namespace_uri:
+            write(' xmlns="%s"' % _escape_attrib(namespace_uri))
+        lower = tag.lower()
+        if format == 'xhtml' and lower in HTML_EMPTY:
+            write(' />')
+        else:
+            write('>')
+            if text:
+                if lower in ('script', 'style'):
+                    write(text)
+                else:
+                    write(_escape_cdata(text))
+            for e in elem:
+                _serialize(write, e, format)
+            if lower not in HTML_EMPTY:
+                write('</' + tag + '>')
+    if elem.tail:
+        write(_escape_cdata(elem.tail))
+
+
+def to_html_string(element, format='xhtml'):
+    """element を HTML 文字列に変換する
+
+    format は 'xhtml' または 'html' で、Markdown.output_format に対応する。
+    """
+    data = []
+    _serialize(data.append, element, format)
+    return ''.join(data)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+HTML の木構造に対する書き換え
+=========================================
+
+Postprocessor の段階で HTML を木構造 (xml.etree.ElementTree) に変換して書き換え
+る処理 (定義語のリンク化・属性の追加など) を一つの段階にまとめる。
+
+HTML は生の HTML の復元 (raw_html) の後に一度だけ解析され、登録された全ての
+HtmlTreeProcessor が priority の大きい順に同じ木を書き換え、最後に一度だけ文字列
+に戻される。
+
+    >>> from markdown_to_html import html_tree
+    >>> class MyTreeprocessor(html_tree.HtmlTreeProcessor):
+    ...     def run(self, root):
+    ...         for e in root.iter('table'):
+    ...             e.attrib['border'] = '1'
+    >>> class MyExtension(markdown.Extension):
+    ...     def extendMarkdown(self, md):
+    ...         html_tree.register(md, MyTreeprocessor(md), 'my_tree', 10)
+
+構文エラーの報告に用いる文書のパスは set_document(md, full_path) で設定する。
+"""
+
+import sys
+
+from markdown import postprocessors
+from markdown import util
+
+import xml.etree.ElementTree as etree
+
+from . import html_serializer
+
+
+class HtmlTreeProcessor(util.Processor):
+    """HTML 木構造段階で実行される書き換え処理の基底クラス
+
+    run(root) は文書全体を子に持つ md.doc_tag 要素を受け取り、木をその場で書き換
+    える。
+    """
+
+    def run(self, root):
+        pass
+
+
+class HtmlTreePostprocessor(postprocessors.Postprocessor):
+    """HTML を一度だけ解析し、登録された HtmlTreeProcessor を順に適用する"""
+
+    def __init__(self, md):
+        postprocessors.Postprocessor.__init__(self, md)
+        self._markdown = md
+        self.treeprocessors = util.Registry()
+
+    def _parse(self, text):
+        text = '<{tag}>{text}</{tag}>'.format(tag=self._markdown.doc_tag, text=text)
+        try:
+            return etree.fromstring(text)
+        except etree.ParseError as e:
+            lineno = e.position[0]
+            xs = text.split('\n')[lineno - 5:lineno + 5]
+            # 標準出力は変換結果の出力に使われ得るので、報告は標準エラーに書く
+            sys.stderr.write('[Parse Error : {0}]\n'.format(getattr(self._markdown, '_html_tree_full_path', '')))
+            for x, n in zip(xs, range(lineno - 5, lineno + 5)):
+                sys.stderr.write('{0:5d} {1}\n'.format(n + 1, x))
+            raise
+
+    def _tohtml(self, element):
+        # Note: 以下の様に etree.tostring(method="xml") を用いると
+        # <span></span> や <td></td> が <span /> や <td /> になってしまう。また、
+        # HTML 属性の順序が保持されない。
+        #
+        # return etree.tostring(element, encoding="unicode", method="xml")
+
+        # Note: 代わりに etree.tostring(method="html") を用いると、今度は <img
+        # /> や <br /> が <img> や <br> になってしまい好ましくない。またこの時
+        # も HTML 属性の順序が保持されない。
+        #
+        # return etree.tostring(element, encoding="unicode", method="html")
+
+        # 今は代わりに html_serializer を用いている (詳細はそちらを参照)。
+        return html_serializer.to_html_string(element, self._markdown.output_format)
+
+    def run(self, text):
+        if len(self.treeprocessors) == 0:
+            return text
+
+        root = self._parse(text)
+        for proc in self.treeprocessors:
+            proc.run(root)
+
+        output = self._tohtml(root)
+        if self._markdown.stripTopLevelTags:
+            try:
+                start = output.index('<%s>' % self._markdown.doc_tag) + len(self._markdown.doc_tag) + 2
+                end = output.rindex('</%s>' % self._markdown.doc_tag)
+                output = output[start:end].strip()
+            except ValueError:
+                if output.strip().endswith('<%s />' % self._markdown.doc_tag):
+                    # We have an empty document
+                    output = ''
+                else:
+                    # We have a serious problem
+                    raise ValueError('Markdown failed to strip top-level tags. Document=%r' % output.strip())
+        return output
+
+
+def set_document(md, full_path):
+    """md で次に変換する文書のパスを設定する"""
+    md._html_tree_full_path = full_path
+
+
+def register(md, processor, name, priority):
+    """HTML 木構造段階に processor を登録する
+
+    HtmlTreePostprocessor は最初の登録時に 'html_tree' という名前で
+    md.postprocessors の末尾 (priority 0) に追加され、以降の登録では共有される。
+    """
+    if 'html_tree' in md.postprocessors:
+        stage = md.postprocessors['html_tree']
+    else:
+        stage = HtmlTreePostprocessor(md)
+        md.postprocessors.register(stage, 'html_tree', 0)
+    stage.treeprocessors.register(processor, name, priority)
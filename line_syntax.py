@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+行単位の構文の処理
+=========================================
+
+[meta ...], [mathjax ...], [mark ...], [commit ...], [sponsor ...] の様な角括弧
+で始まる行単位の構文を一つの Preprocessor の段階にまとめる。
+
+各行は一度だけ調べ、'[' を含む行だけを '[' + keyword を含むかどうかで登録された
+処理に振り分ける。
+
+    >>> class MyProcessor(LineSyntaxProcessor):
+    ...     keyword = 'my'
+    ...     def run_line(self, line):
+    ...         return line.replace('[my]', 'MY')
+    >>> line_syntax.register(md, MyProcessor(md), 'my', 10)
+"""
+
+from markdown import util
+from markdown.preprocessors import Preprocessor
+
+
+class LineSyntaxProcessor(Preprocessor):
+    """行単位の構文の処理の基底クラス
+
+    keyword は構文の角括弧の直後の語である。'[' + keyword を含む行についてのみ
+    run_line(line) が呼び出される。run_line は書き換えた行を返すか、行を削除する
+    場合は None を返す。reset() は文書毎に最初に、finish(lines) は全ての行を処理
+    した後に呼び出される。
+
+    単独の Preprocessor として md.preprocessors に登録して使うこともできる。
+    """
+
+    keyword = None
+
+    def reset(self):
+        pass
+
+    def run_line(self, line):
+        return line
+
+    def finish(self, lines):
+        return lines
+
+    def run(self, lines):
+        return run_processors([self], lines)
+
+
+def run_processors(processors, lines):
+    """processors を順に適用しながら lines を一度だけ走査する"""
+    for proc in processors:
+        proc.reset()
+
+    keywords = [('[' + proc.keyword, proc) for proc in processors]
+    new_lines = []
+    for line in lines:
+        if '[' in line:
+            for keyword, proc in keywords:
+                if keyword in line:
+                    line = proc.run_line(line)
+                    if line is None:
+                        break
+            if line is None:
+                continue
+        new_lines.append(line)
+
+    for proc in processors:
+        new_lines = proc.finish(new_lines)
+    return new_lines
+
+
+class LineSyntaxPreprocessor(Preprocessor):
+    """登録された LineSyntaxProcessor を priority の大きい順に一度の走査で適用する"""
+
+    def __init__(self, md):
+        Preprocessor.__init__(self, md)
+        self._markdown = md
+        self.processors = util.Registry()
+
+    def run(self, lines):
+        if len(self.processors) == 0:
+            return lines
+        return run_processors(list(self.processors), lines)
+
+
+def register(md, processor, name, priority):
+    """行単位の構文の段階に processor を登録する
+
+    LineSyntaxPreprocessor は最初の登録時に 'line_syntax' という名前で
+    md.preprocessors に追加され、以降の登録では共有される。priority は 27 で、
+    qualified_fenced_code (28) がコードブロックを退避した後、html_block (20) の
+    前に実行される。
+    """
+    if 'line_syntax' in md.preprocessors:
+        stage = md.preprocessors['line_syntax']
+    else:
+        stage = LineSyntaxPreprocessor(md)
+        md.preprocessors.register(stage, 'line_syntax', 27)
+    stage.processors.register(processor, name, priority)
@@ -0,0 +1,506 @@
+# -*- coding: utf-8 -*-
+"""
+リンク先の存在確認
+=========================================
+
+サイト内リンクのリンク先が存在するかを調べるための索引 (LinkIndex) と、存在しな
+いリンクの診断情報を集める LinkDiagnostics を提供する。
+
+LinkIndex はソースの木から一度だけ構築し、全ての文書の変換で共有する。
+LinkDiagnostics を md._html_attribute_diagnostics に設定すると、html_attribute
+はリンク毎に端末に出力する代わりに診断情報を記録する。ビルドの最後に整列した報
+告を一度に出力するか JSON に書き出す。
+
+    >>> index = links.LinkIndex.from_directory('site', extension='.html')
+    >>> diagnostics = links.LinkDiagnostics()
+    >>> md._html_attribute_hrefs = index
+    >>> md._html_attribute_diagnostics = diagnostics
+    >>> md.convert(text)
+    >>> diagnostics.write_report()
+    Warning: [reference/vector.md] href "/reference/none.md (/reference/none.html)" not found.
+
+事前に全てのページの索引を作る代わりに、LinkTable を
+md._html_attribute_link_table に設定すると、各変換はサイト内リンクを記録するだ
+けになる。ビルドの最後に実際に生成されたページの集合に対して一度だけ確認し、存
+在しないリンクを含むページだけを書き換える (a 要素を span 要素にする)。
+
+    >>> table = links.LinkTable()
+    >>> md._html_attribute_link_table = table
+    >>> pages[full_path] = md.convert(text)
+    >>> demotions = table.validate(extension='.html', diagnostics=diagnostics)
+    >>> for page, records in demotions.items():
+    ...     pages[page] = links.patch_html(pages[page], records)
+
+LinkGraph を md._html_attribute_link_graph に設定すると、各ページのサイト内リン
+クのリンク先を記録する。ページを追加・削除した時には、そのページにリンクしてい
+るページだけを変換し直せばよい。
+
+    >>> graph = links.LinkGraph.load('links.json', extension='.html')
+    >>> md._html_attribute_link_graph = graph
+    >>> graph.affected(['reference/vector/new_function.md'])
+    ['reference/vector.md']
+    >>> graph.save('links.json')
+"""
+
+import collections
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from xml.sax.saxutils import escape
+
+
+RE_REMOVE_MD = re.compile(r'([^#]*)\.md(#.*)?$')
+
+
+def remove_md(url, extension):
+    # サイト内絶対パスで末尾に .md があった場合、取り除く
+    # （github のプレビューとの互換性のため）
+    # その後、指定があればその拡張子を追加する
+    matched = RE_REMOVE_MD.match(url)
+    if matched:
+        url = matched.group(1)
+        if extension:
+            url = url + extension
+        anchor = matched.group(2)
+        if anchor is not None:
+            url = url + anchor
+    return url
+
+
+def link_target(check_href, extension):
+    """存在確認の結果を左右するページのパスを返す
+
+    .nolink の付いたリンクは、印を外したページが作られると結果が変わる。
+    """
+    if check_href.endswith('.nolink'):
+        return remove_md(check_href.replace('.nolink', ''), extension)
+    return check_href
+
+
+def page_path(page, extension):
+    """ページ (full_path) のサイト内パスを返す"""
+    return remove_md('/' + page, extension)
+
+
+class LinkIndex(object):
+    """サイト内に存在するページのパスの集合
+
+    パスは '/reference/vector.html' の様に、サイトの根からの絶対パスに extension
+    を付けたものである。
+    """
+
+    def __init__(self, hrefs=(), extension=''):
+        if isinstance(hrefs, (set, frozenset)):
+            self._hrefs = hrefs
+        else:
+            self._hrefs = frozenset(hrefs)
+        self.extension = extension
+
+    @classmethod
+    def from_directory(cls, root, extension=''):
+        """root 以下の .md ファイルから索引を構築する"""
+        hrefs = set()
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            rel = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            prefix = '/' if rel == '.' else '/' + rel + '/'
+            for filename in filenames:
+                if filename.endswith('.md'):
+                    hrefs.add(remove_md(prefix + filename, extension))
+        return cls(frozenset(hrefs), extension)
+
+    def __contains__(self, href):
+        return href in self._hrefs
+
+    def __iter__(self):
+        return iter(self._hrefs)
+
+    def __len__(self):
+        return len(self._hrefs)
+
+    def nolink(self, check_href):
+        """.nolink の付いたパスについて、印を外したパスとそれが既に存在するかを返す"""
+        href = check_href.replace('.nolink', '')
+        return href, remove_md(href, self.extension) in self._hrefs
+
+    def check(self, check_href):
+        """リンク先 check_href を確認する
+
+        リンクを span にすべき場合は (kind, 報告するパス) を、問題がなければ None
+        を返す。kind は LinkDiagnostic を参照。
+        """
+        if check_href.endswith('.nolink'):
+            # そのうち作られるはずだけど、まだリンク先のファイルが存在していないケース
+            href, exists = self.nolink(check_href)
+            if exists:
+                # .nolink マークされていたけど、実際はもうこのファイルは作られているっぽいケース
+                # .nolink を外すこと
+                return 'nolink_found', check_href
+            # このファイルを作るように促す
+            return 'nolink', href
+        if check_href not in self._hrefs:
+            # .nolink でない、普通のファイル
+            return 'not_found', check_href
+        return None
+
+
+class LinkDiagnostic(object):
+    """存在確認に失敗したリンク一つ分の情報
+
+    kind は以下のいずれか:
+
+    * 'not_found' : リンク先が存在しない
+    * 'nolink' : .nolink の付いたリンクで、リンク先はまだ存在しない
+    * 'nolink_found' : .nolink の付いたリンクだが、リンク先が既に存在する
+    """
+
+    __slots__ = ('page', 'href', 'resolved', 'kind')
+
+    MESSAGES = {
+        'not_found': 'Warning: [{page}] href "{href} ({resolved})" not found.',
+        'nolink': 'Note: You can create {resolved} for {page}.',
+        'nolink_found': 'Warning: [nolinked {page}] href "{href} ({resolved})" found.',
+    }
+
+    def __init__(self, page, href, resolved, kind):
+        self.page = page
+        self.href = href
+        self.resolved = resolved
+        self.kind = kind
+
+    def key(self):
+        return (self.page, self.href, self.resolved, self.kind)
+
+    def message(self):
+        return self.MESSAGES[self.kind].format(page=self.page, href=self.href, resolved=self.resolved)
+
+    def to_dict(self):
+        return {'page': self.page, 'href': self.href, 'resolved': self.resolved, 'kind': self.kind}
+
+
+class LinkDiagnostics(object):
+    """リンクの診断情報を集める
+
+    複数のスレッドから同時に record を呼び出してもよい。別のプロセスで集めたもの
+    は merge でまとめる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = []
+
+    def record(self, page, href, resolved, kind):
+        diagnostic = LinkDiagnostic(page, href, resolved, kind)
+        with self._lock:
+            self._records.append(diagnostic)
+
+    def merge(self, other):
+        with self._lock:
+            self._records.extend(other.records())
+
+    def clear(self):
+        with self._lock:
+            del self._records[:]
+
+    def records(self):
+        """記録された診断情報をページ・リンクの順に整列して返す"""
+        with self._lock:
+            records = list(self._records)
+        records.sort(key=LinkDiagnostic.key)
+        return records
+
+    def __len__(self):
+        return len(self._records)
+
+    def write_report(self, file=None):
+        """記録を出力する
+
+        file を省略すると、report と同じく nolink の案内は標準出力に、それ以外の
+        警告は標準エラーに出力する。
+        """
+        for d in self.records():
+            if file is not None:
+                file.write(d.message() + '\n')
+            elif d.kind == 'nolink':
+                sys.stdout.write(d.message() + '\n')
+            else:
+                sys.stderr.write(d.message() + '\n')
+
+    def to_json(self):
+        return json.dumps([d.to_dict() for d in self.records()], ensure_ascii=False, indent=2)
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.to_json())
+            f.write('\n')
+
+    def __getstate__(self):
+        return {'records': self.records()}
+
+    def __setstate__(self, state):
+        self._lock = threading.Lock()
+        self._records = list(state['records'])
+
+
+def report(diagnostics, page, href, resolved, kind):
+    """diagnostics に記録する。diagnostics が None の場合はその場で出力する"""
+    if diagnostics is not None:
+        diagnostics.record(page, href, resolved, kind)
+        return
+    message = LinkDiagnostic(page, href, resolved, kind).message()
+    if kind == 'nolink':
+        sys.stdout.write(message + '\n')
+    else:
+        sys.stderr.write(message + '\n')
+
+
+# 文書中のサイト内リンク一つ分の記録
+#
+# index         文書中の href を持つ a 要素の中での通し番号
+# href          元の href
+# check_href    存在確認に使うサイト内パス
+# absolute_href 書き換え後の絶対 URL (span にする時にはこれを href に使う)
+class LinkRecord(collections.namedtuple('LinkRecord', ['index', 'href', 'check_href', 'absolute_href'])):
+
+    __slots__ = ()
+
+    @property
+    def nolink(self):
+        return self.check_href.endswith('.nolink')
+
+
+class LinkTable(object):
+    """変換した各ページのサイト内リンクの表
+
+    ページは変換時の full_path で識別する。同じページを再び変換すると記録は置き
+    換えられる。複数のスレッドから同時に set_page を呼び出してもよい。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pages = {}
+
+    def set_page(self, page, records):
+        records = tuple(records)
+        with self._lock:
+            self._pages[page] = records
+
+    def remove_page(self, page):
+        with self._lock:
+            self._pages.pop(page, None)
+
+    def pages(self):
+        with self._lock:
+            return sorted(self._pages)
+
+    def links(self, page):
+        with self._lock:
+            return self._pages.get(page, ())
+
+    def merge(self, other):
+        items = other.items()
+        with self._lock:
+            self._pages.update(items)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._pages.items())
+
+    def produced_index(self, extension=''):
+        """記録されたページの集合から LinkIndex を作る"""
+        return LinkIndex(frozenset(page_path(page, extension) for page in self.pages()), extension)
+
+    def validate(self, index=None, extension='', diagnostics=None):
+        """全てのリンクを index に対して確認する
+
+        index を省略すると、この表に記録されたページの集合を用いる。span にすべき
+        リンクをページ毎に {page: [LinkRecord, ...]} の形で返す。問題のあったリン
+        クは diagnostics に記録する (None の場合はその場で出力する)。
+        """
+        if index is None:
+            index = self.produced_index(extension)
+        elif not isinstance(index, LinkIndex):
+            index = LinkIndex(index, extension)
+
+        demotions = {}
+        for page, records in self.items():
+            demoted = []
+            for record in records:
+                problem = index.check(record.check_href)
+                if problem is not None:
+                    kind, resolved = problem
+                    report(diagnostics, page, record.href, resolved, kind)
+                    demoted.append(record)
+            if demoted:
+                demotions[page] = demoted
+        return demotions
+
+    def __getstate__(self):
+        return {'pages': dict(self.items())}
+
+    def __setstate__(self, state):
+        self._lock = threading.Lock()
+        self._pages = dict(state['pages'])
+
+
+RE_LINK_TAG = re.compile(r'<a(?=[\s>])[^>]*>|</a>')
+RE_HREF_ATTRIBUTE = re.compile(r'(?<=\s)href="[^"]*"')
+
+
+def patch_html(html, records):
+    """html の中の records のリンクを span 要素に置き換える
+
+    html は html_attribute で変換した文書で、records は LinkTable.validate が返
+    したその文書のリンクである。変換時に直接 span にした場合と同じく、href には
+    相対リンクではなく絶対 URL を設定する。
+    """
+    targets = dict((record.index, record) for record in records)
+    if not targets:
+        return html
+
+    parts = []
+    pos = 0
+    count = 0
+    stack = []
+    for m in RE_LINK_TAG.finditer(html):
+        tag = m.group(0)
+        if tag == '</a>':
+            if stack and stack.pop():
+                parts.append(html[pos:m.start()])
+                parts.append('</span>')
+                pos = m.end()
+            continue
+
+        record = None
+        if RE_HREF_ATTRIBUTE.search(tag):
+            record = targets.get(count)
+            count += 1
+        stack.append(record is not None)
+        if record is not None:
+            href = 'href="%s"' % escape(record.absolute_href, {'"': '&quot;'})
+            parts.append(html[pos:m.start()])
+            parts.append('<span' + RE_HREF_ATTRIBUTE.sub(lambda _: href, tag[2:], count=1))
+            pos = m.end()
+    parts.append(html[pos:])
+    return ''.join(parts)
+
+
+class LinkGraph(object):
+    """ページ間のリンクの逆引きの索引
+
+    ページ (full_path) 毎に、そのページのサイト内リンクのリンク先 (link_target)
+    の集合を保持し、リンク先からリンク元のページを引けるようにする。複数のスレッ
+    ドから同時に set_page を呼び出してもよい。
+    """
+
+    VERSION = 1
+
+    def __init__(self, extension=''):
+        self.extension = extension
+        self._lock = threading.Lock()
+        self._targets = {}
+        self._referrers = {}
+
+    def set_page(self, page, targets):
+        targets = frozenset(targets)
+        with self._lock:
+            self._unlink(page)
+            self._targets[page] = targets
+            for target in targets:
+                self._referrers.setdefault(target, set()).add(page)
+
+    def remove_page(self, page):
+        with self._lock:
+            self._unlink(page)
+
+    def _unlink(self, page):
+        for target in self._targets.pop(page, ()):
+            referrers = self._referrers[target]
+            referrers.discard(page)
+            if not referrers:
+                del self._referrers[target]
+
+    def pages(self):
+        with self._lock:
+            return sorted(self._targets)
+
+    def targets(self, page):
+        with self._lock:
+            return sorted(self._targets.get(page, ()))
+
+    def referrers(self, target):
+        """リンク先 target にリンクしているページを返す"""
+        with self._lock:
+            return sorted(self._referrers.get(target, ()))
+
+    def affected(self, pages):
+        """pages を追加・削除した時に変換し直すべきページを返す
+
+        pages は追加・削除したページの full_path である。pages 自身は含まない。
+        """
+        pages = set(pages)
+        result = set()
+        with self._lock:
+            for page in pages:
+                result.update(self._referrers.get(page_path(page, self.extension), ()))
+        return sorted(result - pages)
+
+    def merge(self, other):
+        for page, targets in other.items():
+            self.set_page(page, targets)
+
+    def items(self):
+        with self._lock:
+            return sorted(self._targets.items())
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'version': self.VERSION,
+                'extension': self.extension,
+                'pages': dict((page, sorted(targets)) for page, targets in sorted(self._targets.items())),
+                'referrers': dict((target, sorted(pages)) for target, pages in sorted(self._referrers.items())),
+            }
+
+    def save(self, path):
+        """JSON で保存する。書き込みは一時ファイルを介して原子的に行う"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=1)
+                f.write('\n')
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    @classmethod
+    def load(cls, path, extension=''):
+        """save で保存した索引を読み込む
+
+        ファイルが存在しないか、形式や extension が異なる場合は空の索引を返す。
+        """
+        graph = cls(extension)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return graph
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION or data.get('extension') != extension:
+            return graph
+        for page, targets in data['pages'].items():
+            graph.set_page(page, targets)
+        return graph
+
+    def __getstate__(self):
+        return {'extension': self.extension, 'pages': dict(self.items())}
+
+    def __setstate__(self, state):
+        self.__init__(state['extension'])
+        for page, targets in state['pages'].items():
+            self.set_page(page, targets)
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+差分ビルドのための変換記録
+=========================================
+
+前回の変換で各ページ (full_path) の出力を左右したものを記録し、何も変わってい
+ないページの変換を省略する。ページの出力は以下のもので決まる。
+
+* ソースファイルの内容 (ハッシュ値で記録する)
+* 変換の設定 (config_fingerprint)。base_url, extension, use_relative_link,
+  use_static_image, image_repo, 定義語の辞書, global_qualify_list, コードハイラ
+  イトの設定、追加の拡張、Pygments と Markdown の版、このパッケージのソース
+  (code_version)、リンク先の存在確認をするかどうか
+* 時刻。スポンサーは掲載期限を過ぎると表示されなくなるので、変換時より後の最
+  も早い期限 (md._sponsor_next_expiry) を記録し、それを過ぎたら変換し直す
+* サイト内リンクのリンク先が存在するかどうか。リンク先の存在確認をする場合、
+  ページ毎にリンク先 (links.link_target) とその時の存在の有無を記録し、今回の
+  LinkIndex で一つでも結果が変わるリンクがあれば変換し直す
+
+設定が変わった場合は記録全体を破棄し、全てのページを変換し直す。
+
+    >>> fingerprint = manifest.config_fingerprint(options)
+    >>> m = manifest.Manifest.load('manifest.json', fingerprint)
+    >>> if not m.is_up_to_date(full_path, manifest.file_digest(source_path), index, now):
+    ...     result = converter.convert(...)
+    ...     m.update(full_path, digest, result.expires, result.link_targets, index, result.diagnostics)
+    >>> m.save('manifest.json')
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import tempfile
+import types
+
+import markdown
+from markdown.extensions import Extension
+
+from . import links
+
+try:
+    import pygments
+    PYGMENTS_VERSION = pygments.__version__
+except ImportError:
+    PYGMENTS_VERSION = None
+
+
+# 出力に影響する Converter のオプション
+FINGERPRINT_OPTIONS = [
+    'base_url',
+    'extension',
+    'use_relative_link',
+    'use_static_image',
+    'image_repo',
+    'defined_words',
+    'global_qualify_list',
+    'codehilite',
+    'extensions',
+]
+
+
+_CODE_VERSION = None
+
+
+def code_version():
+    """このパッケージのソース (*.py) のハッシュ値を返す
+
+    変換の処理を変更した後に、古いコードの出力を最新のものとして扱わないようにす
+    る。
+    """
+    global _CODE_VERSION
+    if _CODE_VERSION is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        h = hashlib.sha1()
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                with open(os.path.join(directory, name), 'rb') as f:
+                    h.update(name.encode('utf-8') + b'\0' + f.read() + b'\0')
+        _CODE_VERSION = h.hexdigest()
+    return _CODE_VERSION
+
+
+def _qualified_name(obj):
+    return '{0}.{1}'.format(obj.__module__, obj.__qualname__)
+
+
+def _encode_option(value):
+    # 追加の拡張 (Extension のインスタンス) はクラスの完全な名前と設定で、拡張の
+    # 設定に含まれる関数 (toc の slugify など) やクラスは完全な名前で表す。repr
+    # はオブジェクトのアドレスを含み得るので使わない
+    if isinstance(value, Extension):
+        return {'extension': _qualified_name(type(value)), 'config': value.getConfigs()}
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type)):
+        return {'callable': _qualified_name(value)}
+    raise TypeError('config_fingerprint: {0!r} is not JSON serializable'.format(value))
+
+
+def config_fingerprint(options, check_links=None):
+    """出力に影響する設定のハッシュ値を返す
+
+    options は batch.Converter のオプションである。check_links を省略すると、
+    options['hrefs'] が設定されているかどうかで判断する。
+
+    設定の値は JSON で表せるものか、追加の拡張 (markdown.extensions.Extension)
+    でなければならない。それ以外の値が含まれる場合は TypeError を送出する。
+    """
+    if check_links is None:
+        check_links = options.get('hrefs') is not None
+    data = {
+        'version': Manifest.VERSION,
+        'options': dict((key, options.get(key)) for key in FINGERPRINT_OPTIONS),
+        'check_links': bool(check_links),
+        'pygments': PYGMENTS_VERSION,
+        'markdown': markdown.__version__,
+        'code': code_version(),
+    }
+    data = json.dumps(data, sort_keys=True, ensure_ascii=False, default=_encode_option)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def file_digest(path):
+    """ソースファイルの内容のハッシュ値を返す"""
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class Manifest(object):
+    """ページ毎の前回の変換の記録
+
+    各ページについて以下を記録する。
+
+    * digest : ソースファイルのハッシュ値 (file_digest)
+    * expires : 出力が変わる時刻 (ISO 8601)。なければ None
+    * links : {リンク先: 存在したかどうか}。存在確認をしない場合は None
+    * diagnostics : 変換時のリンクの診断情報。変換を省略したページの分も報告できる
+      ようにする
+    """
+
+    VERSION = 1
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self._pages = {}
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """save で保存した記録を読み込む
+
+        ファイルが存在しないか、形式や fingerprint が異なる場合は空の記録を返す。
+        """
+        manifest = cls(fingerprint)
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if not isinstance(data, dict) or data.get('version') != cls.VERSION or data.get('fingerprint') != fingerprint:
+            return manifest
+        manifest._pages = data['pages']
+        return manifest
+
+    def save(self, path):
+        """JSON で保存する。書き込みは一時ファイルを介して原子的に行う"""
+        data = {
+            'version': self.VERSION,
+            'fingerprint': self.fingerprint,
+            'pages': dict(sorted(self._pages.items())),
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=1, sort_keys=True)
+                f.write('\n')
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __contains__(self, page):
+        return page in self._pages
+
+    def __len__(self):
+        return len(self._pages)
+
+    def pages(self):
+        return sorted(self._pages)
+
+    def is_up_to_date(self, page, digest, index=None, now=None):
+        """page の前回の出力がそのまま使えるかどうかを返す
+
+        digest は今回のソースファイルのハッシュ値、index はリンク先の存在確認に
+        用いる LinkIndex (またはパスの集合)、now は現在時刻 (timezone 付きの
+        datetime) である。
+        """
+        entry = self._pages.get(page)
+        if entry is None or entry['digest'] != digest:
+            return False
+
+        if entry['expires'] is not None:
+            if now is None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+            if now > datetime.datetime.fromisoformat(entry['expires']):
+                return False
+
+        if entry['links'] is not None:
+            if index is None:
+                return False
+            for target, exists in entry['links'].items():
+                if (target in index) != exists:
+                    return False
+        return True
+
+    def update(self, page, digest, expires=None, link_targets=None, index=None, diagnostics=()):
+        """page を変換した結果を記録する
+
+        link_targets は変換時に記録したリンク先 (links.LinkGraph.targets) で、
+        index は変換時に用いた LinkIndex である。index が None の場合はリンク先
+        の存在を記録しない。
+        """
+        if index is None:
+            link_bits = None
+        else:
+            link_bits = dict((target, target in index) for target in link_targets or ())
+        self._pages[page] = {
+            'digest': digest,
+            'expires': expires.isoformat() if expires is not None else None,
+            'links': link_bits,
+            'diagnostics': [d.to_dict() for d in diagnostics],
+        }
+
+    def diagnostics(self, page):
+        """page の前回の変換時のリンクの診断情報を返す"""
+        entry = self._pages.get(page)
+        if entry is None:
+            return []
+        return [links.LinkDiagnostic(d['page'], d['href'], d['resolved'], d['kind']) for d in entry['diagnostics']]
+
+    def remove(self, page):
+        self._pages.pop(page, None)
+
+    def prune(self, pages):
+        """pages に含まれないページ (削除されたソース) の記録を取り除く"""
+        pages = set(pages)
+        for page in list(self._pages):
+            if page not in pages:
+                del self._pages[page]
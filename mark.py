@@ -16,7 +16,8 @@
 import re
 
 from markdown.extensions import Extension
-from markdown.preprocessors import Preprocessor
+
+from . import line_syntax
 
 
 MARK_DICT = {
@@ -24,32 +25,30 @@ MARK_DICT = {
     "[mark impl]": "<span role=\"img\" aria-label=\"実装済\" title=\"実装済\">⭕</span>",
     "[mark verified]": "<span role=\"img\" aria-label=\"検証済\" title=\"検証済\">✅</span>",
 }
+MARK_RE = re.compile("|".join(map(re.escape, MARK_DICT.keys())))
 
 class MarkExtension(Extension):
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         markpre = MarkPreprocessor(md)
 
         md.registerExtension(self)
-        md.preprocessors.add('mark', markpre, ">normalize_whitespace")
+        line_syntax.register(md, markpre, 'mark', 30)
+
 
+class MarkPreprocessor(line_syntax.LineSyntaxProcessor):
 
-class MarkPreprocessor(Preprocessor):
+    keyword = 'mark'
 
     def __init__(self, md):
-        Preprocessor.__init__(self, md)
+        line_syntax.LineSyntaxProcessor.__init__(self, md)
         self._markdown = md
 
-    def run(self, lines):
-        new_lines = []
+    def reset(self):
         self._markdown._meta_result = {}
-        pattern = re.compile("|".join(map(re.escape, MARK_DICT.keys())))
-
-        for line in lines:
-            new_line = pattern.sub(lambda match: MARK_DICT[match.group(0)], line)
-            new_lines.append(new_line)
 
-        return new_lines
+    def run_line(self, line):
+        return MARK_RE.sub(lambda match: MARK_DICT[match.group(0)], line)
 
 
 def makeExtension(**kwargs):
@@ -13,66 +13,63 @@ MathJaxを有効にした場合、$$...$$ （ブロック）か $...$ （イン
 import re
 
 from markdown.extensions import Extension
-from markdown.preprocessors import Preprocessor
 from markdown.util import code_escape
 
+from . import line_syntax
+
 
 MATHJAX_CONFIG_RE = re.compile(r'^\s*\*\s*(?P<target>.*?)\[mathjax\s+(?P<name>.*?)\]\s*$')
 MATHJAX_BLOCK_RE = re.compile(r'\$\$.*?\$\$', re.MULTILINE | re.DOTALL)
-MATHJAX_INLINE_RE = re.compile(r'\$[^\\\$]*(?:\\\$[^\\\$]*)*\$')
+# インライン数式は行を跨がない。文書全体に一度に適用できる様に改行を除外する。
+MATHJAX_INLINE_RE = re.compile(r'\$[^\\\$\n]*(?:\\\$[^\\\$\n]*)*\$')
 
 
 class MathJaxExtension(Extension):
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         mathjaxpre = MathJaxPreprocessor(md)
 
         md.registerExtension(self)
-        md.preprocessors.add('mathjax', mathjaxpre, ">normalize_whitespace")
+        self._markdown = md
+        line_syntax.register(md, mathjaxpre, 'mathjax', 20)
+
+    def reset(self):
+        self._markdown._mathjax_enabled = False
+
 
+class MathJaxPreprocessor(line_syntax.LineSyntaxProcessor):
 
-class MathJaxPreprocessor(Preprocessor):
+    keyword = 'mathjax'
 
     def __init__(self, md):
-        Preprocessor.__init__(self, md)
+        line_syntax.LineSyntaxProcessor.__init__(self, md)
         self._markdown = md
 
-    def run(self, lines):
-        lines2 = []
+    def reset(self):
         self._markdown._mathjax_enabled = False
-        for line in lines:
-            m = MATHJAX_CONFIG_RE.match(line)
-            if m:
-                name = m.group('name')
-                if name == 'enable':
-                    self._markdown._mathjax_enabled = True
-            else:
-                lines2.append(line)
+
+    def run_line(self, line):
+        m = MATHJAX_CONFIG_RE.match(line)
+        if not m:
+            return line
+        name = m.group('name')
+        if name == 'enable':
+            self._markdown._mathjax_enabled = True
+        return None
+
+    def finish(self, lines):
         if not self._markdown._mathjax_enabled:
-            return lines2
-
-        text = "\n".join(lines2)
-        while True:
-            m = MATHJAX_BLOCK_RE.search(text)
-            if not m:
-                break
-            tex = m.group(0)
-            placeholder = self.markdown.htmlStash.store(code_escape(tex))
-            text = text[:m.start()] + placeholder + text[m.end():]
-
-        lines3 = []
-
-        for line in text.split('\n'):
-            while True:
-                m = MATHJAX_INLINE_RE.search(line)
-                if not m:
-                    break
-                tex = m.group(0)
-                placeholder = self.markdown.htmlStash.store(code_escape(tex))
-                line = line[:m.start()] + placeholder + line[m.end():]
-            lines3.append(line)
-
-        return lines3
+            return lines
+
+        def stash(m):
+            return self.md.htmlStash.store(code_escape(m.group(0)))
+
+        # プレースホルダは $ を含まないので、左から順に一度だけ走査して置換す
+        # る。ブロック数式を全て退避してからインライン数式を退避する。
+        text = "\n".join(lines)
+        text = MATHJAX_BLOCK_RE.sub(stash, text)
+        text = MATHJAX_INLINE_RE.sub(stash, text)
+        return text.split('\n')
 
 
 def makeExtension(**kwargs):
@@ -27,7 +27,8 @@ import re
 
 from markdown.extensions import Extension
 from markdown import postprocessors
-from markdown.preprocessors import Preprocessor
+
+from . import line_syntax
 
 
 META_RE = re.compile(r'^\s*\*\s*(?P<target>.*?)\[meta\s+(?P<name>.*?)\]\s*$')
@@ -35,35 +36,41 @@ META_RE = re.compile(r'^\s*\*\s*(?P<target>.*?)\[meta\s+(?P<name>.*?)\]\s*$')
 
 class MetaExtension(Extension):
 
-    def extendMarkdown(self, md, md_globals):
+    def extendMarkdown(self, md):
         metapre = MetaPreprocessor(md)
         metapost = MetaPostprocessor(md)
 
         md.registerExtension(self)
-        md.preprocessors.add('meta', metapre, ">normalize_whitespace")
-        md.postprocessors.add('meta', metapost, '_end')
+        self._markdown = md
+        line_syntax.register(md, metapre, 'meta', 10)
+        # raw_html (30) の後、html_tree (0) の前
+        md.postprocessors.register(metapost, 'meta', 5)
+
+    def reset(self):
+        self._markdown._meta_result = {}
+
 
+class MetaPreprocessor(line_syntax.LineSyntaxProcessor):
 
-class MetaPreprocessor(Preprocessor):
+    keyword = 'meta'
 
     def __init__(self, md):
-        Preprocessor.__init__(self, md)
+        line_syntax.LineSyntaxProcessor.__init__(self, md)
         self._markdown = md
 
-    def run(self, lines):
-        new_lines = []
+    def reset(self):
         self._markdown._meta_result = {}
-        for line in lines:
-            m = META_RE.match(line)
-            if m:
-                target = m.group('target')
-                name = m.group('name')
-                if name not in self._markdown._meta_result:
-                    self._markdown._meta_result[name] = []
-                self._markdown._meta_result[name].append(target)
-            else:
-                new_lines.append(line)
-        return new_lines
+
+    def run_line(self, line):
+        m = META_RE.match(line)
+        if not m:
+            return line
+        target = m.group('target')
+        name = m.group('name')
+        if name not in self._markdown._meta_result:
+            self._markdown._meta_result[name] = []
+        self._markdown._meta_result[name].append(target)
+        return None
 
 
 class MetaPostprocessor(postprocessors.Postprocessor):
@@ -170,30 +177,56 @@ class MetaPostprocessor(postprocessors.Postprocessor):
         },
     }
 
+    # CPP_DIC の各項目を見出しに挿入する HTML 断片
+    CPP_HTML = dict(
+        (name, '<span class="cpp {class_name}" title="{title}">{text}</span>'.format(**value))
+        for name, value in CPP_DIC.items())
+
+    def _decorate_heading(self, meta):
+        """見出しの開始タグと終了タグを置き換える HTML を構築する"""
+        head = ['<h1>']
+        if 'namespace' in meta:
+            head.append('<span class="namespace" title="namespace {ns}">{ns}::</span>'.format(ns=meta['namespace'][0]))
+        if 'class' in meta:
+            head.append('<span class="class" title="class {cls}">{cls}::</span>'.format(cls=meta['class'][0]))
+        head.append('<span class="token">')
+
+        tail = ['</span>']
+        if 'cpp' in meta:
+            for name in meta['cpp']:
+                tail.append(self.CPP_HTML[name])
+        tail.append('</h1>')
+        return ''.join(head), ''.join(tail)
+
     def run(self, text):
         if not hasattr(self._markdown, '_meta_result'):
             return text
 
         meta = self._markdown._meta_result
 
-        text = text.replace('<h1>', '<h1><span class="token">').replace('</h1>', '</span></h1>')
-
-        if 'cpp' in meta:
-            for name in meta['cpp']:
-                text = text.replace('</h1>', '<span class="cpp {class_name}" title="{title}">{text}</span></h1>'.format(**self.CPP_DIC[name]))
-        if 'class' in meta:
-            text = text.replace('<h1>', '<h1><span class="class" title="class {cls}">{cls}::</span>'.format(cls=meta['class'][0]))
-        if 'namespace' in meta:
-            text = text.replace('<h1>', '<h1><span class="namespace" title="namespace {ns}">{ns}::</span>'.format(ns=meta['namespace'][0]))
-        if 'header' in meta:
-            text = '<div class="header">&lt;{}&gt;</div>'.format(meta['header'][0]) + text
+        # 最初の <h1>...</h1> だけを一度に組み立て直す
+        parts = []
         if 'id-type' in meta:
             id_type = meta['id-type'][0]
             if id_type == 'cpo':
-                text = '<div class="identifier-type">{}</div>'.format('customization point object') + text
+                parts.append('<div class="identifier-type">{}</div>'.format('customization point object'))
             else:
-                text = '<div class="identifier-type">{}</div>'.format(id_type) + text
-        return text
+                parts.append('<div class="identifier-type">{}</div>'.format(id_type))
+        if 'header' in meta:
+            parts.append('<div class="header">&lt;{}&gt;</div>'.format(meta['header'][0]))
+
+        begin = text.find('<h1>')
+        if begin < 0:
+            parts.append(text)
+            return ''.join(parts)
+
+        head, tail = self._decorate_heading(meta)
+        end = text.find('</h1>', begin)
+        if end < 0:
+            parts += [text[:begin], head, text[begin + 4:]]
+        else:
+            parts += [text[:begin], head, text[begin + 4:end], tail, text[end + 5:]]
+        return ''.join(parts)
 
 
 def makeExtension(**kwargs):
@@ -29,11 +29,25 @@ github でのコードブロック記法が使える。
     >>> print markdown.markdown(text, extensions=['qualified_fenced_code'])
 """
 
+import bisect
+import functools
 import hashlib
+import json
+import os
+import sqlite3
+import string
+import threading
+import time
 
 import regex as re
 
-from markdown.extensions.codehilite import CodeHilite
+import markdown
+import pygments
+
+from pygments.formatters import get_formatter_by_name
+from pygments.lexers import get_lexer_by_name
+from pygments.lexers import guess_lexer
+
 from markdown.extensions.codehilite import CodeHiliteExtension
 from markdown.extensions import Extension
 from markdown.preprocessors import Preprocessor
@@ -41,29 +55,55 @@ from markdown.preprocessors import Preprocessor
 CODE_WRAP = '<pre><code%s>%s</code></pre>'
 LANG_TAG = ' class="%s"'
 
-QUALIFIED_FENCED_BLOCK_RE = re.compile(r'(?P<fence>`{3,})[ ]*(?P<lang>[a-zA-Z0-9_+-]*)(?P<lang_meta>.*?)\n(?P<code>.*?)(?<=\n)(?P<indent>[ \t]*)(?P=fence)[ ]*\n(?:(?=\n)|(?P<qualifies>.*?\n(?=\s*\n)))', re.MULTILINE | re.DOTALL)
+FENCE_LANG_RE = re.compile(r'[ ]*(?P<lang>[a-zA-Z0-9_+-]*)')
+CLOSING_FENCE_RE = re.compile(r'(?P<indent>[ \t]*)(?P<fence>`{3,})[ ]*')
+BLANK_LINE_RE = re.compile(r'\s*')
 QUALIFY_COMMAND_RE = re.compile(r'\[(.*?)\]')
+MARKER_PREFIX = 'qfcmark'
+MARKER_WIDTH = 6
+MARKER_RE = re.compile(MARKER_PREFIX + '([a-z]{%d})' % MARKER_WIDTH)
 INDENT_RE = re.compile(r'^[ \t]+', re.MULTILINE)
 
 
 class QualifiedFencedCodeExtension(Extension):
 
-    def __init__(self, global_qualify_list):
+    def __init__(self, global_qualify_list, highlight_cache=None):
         self.global_qualify_list = global_qualify_list
+        # ハイライト結果の永続キャッシュ (HighlightCache またはそのファイルのパス)
+        if isinstance(highlight_cache, str):
+            highlight_cache = get_highlight_cache(os.path.abspath(highlight_cache))
+        self.highlight_cache = highlight_cache
 
-    def extendMarkdown(self, md, md_globals):
-        fenced_block = QualifiedFencedBlockPreprocessor(md, self.global_qualify_list)
+    def extendMarkdown(self, md):
+        fenced_block = QualifiedFencedBlockPreprocessor(md, self.global_qualify_list, self.highlight_cache)
         md.registerExtension(self)
+        self._markdown = md
+
+        # normalize_whitespace (30) の後、行単位の構文 (27) の前
+        md.preprocessors.register(fenced_block, 'qualified_fenced_code', 28)
+
+    def reset(self):
+        self._markdown._example_codes = []
+
+
+def _make_marker(prefix, index):
+    """index 番目の修飾を表すマーク (prefix + 固定長の小文字の列) を作る
 
-        md.preprocessors.add('qualified_fenced_code', fenced_block, ">normalize_whitespace")
+    マークはハイライトの前のコードに埋め込まれるので、英字だけから成る一つの識
+    別子として字句解析されるようにする。
+    """
+    digits = []
+    for i in range(MARKER_WIDTH):
+        index, d = divmod(index, 26)
+        digits.append(string.ascii_lowercase[d])
+    return prefix + ''.join(reversed(digits))
 
 
-def _make_random_string():
-    """アルファベットから成るランダムな文字列を作る"""
-    from random import randrange
-    import string
-    alphabets = string.ascii_letters
-    return ''.join(alphabets[randrange(len(alphabets))] for i in range(32))
+def _parse_marker(digits):
+    index = 0
+    for c in digits:
+        index = index * 26 + (ord(c) - ord('a'))
+    return index
 
 
 def _escape(txt):
@@ -95,21 +135,28 @@ class QualifyDictionary(object):
         }
 
 
+@functools.lru_cache(maxsize=None)
+def _compileQualifyRe(commands):
+    command_res = [r'(\[{cmd}(\]|.*?\]))'.format(cmd=cmd) for cmd in commands]
+
+    qualify_re_str = r'^[ \t]*\*[ \t]+(?P<target>.*?)(?P<commands>({commands})+)$'.format(
+        commands='|'.join(command_res))
+    return re.compile(qualify_re_str)
+
+
 class Qualifier(object):
 
     """修飾１個分のデータを保持するクラス"""
 
     def __init__(self, line, qdic):
-        command_res = [r'(\[{cmd}(\]|.*?\]))'.format(cmd=cmd) for cmd in qdic.qualify_dic]
-
-        qualify_re_str = r'^[ \t]*\*[ \t]+(?P<target>.*?)(?P<commands>({commands})+)$'.format(
-            commands='|'.join(command_res))
-        qualify_re = re.compile(qualify_re_str)
+        # 修飾の行を解析する正規表現はコマンドの一覧毎に一度だけコンパイルする
+        qualify_re = _compileQualifyRe(tuple(qdic.qualify_dic))
 
         # parsing
         m = qualify_re.search(line)
         if not m:
             raise ValueError('Failed parse')
+        self.line = line
         self.target = m.group('target')
         self.commands = []
 
@@ -143,93 +190,178 @@ class Qualifier(object):
         return self._get_target_re().search(code) is not None
 
 
+def _parseQualifiers(lines, qdic, excluded=()):
+    """Qualifier を作るが、重複した行・excluded に含まれる行・エラーになった行は取り除く"""
+    seen = set(excluded)
+    results = []
+    for x in lines:
+        if x not in seen:
+            seen.add(x)
+            try:
+                results.append(Qualifier(x, qdic))
+            except Exception:
+                pass
+    return results
+
+
+class GlobalQualifierList(object):
+
+    """全てのコードブロックに適用される修飾 (global_qualify_list)
+
+    修飾の解析と対象の正規表現のコンパイルは構築時に一度だけ行い、全ての対象を
+    一つの正規表現 (target_re) にまとめておく。
+    """
+
+    def __init__(self, text):
+        self._qdic = QualifyDictionary()
+        self.qualifiers = _parseQualifiers([f for f in text.split('\n') if f], self._qdic)
+
+        # 同じ位置で複数の対象が一致する時は先に書かれた修飾を優先する
+        self.target_re = None
+        if self.qualifiers:
+            self.target_re = re.compile('|'.join(q.get_target_re_text() for q in self.qualifiers))
+        self.has_empty_target = any(q.target == '' for q in self.qualifiers)
+
+        # 対象の文字列から (先に書かれた) 修飾を引く辞書
+        self.qualifier_by_target = {}
+        for q in self.qualifiers:
+            self.qualifier_by_target.setdefault(q.target, q)
+
+
+@functools.lru_cache(maxsize=16)
+def get_global_qualifiers(text):
+    """global_qualify_list の文字列に対応する GlobalQualifierList をプロセス内で共有する"""
+    return GlobalQualifierList(text)
+
+
 class QualifierList(object):
 
-    def __init__(self, lines):
+    def __init__(self, lines, global_qualifiers=None):
         self._qdic = QualifyDictionary()
 
         # Qualifier を作るが、エラーになったデータは取り除く
-        def unique(xs):
-            seen = set()
-            results = []
-            for x in xs:
-                if x not in seen:
-                    seen.add(x)
-                    try:
-                        results.append(Qualifier(x, self._qdic))
-                    except Exception:
-                        pass
-            return results
-
-        self._qs = unique(lines)
+        self._local_qs = _parseQualifiers(lines, self._qdic)
+        self._global = global_qualifiers
+
+        # 修飾の一覧 (ブロックの修飾 → 共通の修飾の順)
+        self._qs = list(self._local_qs)
+        self._marked = []
+        if global_qualifiers is not None:
+            local_lines = set(lines)
+            self._qs += [q for q in global_qualifiers.qualifiers if q.line not in local_lines]
+
+    def _find_targets(self, code):
+        """置換対象になる単語の一致を先頭から順に列挙する
+
+        ブロックの修飾の正規表現とコンパイル済みの共通の修飾の正規表現で別々に検
+        索し、先に現れる方 (同じ位置ならブロックの修飾) を採用する。これは全ての
+        修飾の対象を一つの正規表現にまとめて検索した場合と同じ結果になる。
+        """
+        local_texts = [q.get_target_re_text() for q in self._local_qs if q.find_match(code)]
+        local_re = re.compile('|'.join(local_texts)) if local_texts else None
+
+        g = self._global
+        if g is None or g.target_re is None:
+            if local_re is None:
+                return []
+            return list(local_re.finditer(code))
+
+        if g.has_empty_target or any(q.target == '' for q in self._local_qs):
+            # 空文字列に一致する対象がある場合は交互に検索できないので、全ての対
+            # 象を一つの正規表現にまとめて検索する
+            texts = [q.get_target_re_text() for q in self._qs if q.find_match(code)]
+            if not texts:
+                return []
+            return list(re.finditer('|'.join(texts), code))
+
+        results = []
+        pos = 0
+        lm = local_re.search(code) if local_re is not None else None
+        gm = g.target_re.search(code)
+        while lm is not None or gm is not None:
+            if gm is None or (lm is not None and lm.start() <= gm.start()):
+                m = lm
+            else:
+                m = gm
+            results.append(m)
+            pos = m.end()
+            if lm is not None and lm.start() < pos:
+                lm = local_re.search(code, pos)
+            if gm is not None and gm.start() < pos:
+                gm = g.target_re.search(code, pos)
+        return results
+
+    def _lookup(self, text):
+        q = next((q for q in self._local_qs if q.target == text), None)
+        if q is None:
+            q = self._global.qualifier_by_target[text]
+        return q
 
     def mark(self, code):
         """置換対象になる単語にマーキングを施す
 
         対象文字列が 'sort' だとすれば、文字列中にある全ての 'sort' を
-        '{ランダムな文字列}'
-        という文字列に置換する。
+        'qfcmark' + {修飾の番号を表す6文字の小文字}
+        という文字列に置換する。'qfcmark' がコード中に既に含まれている場合は、含
+        まれなくなるまで接頭辞を伸ばす。
         """
+        self._marked = []
         if len(self._qs) == 0:
-            self._code_re = re.compile("")
             return code
 
-        pre_target_re_text_list = [q.get_target_re_text() for q in self._qs if q.find_match(code)]
-        if len(pre_target_re_text_list) == 0:
-            self._code_re = re.compile("")
+        matches = self._find_targets(code)
+        if len(matches) == 0:
             return code
 
-        target_re_text = '|'.join(pre_target_re_text_list)
-
-        # 対象となる単語を置換し、その置換された文字列を後で辿るための正規表現（text_re_list）と、
-        # 置換された文字列に対してどのような修飾を行えばいいかという辞書（match_qualifier）を作る。
-        text_re_list = []
-        match_qualifier = {}
-
-        def mark_command(match):
-            # 各置換毎に一意な文字列を用意する
-            match_name = _make_random_string()
+        prefix = MARKER_PREFIX
+        while prefix in code:
+            prefix += 'x'
+        if prefix == MARKER_PREFIX:
+            self._code_re = MARKER_RE
+        else:
+            self._code_re = re.compile(prefix + '([a-z]{%d})' % MARKER_WIDTH)
+
+        # 対象となる単語を修飾の番号を埋め込んだマークに置換し、番号から修飾を引
+        # く一覧 (self._marked) を作る。
+        markers = {}
+        output = []
+        pos = 0
+        for match in matches:
             # 対象となる単語がどの修飾のデータなのかを調べる
-            text = match.group(0)
-            q = next(q for q in self._qs if q.target == text)
-            match_qualifier[match_name] = q
-
-            # text をこの文字列に置換する
-            text = '{match_name}'.format(
-                match_name=match_name,
-            )
-            # 置換された text だけを確実に検索するための正規表現
-            text_re = '(?P<{match_name}>{match_name})'.format(
-                match_name=match_name
-            )
-            text_re_list.append(text_re)
-            return text
-        # 対象になる単語を一括置換
-        code = re.sub(target_re_text, mark_command, code)
-        # マークされた文字列を見つけるための正規表現を作る
-        self._code_re = re.compile('|'.join(r for r in text_re_list))
-        self._match_qualifier = match_qualifier
-        return code
+            q = self._lookup(match.group(0))
+            marker = markers.get(q)
+            if marker is None:
+                marker = _make_marker(prefix, len(self._marked))
+                markers[q] = marker
+                self._marked.append(q)
+
+            output.append(code[pos:match.start()])
+            output.append(marker)
+            pos = match.end()
+        output.append(code[pos:])
+        return ''.join(output)
+
+    def _qualify_text(self, q):
+        text = _escape(q.target)
+        for command in q.commands:
+            xs = command.split(' ')
+            c = xs[0]
+            remain = xs[1:]
+            # 修飾
+            text = self._qdic.qualify_dic[c](text, *remain)
+        return text
 
     def qualify(self, html):
-        # 修飾の指定がなかった
-        if len(self._qs) == 0:
-            return html
+        # 修飾の指定がなかった、または
         # 修飾の指定はあったが、検索してみると修飾する文字列が見つからなかった
-        if len(self._code_re.pattern) == 0:
+        if len(self._marked) == 0:
             return html
 
         # マークされた文字列を探しだして、そのマークに対応した修飾を行う
+        texts = [self._qualify_text(q) for q in self._marked]
+
         def convert(match):
-            q = next(q for m, q in self._match_qualifier.items() if match.group(m))
-            text = _escape(q.target)
-            for command in q.commands:
-                xs = command.split(' ')
-                c = xs[0]
-                remain = xs[1:]
-                # 修飾
-                text = self._qdic.qualify_dic[c](text, *remain)
-            return text
+            return texts[_parse_marker(match.group(1))]
         return self._code_re.sub(convert, html)
 
 
@@ -240,20 +372,350 @@ def _removeIndent(code, indent):
     return INDENT_RE.sub(lambda m: m.group().expandtabs(4)[n:], code)
 
 
+class _FencedBlock(object):
+
+    def __init__(self, start, end, lang, lang_meta, code, indent, qualifies):
+        self.start = start
+        self.end = end
+        self.lang = lang
+        self.lang_meta = lang_meta
+        self.code = code
+        self.indent = indent
+        self.qualifies = qualifies
+
+
+def _iterFencedBlocks(text):
+    """text 中のコードブロックとその直後の修飾の一覧を先頭から順に列挙する
+
+    以下の正規表現の一致を、行の一覧を一度だけ走査して線形時間で求める。
+
+      (?P<fence>`{3,})[ ]*(?P<lang>[a-zA-Z0-9_+-]*)(?P<lang_meta>.*?)\\n
+      (?P<code>.*?)(?<=\\n)(?P<indent>[ \\t]*)(?P=fence)[ ]*\\n
+      (?:(?=\\n)|(?P<qualifies>.*?\\n(?=\\s*\\n)))   (MULTILINE | DOTALL)
+
+    * 開始のフェンスは行頭になくても良い。同じ数のバッククォートだけから成る行
+      (前後の空白は可) で閉じる。閉じる行が見つからなければ、バッククォートの数
+      を減らして再度試す。
+
+    * 閉じるフェンスの次の行が空行なら修飾はない。そうでなければ、次に空白だけ
+      の行が現れるまでの行が修飾になる。空白だけの行が現れない場合は一致しない。
+
+    * 一致したブロックより前は読み直さない。開始のフェンスの前に空白以外の文字
+      がある行 ("``` ````" など) でも、その文字を前のフェンスと組にしない。
+    """
+    lines = text.split('\n')
+    line_starts = []
+    offset = 0
+    for line in lines:
+        line_starts.append(offset)
+        offset += len(line) + 1
+
+    # 閉じるフェンスになり得る行 (バッククォートの数 → 行番号の一覧)。最終行は
+    # 改行で終端していないので対象外。
+    closings = {}
+    # next_blank[i]: i 行目以降で最初の、空白だけから成り改行で終端している行
+    next_blank = [None] * (len(lines) + 1)
+    for i in range(len(lines) - 2, -1, -1):
+        line = lines[i]
+        if BLANK_LINE_RE.fullmatch(line):
+            next_blank[i] = i
+        else:
+            next_blank[i] = next_blank[i + 1]
+    for i in range(len(lines) - 1):
+        m = CLOSING_FENCE_RE.fullmatch(lines[i])
+        if m:
+            closings.setdefault(len(m.group('fence')), []).append(i)
+
+    def close(opening, fence):
+        candidates = closings.get(fence)
+        if not candidates:
+            return None
+        k = bisect.bisect_right(candidates, opening)
+        if k == len(candidates):
+            return None
+        closing = candidates[k]
+        # 最初の候補で修飾の終端が見つからなければ、それ以降の候補でも見つから
+        # ない。
+        following = closing + 1
+        if lines[following] == '' and following < len(lines) - 1:
+            return closing, None
+        if following + 1 < len(next_blank) and next_blank[following + 1] is not None:
+            return closing, next_blank[following + 1]
+        return None
+
+    pos = 0
+    line_index = 0
+    while True:
+        start = text.find('```', pos)
+        if start < 0:
+            break
+        n = 3
+        while start + n < len(text) and text[start + n] == '`':
+            n += 1
+        while line_index + 1 < len(lines) and line_starts[line_index + 1] <= start:
+            line_index += 1
+        if line_index + 1 >= len(lines):
+            break
+
+        for fence in range(n, 2, -1):
+            result = close(line_index, fence)
+            if result is not None:
+                break
+        else:
+            pos = start + n
+            continue
+
+        closing, blank = result
+        opening_end = line_starts[line_index + 1] - 1
+        if fence == n:
+            m = FENCE_LANG_RE.match(text, start + n, opening_end)
+            lang = m.group('lang')
+            lang_meta = text[m.end():opening_end]
+        else:
+            lang = ''
+            lang_meta = text[start + fence:opening_end]
+        code = text[line_starts[line_index + 1]:line_starts[closing]]
+        indent = CLOSING_FENCE_RE.fullmatch(lines[closing]).group('indent')
+        if blank is None:
+            end = line_starts[closing + 1]
+            qualifies = None
+        else:
+            end = line_starts[blank]
+            qualifies = text[line_starts[closing + 1]:end]
+
+        yield _FencedBlock(start, end, lang, lang_meta, code, indent, qualifies)
+        pos = end
+
+
+class HighlightEngine(object):
+
+    """CodeHilite と同じ設定で Pygments を直接呼び出してハイライトする
+
+    言語毎に一つの lexer、設定毎に一つの formatter を作って使い回す。出力は
+    CodeHilite(code, lang=lang, ...).hilite() と同じ。
+    """
+
+    def __init__(self, linenums, guess_lang, css_class, style, noclasses):
+        self.guess_lang = guess_lang
+        # CodeHilite が lexer と formatter に渡すのと同じ設定
+        self.options = {
+            'style': style,
+            'noclasses': noclasses,
+            'linenos': linenums,
+            'cssclass': css_class,
+            'wrapcode': True,
+            'full': False,
+        }
+        self._formatter = get_formatter_by_name('html', **self.options)
+        self._lexers = {}
+
+    def _get_lexer(self, lang, src):
+        lexer = self._lexers.get(lang)
+        if lexer is not None:
+            return lexer
+        try:
+            lexer = get_lexer_by_name(lang, **self.options)
+        except ValueError:
+            if self.guess_lang:
+                # 推測された lexer はコードに依存するので保持しない
+                try:
+                    return guess_lexer(src, **self.options)
+                except ValueError:
+                    return get_lexer_by_name('text', **self.options)
+            lexer = get_lexer_by_name('text', **self.options)
+        self._lexers[lang] = lexer
+        return lexer
+
+    def highlight(self, code, lang):
+        src = code.strip('\n')
+        return pygments.highlight(src, self._get_lexer(lang, src), self._formatter)
+
+
+@functools.lru_cache(maxsize=16)
+def get_highlight_engine(linenums, guess_lang, css_class, style, noclasses):
+    """設定毎に一つの HighlightEngine をプロセス内で共有する"""
+    return HighlightEngine(linenums, guess_lang, css_class, style, noclasses)
+
+
+class HighlightCache(object):
+
+    """Pygments によるハイライト結果の永続キャッシュ
+
+    ハイライトはビルドの中で最も重い処理だが、殆どのコードブロックはビルドの間
+    で変化しない。(マーク済みのコード, 言語, ハイライトの設定, Pygments と
+    Python-Markdown のバージョン) のハッシュをキーとして、ハイライト結果の HTML を
+    一つの SQLite ファイルに保存する。
+
+    * 合計サイズが max_bytes を超えたら、最後に参照された時刻 (atime) の古いもの
+      から削除する (LRU)。合計サイズはファイル内に記録し (トリガーで更新する)、
+      書き込みの度に同じトランザクションで確認するので、同じファイルを使う全ての
+      インスタンス・プロセスを通して max_bytes を超えない。
+
+    * 複数のワーカープロセスから同じファイルを同時に使っても良い (WAL モードで開
+      き、ロック待ちは timeout 秒まで待つ)。接続はプロセス毎に開き直す。
+
+    * hits, misses はこのプロセスでのヒット・ミスの回数。
+    """
+
+    # atime の更新はこの秒数以上古い場合だけ行う (ヒットの度に書き込まないため)
+    ATIME_RESOLUTION = 60
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, timeout=60):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_pid'] = None
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS highlight ('
+                         'key TEXT PRIMARY KEY, html TEXT NOT NULL, size INTEGER NOT NULL, atime REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS highlight_atime ON highlight (atime)')
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # 合計サイズ (一行だけの表)。highlight の変更に合わせてトリガーで更新する
+                conn.execute('CREATE TABLE IF NOT EXISTS highlight_size ('
+                             'id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)')
+                conn.execute('INSERT OR IGNORE INTO highlight_size (id, total) '
+                             'SELECT 0, COALESCE(SUM(size), 0) FROM highlight')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS highlight_insert AFTER INSERT ON highlight BEGIN '
+                             'UPDATE highlight_size SET total = total + NEW.size; END')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS highlight_delete AFTER DELETE ON highlight BEGIN '
+                             'UPDATE highlight_size SET total = total - OLD.size; END')
+                conn.execute('CREATE TRIGGER IF NOT EXISTS highlight_update AFTER UPDATE OF size ON highlight BEGIN '
+                             'UPDATE highlight_size SET total = total - OLD.size + NEW.size; END')
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def make_key(code, lang, options):
+        data = json.dumps([code, lang, sorted(options.items()), pygments.__version__, markdown.__version__])
+        return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute('SELECT html, atime FROM highlight WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if now - row[1] >= self.ATIME_RESOLUTION:
+                conn.execute('UPDATE highlight SET atime = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def put(self, key, html):
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Note: INSERT OR REPLACE の削除では DELETE のトリガーが動かないので UPSERT を使う
+                conn.execute('INSERT INTO highlight (key, html, size, atime) VALUES (?, ?, ?, ?) '
+                             'ON CONFLICT (key) DO UPDATE SET '
+                             'html = excluded.html, size = excluded.size, atime = excluded.atime',
+                             (key, html, len(html.encode('utf-8')), time.time()))
+                self._evict(conn)
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def _evict(self, conn):
+        total = conn.execute('SELECT total FROM highlight_size').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # 新しい順に累積したサイズが max_bytes を超える分を削除する
+        conn.execute('DELETE FROM highlight WHERE key IN ('
+                     'SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY atime DESC, key) AS total FROM highlight) '
+                     'WHERE total > ?)', (self.max_bytes,))
+
+    def evict(self):
+        with self._lock:
+            self._evict(self._connect())
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._connect().execute(
+                'SELECT COUNT(*), (SELECT total FROM highlight_size) FROM highlight').fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries, 'bytes': size}
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+            self._pid = None
+
+
+@functools.lru_cache(maxsize=16)
+def get_highlight_cache(path):
+    """path の HighlightCache を返す。同じパスには同じインスタンスを返す"""
+    return HighlightCache(path)
+
+
 class QualifiedFencedBlockPreprocessor(Preprocessor):
 
-    def __init__(self, md, global_qualify_list):
+    def __init__(self, md, global_qualify_list, highlight_cache=None):
         Preprocessor.__init__(self, md)
 
         md._example_codes = []
         self.checked_for_codehilite = False
         self.codehilite_conf = {}
         self.global_qualify_list = global_qualify_list
+        self.global_qualifiers = get_global_qualifiers(global_qualify_list)
+        self.highlight_cache = highlight_cache
+
+    def _highlight(self, code, lang):
+        options = {
+            'linenums': self.codehilite_conf['linenums'][0],
+            'guess_lang': self.codehilite_conf['guess_lang'][0],
+            'css_class': self.codehilite_conf['css_class'][0],
+            'style': self.codehilite_conf['pygments_style'][0],
+            'noclasses': self.codehilite_conf['noclasses'][0],
+        }
+        cache = self.highlight_cache
+        if cache is not None:
+            key = cache.make_key(code, lang, options)
+            html = cache.get(key)
+            if html is not None:
+                return html
+
+        html = get_highlight_engine(**options).highlight(code, lang)
+        if cache is not None:
+            cache.put(key, html)
+        return html
 
     def run(self, lines):
         # Check for code hilite extension
         if not self.checked_for_codehilite:
-            for ext in self.markdown.registeredExtensions:
+            for ext in self.md.registeredExtensions:
                 if isinstance(ext, CodeHiliteExtension):
                     self.codehilite_conf = ext.config
                     break
@@ -264,56 +726,47 @@ class QualifiedFencedBlockPreprocessor(Preprocessor):
 
         example_counter = 0
 
-        while 1:
-            m = QUALIFIED_FENCED_BLOCK_RE.search(text)
-            if m:
-                # ```cpp example みたいに書かれていたらサンプルコードとして扱う
-                is_example = m.group('lang_meta') and ('example' in m.group('lang_meta').strip().split())
-
-                qualifies = m.group('qualifies') or ''
-                qualifies = qualifies + self.global_qualify_list
-                qualifies = [f for f in qualifies.split('\n') if f]
-                code = _removeIndent(*m.group('code', 'indent'))
-
-                # サンプルコードだったら、self.markdown の中にコードの情報と ID を入れておく
+        output = []
+        pos = 0
+        for m in _iterFencedBlocks(text):
+            # ```cpp example みたいに書かれていたらサンプルコードとして扱う
+            is_example = m.lang_meta and ('example' in m.lang_meta.strip().split())
+
+            qualifies = m.qualifies or ''
+            qualifies = [f for f in qualifies.split('\n') if f]
+            code = _removeIndent(m.code, m.indent)
+
+            # サンプルコードだったら、self.md の中にコードの情報と ID を入れておく
+            if is_example:
+                example_id = hashlib.sha1((str(example_counter) + code).encode('utf-8')).hexdigest()
+                self.md._example_codes.append({"id": example_id, "code": code})
+                example_counter += 1
+
+            qualifier_list = QualifierList(qualifies, self.global_qualifiers)
+            code = qualifier_list.mark(code)
+
+            # If config is not empty, then the codehighlite extension
+            # is enabled, so we call it to highlite the code
+            if self.codehilite_conf and m.lang:
+                code = self._highlight(code, m.lang)
+                # サンプルコードだったら <div id="..." class="yata"> で囲む
                 if is_example:
-                    example_id = hashlib.sha1((str(example_counter) + code).encode('utf-8')).hexdigest()
-                    self.markdown._example_codes.append({"id": example_id, "code": code})
-                    example_counter += 1
-
-                qualifier_list = QualifierList(qualifies)
-                code = qualifier_list.mark(code)
-
-                # If config is not empty, then the codehighlite extension
-                # is enabled, so we call it to highlite the code
-                if self.codehilite_conf and m.group('lang'):
-                    highliter = CodeHilite(
-                        code,
-                        linenums=self.codehilite_conf['linenums'][0],
-                        guess_lang=self.codehilite_conf['guess_lang'][0],
-                        css_class=self.codehilite_conf['css_class'][0],
-                        style=self.codehilite_conf['pygments_style'][0],
-                        lang=(m.group('lang') or None),
-                        noclasses=self.codehilite_conf['noclasses'][0])
-
-                    code = highliter.hilite()
-                    # サンプルコードだったら <div id="..." class="yata"> で囲む
-                    if is_example:
-                        code = '<div id="%s" class="yata">%s</div>' % (example_id, code)
-                else:
-                    lang = ''
-                    if m.group('lang'):
-                        lang = LANG_TAG % m.group('lang')
-
-                    code = CODE_WRAP % (lang, _escape(code))
-
-                code = qualifier_list.qualify(code)
-
-                placeholder = self.markdown.htmlStash.store(code)
-                text = '%s\n%s\n%s' % (text[:m.start()], placeholder, text[m.end():])
+                    code = '<div id="%s" class="yata">%s</div>' % (example_id, code)
             else:
-                break
-        return text.split("\n")
+                lang = ''
+                if m.lang:
+                    lang = LANG_TAG % m.lang
+
+                code = CODE_WRAP % (lang, _escape(code))
+
+            code = qualifier_list.qualify(code)
+
+            placeholder = self.md.htmlStash.store(code)
+            output.append(text[pos:m.start])
+            output.append('\n%s\n' % placeholder)
+            pos = m.end
+        output.append(text[pos:])
+        return ''.join(output).split("\n")
 
 
 def makeExtension(**kwargs):
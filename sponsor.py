@@ -22,38 +22,54 @@
     >>> md = markdown.Markdown(['mark'])
     >>> print md.convert(text)
     <ul><li><a href="LINK_URL">NAME</a></li></ul>
+
+スポンサーの記述は一度だけ解析して SponsorEntry として保持する。変換後の
+md._sponsor_next_expiry は、その文書のスポンサーで変換時より後に掲載期限を迎え
+る最も早い期限 (なければ None) であり、文書の変換結果はこの時刻を過ぎると変わる。
+現在時刻は clock で差し替えられる。
+
+    >>> ext = SponsorExtension(clock=lambda: datetime.datetime(2024, 1, 1, tzinfo=JST))
 """
 
-import re
 import datetime
+import functools
+import re
 
 from markdown.extensions import Extension
-from markdown.preprocessors import Preprocessor
 
+from . import line_syntax
 
-def replace_sponsor_line(line: str, now: datetime.datetime) -> str:
-    m = re.search(r'\[sponsor (.*?)\]', line)
-    if not m:
-        return line
 
+JST = datetime.timezone(datetime.timedelta(hours=+9), 'JST')
+
+SPONSOR_RE = re.compile(r'\[sponsor (.*?)\]')
+
+
+def now_jst() -> datetime.datetime:
+    return datetime.datetime.now(JST)
+
+
+def parse_sponsor(params: str) -> dict:
     dict = {}
-    for x in m[1].split(", "):
+    for x in params.split(", "):
         y = x.split(":")
         dict[y[0]] = ":".join(y[1:])
+    return dict
 
-    # check expired (one-time or canceled)
-    if dict.get("period"):
-        period = datetime.datetime.fromisoformat(dict["period"] + " 23:59:59.000000+09:00")
-        if now > period:
-            return line.replace(m[0], "")
 
+def parse_period(period: str) -> datetime.datetime:
+    # 掲載期限の日の終わり (JST)
+    return datetime.datetime.fromisoformat(period + " 23:59:59.000000+09:00")
+
+
+def render_sponsor(dict) -> str:
     if dict.get("img") is None:
         new_sponsor = ""
         if dict.get("link") is None:
             new_sponsor = "<ul><li>{}</li></ul>".format(dict["name"])
         else:
             new_sponsor = "<ul><li><a href=\"{}\">{}</a></li></ul>".format(dict["link"], dict["name"])
-        return line.replace(m[0], new_sponsor)
+        return new_sponsor
 
     img = ""
     center = ""
@@ -71,36 +87,107 @@ def replace_sponsor_line(line: str, now: datetime.datetime) -> str:
         link = "<a href=\"{}\">".format(dict["link"])
         link_close = "</a>"
 
-    new_sponsor = center + link + img + link_close + center_close
-    return line.replace(m[0], new_sponsor)
+    return center + link + img + link_close + center_close
+
+
+class SponsorEntry(object):
+    """解析済みのスポンサー
+
+    period は掲載期限 (なければ None) で、この時刻を過ぎると表示しない。html()
+    は掲載期限内に表示する HTML を返す。HTML は初めて必要になった時に生成する。
+    """
+
+    __slots__ = ('params', 'period', '_html')
+
+    def __init__(self, params):
+        self.params = params
+        self.period = parse_period(params["period"]) if params.get("period") else None
+        self._html = None
+
+    def html(self):
+        if self._html is None:
+            self._html = render_sponsor(self.params)
+        return self._html
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_entry(params: str) -> SponsorEntry:
+    """[sponsor params] を解析する。同じ記述は一度だけ解析する"""
+    return SponsorEntry(parse_sponsor(params))
+
+
+def _replace_sponsor(line: str, now: datetime.datetime):
+    """line のスポンサーを now の時点の表示に置き換える
+
+    置き換えた行と、表示したスポンサーの掲載期限 (なければ None) を返す。
+    """
+    m = SPONSOR_RE.search(line)
+    if not m:
+        return line, None
+
+    entry = parse_entry(m[1])
+
+    # check expired (one-time or canceled)
+    if entry.period is not None and now > entry.period:
+        return line.replace(m[0], ""), None
+    return line.replace(m[0], entry.html()), entry.period
+
+
+def replace_sponsor_line(line: str, now: datetime.datetime) -> str:
+    return _replace_sponsor(line, now)[0]
+
 
 class SponsorExtension(Extension):
 
-    def extendMarkdown(self, md, md_globals):
-        pre = SponsorPreprocessor(md)
+    def __init__(self, clock=None, **kwargs):
+        self.clock = clock
+        super().__init__(**kwargs)
+
+    def extendMarkdown(self, md):
+        pre = SponsorPreprocessor(md, self.clock)
 
         md.registerExtension(self)
-        md.preprocessors.add('sponsor', pre, ">normalize_whitespace")
+        self._markdown = md
+        self._processor = pre
+        line_syntax.register(md, pre, 'sponsor', 50)
+
+    def set_clock(self, clock):
+        """拡張を作り直さずに、次の変換から用いる現在時刻の関数を設定する
 
+        clock は timezone 付きの datetime を返す関数で、None の場合は実際の時刻を
+        用いる。
+        """
+        self.clock = clock
+        if getattr(self, '_processor', None) is not None:
+            self._processor.clock = clock
 
-class SponsorPreprocessor(Preprocessor):
+    def reset(self):
+        self._markdown._sponsor_next_expiry = None
 
-    def __init__(self, md):
-        Preprocessor.__init__(self, md)
+
+class SponsorPreprocessor(line_syntax.LineSyntaxProcessor):
+
+    keyword = 'sponsor'
+
+    def __init__(self, md, clock=None):
+        line_syntax.LineSyntaxProcessor.__init__(self, md)
         self._markdown = md
+        self.clock = clock
+        self._now = None
 
-    def run(self, lines):
-        new_lines = []
+    def reset(self):
         self._markdown._meta_result = {}
+        self._markdown._sponsor_next_expiry = None
 
-        jst = datetime.timezone(datetime.timedelta(hours=+9), 'JST')
-        now = datetime.datetime.now(jst)
+        self._now = (self.clock or now_jst)()
 
-        for line in lines:
-            new_line = replace_sponsor_line(line, now)
-            new_lines.append(new_line)
-
-        return new_lines
+    def run_line(self, line):
+        line, period = _replace_sponsor(line, self._now)
+        if period is not None:
+            next_expiry = self._markdown._sponsor_next_expiry
+            if next_expiry is None or period < next_expiry:
+                self._markdown._sponsor_next_expiry = period
+        return line
 
 
 def makeExtension(**kwargs):
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+AttributePostprocessor の木の走査の計測
+
+15000 個のリンクと 30 個の表・画像を含む木に対して、相対リンク (存在確認あり・
+なし) と絶対リンクの三通りで AttributePostprocessor.run を実行する。リンクの警告
+は出力せず、そのハッシュ値を表示する。
+
+    $ python tests/bench_attribute.py [--rev REV]
+"""
+
+import contextlib
+import copy
+import hashlib
+import io
+import xml.etree.ElementTree as etree
+
+import support
+
+
+def make_html():
+    parts = ['<h1>t</h1>']
+    for i in range(3000):
+        parts.append(
+            '<p>見出し %d の説明 <a href="/reference/vector/v%d.md">v%d</a> と <a href="../array/a%d.md#x">a</a>, '
+            '<a href="#s%d">s</a>, <a href="https://example.org/%d">e</a> <a href="/reference/none%d.nolink.md">n</a> '
+            '<code>x</code></p>' % (i, i % 50, i, i, i, i, i))
+        if i % 100 == 0:
+            parts.append('<table><tr><td>x</td></tr></table>'
+                         '<p><img src="https://github.com/cpprefjp/image/raw/master/x%d.png" /></p>' % i)
+    return '<div>' + ''.join(parts) + '</div>'
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html.html_attribute import AttributePostprocessor
+
+    root0 = etree.fromstring(make_html())
+    hrefs = set('/reference/vector/v%d.html' % i for i in range(25))
+    cases = [
+        ('relative links + existence check', True, hrefs),
+        ('relative links', True, None),
+        ('absolute links', False, None),
+    ]
+    for name, relative, index in cases:
+        md = markdown.Markdown()
+        md._html_attribute_hrefs = index
+        proc = AttributePostprocessor(md, {
+            'base_url': 'https://cpprefjp.github.io',
+            'base_path': 'reference/vector',
+            'full_path': 'reference/vector/push_back.md',
+            'extension': '.html',
+            'use_relative_link': relative,
+            'image_repo': 'cpprefjp/image',
+            'use_static_image': True,
+        })
+        # 木の複製は計測に含めない
+        roots = [copy.deepcopy(root0) for _ in range(args.repeat)]
+        pending = iter(roots)
+        messages = io.StringIO()
+        with contextlib.redirect_stdout(messages), contextlib.redirect_stderr(messages):
+            seconds = support.timeit(lambda: proc.run(next(pending)), args.repeat)
+        html = etree.tostring(roots[0], encoding='unicode')
+        digest = hashlib.md5(html.encode('utf-8')).hexdigest()[:8] + ' ' + hashlib.md5(messages.getvalue().encode('utf-8')).hexdigest()[:8]
+        support.report(name, seconds, digest)
+
+    root = etree.Element('div')
+    etree.SubElement(root, 'h1').text = 't'
+    for i in range(10000):
+        etree.SubElement(root, 'p').text = str(i)
+    roots = [copy.deepcopy(root) for _ in range(args.repeat)]
+    pending = iter(roots)
+    seconds = support.timeit(lambda: proc._add_meta(next(pending)), args.repeat)
+    support.report('_add_meta, 10000 children', seconds)
+
+
+if __name__ == '__main__':
+    main()
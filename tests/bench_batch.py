@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+一括変換 (batch) の計測
+
+小さなページを 300 個、ページ毎に Converter を作り直す場合と、一つの Converter
+を使い回す場合、convert_all でワーカーに分ける場合で変換する。変換結果が全て同じ
+であることも確かめる。-p はページ数、-n は計測の回数である。
+
+    $ python tests/bench_batch.py [-p PAGES] [-j PROCESSES] [-n REPEAT]
+"""
+
+import argparse
+import hashlib
+import os
+import tempfile
+
+import support
+
+PAGE = '''# page{0}
+* page{0}[meta class]
+* std[meta namespace]
+* cpp11[meta cpp]
+
+## 概要
+{0} 番目のページ。不定値を返す。GCC: 13.1 [mark impl]
+
+## 例
+```cpp example
+#include <vector>
+
+int main() {{
+  std::vector<int> v;
+  v.push_back({0});
+}}
+```
+* v.push_back[color ff0000]
+
+### 出力
+```
+{0}
+```
+
+## 関連項目
+- [前のページ](page{1}.md)
+- [次のページ](page{2}.md)
+'''
+
+OPTIONS = {
+    'defined_words': {'不定値': {'link': '/reference/indeterminate.md'}},
+    'global_qualify_list': '* std::vector[link /reference/vector.md]\n',
+}
+
+
+def digest(results):
+    h = hashlib.md5()
+    for result in results:
+        assert result.error is None, result.error
+        h.update(repr((result.full_path, result.html, result.meta, result.example_codes)).encode('utf-8'))
+    return h.hexdigest()[:8]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-p', '--pages', type=int, default=300, help='number of pages')
+    parser.add_argument('-j', '--processes', type=int, default=2, help='number of worker processes for convert_all')
+    parser.add_argument('-n', '--repeat', type=int, default=1, help='number of timed runs')
+    args = parser.parse_args()
+    support.import_package()
+    from markdown_to_html import batch
+
+    with tempfile.TemporaryDirectory() as source_dir:
+        os.mkdir(os.path.join(source_dir, 'reference'))
+        for i in range(args.pages):
+            with open(os.path.join(source_dir, 'reference', 'page%d.md' % i), 'w', encoding='utf-8') as f:
+                f.write(PAGE.format(i, i - 1, i + 1))
+        jobs = list(batch.find_jobs(source_dir))
+
+        def fresh():
+            return [batch.Converter(OPTIONS).convert_job(job) for job in jobs]
+
+        def reused():
+            converter = batch.Converter(OPTIONS)
+            return [converter.convert_job(job) for job in jobs]
+
+        def pooled():
+            return list(batch.convert_all(jobs, OPTIONS, args.processes))
+
+        for name, func in [('Converter per page', fresh), ('one Converter', reused),
+                           ('convert_all -j {0}'.format(args.processes), pooled)]:
+            results = []
+            seconds = support.timeit(lambda: results.append(func()), args.repeat)
+            support.report('{0} pages, {1}'.format(len(jobs), name), seconds, digest(results[-1]))
+        print('CPUs: {0}'.format(os.cpu_count()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+defined_words の定義語の照合の計測
+
+辞書の構築 (DefinedWordTreeprocessor の生成) と、約 12 万文字のテキストからの定
+義語の検索 (_convertText) の時間を計る。
+
+    $ python tests/bench_defined_words.py [--rev REV]
+"""
+
+import hashlib
+import random
+
+import support
+
+
+def make_words(rnd, n):
+    words = set()
+    while len(words) < n:
+        k = rnd.randint(2, 8)
+        if rnd.random() < 0.5:
+            words.add(''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(k)))
+        else:
+            words.add(''.join(chr(0x4e00 + rnd.randint(0, 2000)) for _ in range(k)))
+    return sorted(words)
+
+
+def make_text(rnd, words):
+    def token():
+        if rnd.random() < 0.1:
+            return rnd.choice(words)
+        return ''.join(chr(0x3041 + rnd.randint(0, 80)) for _ in range(5))
+    return ' '.join(token() for _ in range(20000))
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html import defined_words
+
+    rnd = random.Random(1)
+    for n in (500, 20000):
+        words = make_words(rnd, n)
+        text = make_text(rnd, words)
+        config = {
+            'base_url': 'https://cpprefjp.github.io',
+            'base_path': 'reference',
+            'full_path': 'reference/vector.md',
+            'extension': '.html',
+            'dict': dict((word, {'link': '/reference/w%d.md' % i}) for i, word in enumerate(words)),
+            'cache_dir': '',
+        }
+        procs = []
+        try:
+            # 辞書はメモリ上にもキャッシュされるので、構築は一度だけ計る
+            build = support.timeit(lambda: procs.append(defined_words.DefinedWordTreeprocessor(markdown.Markdown(), config)), 1)
+        except Exception as e:
+            print('{0} words: {1}'.format(n, e))
+            continue
+        support.report('{0} words: build'.format(n), build)
+
+        results = []
+        search = support.timeit(lambda: results.append(procs[0]._convertText(text)), args.repeat)
+        new_text, anchors = results[-1]
+        digest = hashlib.md5(repr((new_text, [(a.text, a.tail, a.get('href')) for a in anchors])).encode('utf-8')).hexdigest()[:8]
+        support.report('{0} words: search {1} chars'.format(n, len(text)), search, digest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+defined_words の木の書き換えの計測
+
+定義語のリンクを木に挿入する DefinedWordTreeprocessor.run の時間を計る。深く入れ
+子になった文書を処理できるかどうかも確かめる。
+
+    $ python tests/bench_defined_words_tree.py [--rev REV]
+"""
+
+import copy
+import hashlib
+import random
+import xml.etree.ElementTree as etree
+
+import support
+
+WORDS = {
+    '不定値': {'link': '/a.md'},
+    '未定義動作': {'link': '/b.md'},
+    'ill-formed': {'desc': 'x'},
+    '適格': {'link': '/c.md'},
+}
+TOKENS = ['不定値', '未定義動作', ' ill-formed ', '適格', 'テキスト', '<code>不定値</code>', '<em>適格</em>']
+
+
+def make_tree(rnd, paragraphs, tokens):
+    parts = []
+    for _ in range(paragraphs):
+        parts.append('<p>%s</p>' % ''.join(rnd.choice(TOKENS) for _ in range(tokens)))
+    return etree.fromstring('<div>%s</div>' % ''.join(parts))
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html import defined_words
+
+    config = {
+        'base_url': 'https://cpprefjp.github.io',
+        'base_path': '',
+        'full_path': 'a.md',
+        'extension': '.html',
+        'dict': WORDS,
+        'cache_dir': '',
+    }
+    proc = defined_words.DefinedWordTreeprocessor(markdown.Markdown(), config)
+
+    rnd = random.Random(0)
+    for paragraphs, tokens in ((200, 400), (1, 40000)):
+        root0 = make_tree(rnd, paragraphs, tokens)
+        # 木の複製は計測に含めない
+        roots = [copy.deepcopy(root0) for _ in range(args.repeat)]
+        pending = iter(roots)
+        seconds = support.timeit(lambda: proc.run(next(pending)), args.repeat)
+        digest = hashlib.md5(etree.tostring(roots[0], encoding='unicode').encode('utf-8')).hexdigest()[:8]
+        support.report('{0} paragraphs x {1} tokens'.format(paragraphs, tokens), seconds, digest)
+
+    deep = etree.Element('div')
+    elem = deep
+    for _ in range(5000):
+        elem = etree.SubElement(elem, 'span')
+        elem.text = '不定値'
+    try:
+        seconds = support.timeit(lambda: proc.run(deep), 1)
+    except RecursionError as e:
+        print('5000 nested elements: {0}'.format(e))
+    else:
+        support.report('5000 nested elements', seconds)
+
+
+if __name__ == '__main__':
+    main()
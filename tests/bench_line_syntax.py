@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+行単位の構文 (meta, mathjax, mark, commit, sponsor) の前処理の計測
+
+五つの拡張を全て有効にし、それらの構文を含む約 3000 行の文書に対して、この
+パッケージの前処理だけを実行する。
+
+    $ python tests/bench_line_syntax.py [--rev REV]
+"""
+
+import hashlib
+
+import support
+
+HEADER = '''# push_back
+* vector[meta header]
+* function[meta id-type]
+* std[meta namespace]
+* vector[meta class]
+* cpp11[meta cpp]
+* [mathjax enable]
+
+## 概要
+新たな要素を末尾に追加する。
+
+GCC: 12.0 [mark noimpl], 13.1 [mark impl], 14.1 [mark verified]
+
+[commit cpprefjp/site, 1234567, abcdefg]
+
+[sponsor name:NAME, img:IMAGE_URL, link:LINK_URL, size:120, period:2099-12-31, amount:1]
+[sponsor name:OLD, link:LINK_URL, period:2001-01-01]
+
+数式 $x^2 + y$ と $a\\$b$ そして
+
+$$
+\\sum_{i} i
+$$
+'''
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html.commit import CommitExtension
+    from markdown_to_html.mark import MarkExtension
+    from markdown_to_html.mathjax import MathJaxExtension
+    from markdown_to_html.meta import MetaExtension
+    from markdown_to_html.sponsor import SponsorExtension
+
+    body = '\n'.join('通常の行 %d で、`code` や *強調* を含む。' % i for i in range(3000))
+    lines = (HEADER + '\n' + body).split('\n')
+
+    md = markdown.Markdown(extensions=[
+        MetaExtension(), MathJaxExtension(), MarkExtension(), CommitExtension(), SponsorExtension(),
+    ])
+    procs = [p for p in md.preprocessors if type(p).__module__.startswith(support.PACKAGE)]
+    outputs = []
+
+    def run():
+        md.htmlStash.reset()
+        out = lines
+        for p in procs:
+            out = p.run(out)
+        outputs.append(out)
+
+    seconds = support.timeit(run, args.repeat)
+    data = repr((outputs[-1], md.htmlStash.rawHtmlBlocks, md._meta_result, md._mathjax_enabled))
+    digest = hashlib.md5(data.encode('utf-8')).hexdigest()[:8]
+    support.report('preprocess {0} lines'.format(len(lines)), seconds, digest)
+
+
+if __name__ == '__main__':
+    main()
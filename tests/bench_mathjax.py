@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+MathJax の数式の取り出しの計測
+
+インライン数式の多い行と $$ ... $$ のブロックを含む文書に対して
+MathJaxPreprocessor.run を実行する。
+
+    $ python tests/bench_mathjax.py [--rev REV]
+"""
+
+import hashlib
+
+import support
+
+
+def make_lines(n):
+    lines = ['* [mathjax enable]']
+    for i in range(n):
+        lines.append('関数 $f_{%d}(x) = \\sum_{k=0}^{n} a_k x^k$ と $g(x) = \\$%d$ の誤差 $\\epsilon$ を評価する。' % (i, i))
+        if i % 20 == 0:
+            lines += ['$$', '\\int_0^1 f_{%d}(x)\\,dx' % i, '$$']
+    return lines
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html.mathjax import MathJaxPreprocessor
+
+    md = markdown.Markdown()
+    proc = MathJaxPreprocessor(md)
+    for n in (400, 3000):
+        lines = make_lines(n)
+        results = []
+
+        def run():
+            md.htmlStash.reset()
+            results.append((proc.run(lines), md.htmlStash.rawHtmlBlocks))
+
+        seconds = support.timeit(run, args.repeat)
+        out, stash = results[-1]
+        digest = hashlib.md5(repr((out, stash)).encode('utf-8')).hexdigest()[:8]
+        support.report('{0} lines, {1} formulas'.format(len(lines), len(stash)), seconds, digest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+qualified_fenced_code の fence の走査の計測
+
+    $ python tests/bench_qualified_fenced_code.py [--rev REV]
+"""
+
+import hashlib
+
+import support
+
+BLOCK = 'text\n\n```cpp example\nint main() { std::sort(v.begin(), v.end()); }\n```\n* std::sort[link /x.md]\n\n'
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html.qualified_fenced_code import QualifiedFencedCodeExtension
+
+    cases = [
+        ('1000 blocks', BLOCK * 1000),
+        ('5000 blocks', BLOCK * 5000),
+        ('unterminated fence (2000 lines)', '```cpp\n' + 'int x; // ``\n' * 2000 + '\n\n'),
+    ]
+    for name, text in cases:
+        md = markdown.Markdown(extensions=[QualifiedFencedCodeExtension('')])
+        proc = md.preprocessors['qualified_fenced_code']
+        lines = text.split('\n')
+        results = []
+
+        def run():
+            md.htmlStash.reset()
+            md._example_codes = []
+            results.append(proc.run(lines))
+
+        # 閉じられていない fence は以前の実装では十秒以上掛かるので一回だけ計る
+        repeat = 1 if 'unterminated' in name else args.repeat
+        seconds = support.timeit(run, repeat)
+        digest = hashlib.md5(repr((results[-1], md.htmlStash.rawHtmlBlocks)).encode('utf-8')).hexdigest()[:8]
+        support.report(name, seconds, digest)
+
+
+if __name__ == '__main__':
+    main()
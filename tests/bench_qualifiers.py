@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+コードの修飾 (QualifierList.mark / qualify) の計測
+
+global_qualify_list に 10 個の修飾を持ち、それぞれ 600 回参照する cpp のブロック
+を五つ含む文書を、コードハイライトを有効にして変換する。
+
+    $ python tests/bench_qualifiers.py [--rev REV]
+"""
+
+import hashlib
+
+import support
+
+NAMES = ['vector', 'sort', 'cout', 'endl', 'move', 'size_t', 'find', 'begin', 'end', 'string']
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown.extensions.codehilite import CodeHiliteExtension
+    from markdown_to_html.qualified_fenced_code import QualifiedFencedCodeExtension
+
+    global_qualify_list = ''.join('* std::%s[link /reference/%s.md]\n' % (name, name) for name in NAMES)
+    code = 'int main() {\n'
+    code += ''.join('  std::%s(x, std::%s);\n' % (NAMES[i % 10], NAMES[(i * 3) % 10]) for i in range(300))
+    code += '}\n'
+    text = ('```cpp example\n' + code + '```\n* x[italic]\n\n') * 5
+
+    md = markdown.Markdown(extensions=[
+        QualifiedFencedCodeExtension(global_qualify_list),
+        CodeHiliteExtension(css_class='highlight'),
+    ])
+    outputs = []
+
+    def run():
+        md._example_codes = []
+        outputs.append(md.convert(text))
+
+    seconds = support.timeit(run, args.repeat)
+    digest = hashlib.md5(outputs[-1].encode('utf-8')).hexdigest()[:8]
+    support.report('5 blocks x 600 qualified names', seconds, digest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+退避した生の HTML の復元 (SafeRawHtmlPostprocessor) の計測
+
+段落と、退避したコードブロックを交互に n 個ずつ並べた文書を復元する。
+
+    $ python tests/bench_raw_html.py [--rev REV]
+"""
+
+import hashlib
+
+import support
+
+
+def main():
+    args = support.bench_args(__doc__)
+    import markdown
+    from markdown_to_html.html_attribute import SafeRawHtmlPostprocessor
+
+    md = markdown.Markdown()
+    proc = SafeRawHtmlPostprocessor(md)
+    for n in (30, 300, 1000):
+        md.htmlStash.reset()
+        parts = []
+        for i in range(n):
+            parts.append('<p>段落 %d の説明文。' % i + 'x' * 200 + '</p>\n')
+            code = '<div class="highlight"><pre>' + 'int x = %d;\n' % i * 20 + '</pre></div>'
+            parts.append('<p>' + md.htmlStash.store(code) + '</p>\n')
+        text = ''.join(parts)
+        outputs = []
+        seconds = support.timeit(lambda: outputs.append(proc.run(text)), args.repeat)
+        digest = hashlib.md5(outputs[-1].encode('utf-8')).hexdigest()[:8]
+        support.report('{0} fragments'.format(n), seconds, digest)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+import support
+
+support.import_package()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+テストとベンチマークの共通処理
+=========================================
+
+このリポジトリはディレクトリ自体が markdown_to_html パッケージなので、一時ディ
+レクトリに markdown_to_html という名前で置いてから import する。
+
+ベンチマーク (bench_*.py) は --rev で git のリビジョンを指定すると、そのリビジョ
+ンの木を git archive で取り出して計測する。変更の前後を同じ手順で比べられる。
+
+    $ python tests/bench_defined_words.py
+    $ python tests/bench_defined_words.py --rev HEAD^
+"""
+
+import argparse
+import atexit
+import importlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import warnings
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = 'markdown_to_html'
+
+
+def package_parent(rev=None):
+    """markdown_to_html を置いたディレクトリを返す
+
+    rev が None の場合は作業中の木を、それ以外の場合は git のリビジョン rev の木
+    を置く。ディレクトリはプロセスの終了時に削除する。
+    """
+    parent = tempfile.mkdtemp(prefix='markdown_to_html-')
+    atexit.register(shutil.rmtree, parent, True)
+    target = os.path.join(parent, PACKAGE)
+    if rev is None:
+        os.symlink(ROOT, target)
+    else:
+        data = subprocess.check_output(['git', 'archive', '--format=tar', rev], cwd=ROOT)
+        os.mkdir(target)
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            tar.extractall(target)
+    return parent
+
+
+def import_package(rev=None):
+    """markdown_to_html を import して返す"""
+    if PACKAGE not in sys.modules:
+        sys.path.insert(0, package_parent(rev))
+    # markdown の古い API の警告は計測の邪魔になるので抑える
+    warnings.simplefilter('ignore', DeprecationWarning)
+    return importlib.import_module(PACKAGE)
+
+
+def bench_args(description, argv=None):
+    """ベンチマークの共通の引数を解釈し、対象のパッケージを import する"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--rev', help='git revision to measure instead of the working tree')
+    parser.add_argument('-n', '--repeat', type=int, default=5, help='number of timed runs')
+    args = parser.parse_args(argv)
+    import_package(args.rev)
+    return args
+
+
+def timeit(func, repeat=5):
+    """func を repeat 回呼び出し、最も短い時間 (秒) を返す"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def report(name, seconds, digest=None):
+    """計測結果を一行で出力する。digest は出力の同一性を確かめるための値"""
+    line = '{0:<40} {1:10.2f} ms'.format(name, seconds * 1000.0)
+    if digest is not None:
+        line += '  ' + digest
+    print(line)
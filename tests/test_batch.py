@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+from markdown_to_html import batch
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+_LINKS_PAGE = '''# page
+
+- [vector](vector.md)
+- [section](vector.md#size)
+- [here](#top)
+- [none](none.md)
+- [nolink](/reference/none.nolink.md)
+- [nolink dir](vector.nolink)
+- [outside](https://example.com/)
+- [image ![alt](img.png)](missing/page.md)
+'''
+
+
+def _convert(options, pages, text):
+    converter = batch.Converter(options)
+    results = [converter.convert(text, os.path.dirname(page), page) for page in pages]
+    return [(result, result.diagnostics) for result in results]
+
+
+def test_deferred_links_match_eager(tmp_path):
+    from markdown_to_html import links
+
+    pages = ['reference/page.md', 'reference/vector.md']
+    extension = batch.DEFAULT_OPTIONS['extension']
+    index = links.LinkIndex(frozenset(links.page_path(page, extension) for page in pages), extension)
+    eager = _convert(dict(batch.DEFAULT_OPTIONS, hrefs=index), pages, _LINKS_PAGE)
+    deferred = _convert(dict(batch.DEFAULT_OPTIONS, deferred_links=True), pages, _LINKS_PAGE)
+
+    diagnostics = links.LinkDiagnostics()
+    demotions = batch.validate_links([(result.full_path, result.links) for result, _ in deferred],
+                                     index, extension, diagnostics)
+    # 存在しないページへのリンクと nolink のリンクだけが span になる
+    assert sorted(record.href for record in demotions['reference/page.md']) == [
+        '/reference/none.nolink.md', 'missing/page.md', 'none.md', 'vector.nolink']
+
+    eager_diagnostics = links.LinkDiagnostics()
+    for (e, e_diagnostics), (d, d_diagnostics) in zip(eager, deferred):
+        assert e.links is None
+        assert d_diagnostics == []
+        assert links.patch_html(d.html, demotions.get(d.full_path, [])) == e.html
+        for x in e_diagnostics:
+            eager_diagnostics.record(x.page, x.href, x.resolved, x.kind)
+    assert [d.key() for d in diagnostics.records()] == [d.key() for d in eager_diagnostics.records()]
+    assert len(diagnostics.records()) == 8
+
+
+def test_deferred_links_cli(tmp_path):
+    source = str(tmp_path / 'site')
+    _write(os.path.join(source, 'reference/page.md'), _LINKS_PAGE)
+    _write(os.path.join(source, 'reference/vector.md'), '# vector\n\n[page](page.md)\n')
+    _write(os.path.join(source, 'index.md'), '# index\n\n[page](/reference/page.md)\n[gone](/gone.md)\n')
+
+    outputs = {}
+    for mode, extra in [('eager', ['--link-index', source]), ('deferred', ['--deferred-links'])]:
+        output = str(tmp_path / mode)
+        report = str(tmp_path / (mode + '.json'))
+        assert batch.main(['--source-dir', source, '--output', output, '--diagnostics-json', report,
+                           '-j', '1'] + extra) == 0
+        files = {}
+        for dirpath, _, filenames in os.walk(output):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                with open(path, encoding='utf-8') as f:
+                    files[os.path.relpath(path, output)] = f.read()
+        with open(report, encoding='utf-8') as f:
+            outputs[mode] = (files, json.load(f))
+    assert len(outputs['eager'][0]) == 3
+    assert outputs['eager'][1]
+    assert outputs['deferred'] == outputs['eager']
+
+
+_PAGE_A = '''# push_back
+* vector[meta header]
+* function[meta id-type]
+* cpp11[meta cpp]
+
+* mathjax[mathjax enable]
+
+[sponsor name:NAME, link:https://example.com/, period:2099-12-31]
+
+$$ \\sum_{i=0}^{n} a_i $$ と $x^2$
+
+```cpp example
+#include <vector>
+int main() { std::vector<int> v; v.push_back(1); }
+```
+* v.push_back[color ff0000]
+* std::vector[link /reference/vector.md]
+
+不定値 と [vector](/reference/vector.md)、[none](none.md)
+
+| a | b |
+|---|---|
+| 1 | 2 |
+'''
+
+_PAGE_B = '''# size
+* vector[meta header]
+
+$x$ は数式ではない
+
+```cpp
+int x = 0;
+```
+
+不定 と 不定値 [vector](vector.md)
+'''
+
+
+def test_converter_does_not_leak_state_between_documents():
+    from markdown_to_html import footer, links
+
+    def options():
+        return dict(batch.DEFAULT_OPTIONS,
+                    defined_words={'不定値': {'link': '/reference/value.md'}},
+                    global_qualify_list='* std::vector[link /reference/vector.md]',
+                    hrefs=links.LinkIndex(['/reference/vector.html', '/reference/value.html'], '.html'),
+                    extensions=['markdown.extensions.tables',
+                                footer.FooterExtension(configs=[('url', 'https://example.com/edit')])])
+
+    converter = batch.Converter(options())
+    a = converter.convert(_PAGE_A, 'reference/vector', 'reference/vector/push_back.md')
+    assert a.meta and a.mathjax and a.example_codes and a.diagnostics and a.expires is not None
+    assert 'NAME' in a.html and 'https://example.com/edit' in a.html
+    b = converter.convert(_PAGE_B, 'reference/vector', 'reference/vector/size.md')
+
+    fresh = batch.Converter(options()).convert(_PAGE_B, 'reference/vector', 'reference/vector/size.md')
+    assert b.html == fresh.html
+    assert [d.key() for d in b.diagnostics] == [d.key() for d in fresh.diagnostics]
+    assert b._replace(diagnostics=None) == fresh._replace(diagnostics=None)
+    assert b.meta == {'header': ['vector']}
+    assert not b.mathjax and b.example_codes == [] and b.expires is None
+
+    # 逆の順番でも同じ
+    converter = batch.Converter(options())
+    converter.convert(_PAGE_B, 'reference/vector', 'reference/vector/size.md')
+    a2 = converter.convert(_PAGE_A, 'reference/vector', 'reference/vector/push_back.md')
+    assert a2._replace(diagnostics=None) == a._replace(diagnostics=None)
+
+
+def _site(tmp_path, pages):
+    source = str(tmp_path / 'site')
+    for page in pages:
+        _write(os.path.join(source, page), '# {0}\n\ntext\n'.format(page))
+    return source
+
+
+def _jobs_file(tmp_path, source, pages):
+    path = str(tmp_path / 'jobs.jsonl')
+    with open(path, 'w', encoding='utf-8') as f:
+        for page in pages:
+            f.write(json.dumps({'source': os.path.join(source, page), 'base_path': os.path.dirname(page),
+                                'full_path': page}) + '\n')
+    return path
+
+
+def _manifest_pages(path):
+    with open(path, encoding='utf-8') as f:
+        return sorted(json.load(f)['pages'])
+
+
+def test_manifest_subset_keeps_other_records(tmp_path):
+    pages = ['a.md', 'reference/b.md', 'reference/c.md']
+    source = _site(tmp_path, pages)
+    output = str(tmp_path / 'out')
+    path = str(tmp_path / 'manifest.json')
+    assert batch.main(['--source-dir', source, '--output', output, '--manifest', path, '-j', '1']) == 0
+    assert _manifest_pages(path) == pages
+
+    jobs = _jobs_file(tmp_path, source, ['reference/b.md'])
+    assert batch.main([jobs, '--output', output, '--manifest', path, '-j', '1']) == 0
+    assert _manifest_pages(path) == pages
+
+    # --prune を指定した場合と --source-dir の場合は、存在しないページの記録を削除する
+    assert batch.main([jobs, '--output', output, '--manifest', path, '-j', '1', '--prune']) == 0
+    assert _manifest_pages(path) == ['reference/b.md']
+
+    os.remove(os.path.join(source, 'a.md'))
+    assert batch.main(['--source-dir', source, '--output', output, '--manifest', path, '-j', '1']) == 0
+    assert _manifest_pages(path) == ['reference/b.md', 'reference/c.md']
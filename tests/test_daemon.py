@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+import pytest
+
+from markdown_to_html import daemon
+
+
+def _request(id, text='# page\n\ntext\n'):
+    return {'id': id, 'full_path': 'reference/p{0}.md'.format(id), 'text': text}
+
+
+class _Client(object):
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(30)
+        self.sock.connect(path)
+        self.rfile = self.sock.makefile('rb')
+
+    def send(self, request):
+        self.sock.sendall((json.dumps(request) + '\n').encode('utf-8'))
+
+    def receive(self):
+        return json.loads(self.rfile.readline().decode('utf-8'))
+
+    def close(self):
+        self.rfile.close()
+        self.sock.close()
+
+
+@pytest.fixture
+def socket_path():
+    # Unix ドメインソケットのパスの長さには上限があるので短いパスを使う
+    directory = tempfile.mkdtemp(prefix='md2h-', dir='/tmp')
+    yield os.path.join(directory, 'daemon.sock')
+    shutil.rmtree(directory, True)
+
+
+@pytest.fixture
+def server(socket_path):
+    d = daemon.Daemon({}, processes=2)
+    thread = threading.Thread(target=daemon.serve_socket, args=(d, socket_path), daemon=True)
+    thread.start()
+    for _ in range(1000):
+        if os.path.exists(socket_path):
+            break
+        threading.Event().wait(0.01)
+    yield socket_path
+    client = _Client(socket_path)
+    client.send({'op': 'shutdown'})
+    assert client.receive() == {'op': 'shutdown'}
+    client.close()
+    thread.join(30)
+    d.close()
+
+
+def test_two_persistent_clients(server):
+    a = _Client(server)
+    b = _Client(server)
+    # a は接続したまま次の要求を送らない。b の要求はそれを待たずに処理される
+    a.send(_request(1))
+    b.send(_request(2))
+    assert b.receive()['id'] == 2
+    assert a.receive()['id'] == 1
+
+    # 両方の接続から続けて送った要求は、それぞれの接続で送った順に返る
+    for i in range(10):
+        a.send(_request(100 + i))
+        b.send(_request(200 + i))
+    responses_a = [a.receive() for _ in range(10)]
+    responses_b = [b.receive() for _ in range(10)]
+    assert [r['id'] for r in responses_a] == list(range(100, 110))
+    assert [r['id'] for r in responses_b] == list(range(200, 210))
+    assert all(r['error'] is None for r in responses_a + responses_b)
+    a.close()
+    b.close()
+
+
+def test_unknown_op(server):
+    client = _Client(server)
+    client.send({'id': 7, 'op': 'frob'})
+    client.send(_request(8))
+    assert client.receive() == {'id': 7, 'error': 'unknown op: frob'}
+    assert client.receive()['id'] == 8
+    client.close()
+
+
+def test_refuse_live_socket(server):
+    with pytest.raises(OSError):
+        daemon._remove_stale_socket(server)
+    assert os.path.exists(server)
+
+
+def test_remove_stale_socket(socket_path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(socket_path)
+    sock.close()
+    daemon._remove_stale_socket(socket_path)
+    assert not os.path.exists(socket_path)
+
+    with open(socket_path, 'w') as f:
+        f.write('data')
+    with pytest.raises(OSError):
+        daemon._remove_stale_socket(socket_path)
+    assert os.path.exists(socket_path)
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import random
+
+import regex
+
+from markdown_to_html import defined_words
+
+
+def _matches(words, text):
+    return [text[beg:end] for beg, end in defined_words.DefinedWordMatcher(words).finditer(text)]
+
+
+def test_matcher_longest_match():
+    words = ['不定', '不定値', '値', '未定義動作', '動作']
+    # 同じ位置から始まる一致は最も長いものを優先し、一致は重ならない
+    assert _matches(words, '不定値と不定の値') == ['不定値', '不定', '値']
+    assert _matches(words, '未定義動作と動作') == ['未定義動作', '動作']
+    # 左の一致を優先するので、右にある長い一致とは重ならない
+    assert _matches(['不定', '定値'], '不定値') == ['不定']
+    assert _matches(['未定義', '定義動作'], '未定義動作') == ['未定義']
+    assert _matches(['a', 'ab', 'abc'], 'ab abc a') == ['ab', 'abc', 'a']
+
+
+def test_matcher_word_boundary():
+    words = ['size', 'size_type', 'std::size_t', '型']
+    assert _matches(words, 'size() と size_type') == ['size', 'size_type']
+    # 英単語文字で始まる (終わる) 定義語は、前後が英単語文字の位置では一致しない
+    assert _matches(words, 'resize sizes size2 _size') == []
+    assert _matches(words, 'std::size_t の型') == ['std::size_t', '型']
+    # 英単語文字でない文字で始まる (終わる) 側には境界の条件がない
+    assert _matches(['::x', '型'], 'a::x 整数型の') == ['::x', '型']
+    assert _matches(['::x'], 'a::xy') == []
+
+
+def test_matcher_prefix_word():
+    words = ['vector', 'vector<bool>']
+    assert _matches(words, 'vector<bool> と vector<int>') == ['vector<bool>', 'vector']
+    # 長い定義語が境界の条件で一致しない場合は、短い定義語が一致する
+    words = ['push', 'push_back']
+    assert _matches(words, 'push_backs push_back push') == ['push_back', 'push']
+    assert _matches(['ab', 'abc'], 'abcd ab') == ['ab']
+    assert _matches([], 'text') == []
+    assert _matches(['', 'a'], 'a') == ['a']
+
+
+def _quote_word(word):
+    ret = regex.escape(word)
+    if defined_words._RE_WBEG.match(word):
+        ret = r'(?<=^|[^\p{Ll}\p{Lu}_0-9])' + ret
+    if defined_words._RE_WEND.search(word):
+        ret = ret + r'(?=$|[^\p{Ll}\p{Lu}_0-9])'
+    return ret
+
+
+def _regex_matches(words, text):
+    # 定義語を逆順に並べた正規表現の選択による検索。DefinedWordMatcher の一致の規
+    # 則はこれと同じである
+    pattern = regex.compile(r'|'.join(_quote_word(word) for word in sorted(words, reverse=True)), regex.MULTILINE)
+    return [m.group(0) for m in pattern.finditer(text)]
+
+
+def test_matcher_same_as_regex():
+    rng = random.Random(0)
+    alphabet = 'ab_ 不定値\n:'
+    for _ in range(1000):
+        words = sorted(set(''.join(rng.choice(alphabet[:-1]) for _ in range(rng.randint(1, 4)))
+                           for _ in range(rng.randint(1, 6))))
+        text = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+        assert _matches(words, text) == _regex_matches(words, text), (words, text)
+
+
+def test_get_dictionary_identity(monkeypatch):
+    words = {'不定値': {'link': '/a.md'}}
+    first = defined_words.get_dictionary(words, 'https://x', '.html')
+
+    # 同じオブジェクトの二度目以降の取得では辞書の内容を読まない
+    def fail(*args):
+        raise AssertionError('fingerprint computed on an identity hit')
+    monkeypatch.setattr(defined_words, '_fingerprint', fail)
+    assert defined_words.get_dictionary(words, 'https://x', '.html') is first
+    monkeypatch.undo()
+
+    # 等しい内容の別のオブジェクトは内容で引く
+    assert defined_words.get_dictionary(dict(words), 'https://x', '.html') is first
+    other = defined_words.get_dictionary(words, 'https://y', '.html')
+    assert other is not first
+    assert other.entries['不定値']['resolved_link'] == 'https://y/a.html'
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+from xml.etree import ElementTree as etree
+
+from markdown import serializers
+
+from markdown_to_html import html_serializer
+
+
+def _html(source, format='xhtml'):
+    return html_serializer.to_html_string(etree.fromstring(source), format)
+
+
+def test_ampersand_is_always_escaped():
+    # 実体参照の形をしていても '&' は常に '&amp;' にする
+    assert _html('<p>a &amp; b &amp;amp; &amp;lt; &amp;#123;</p>') == '<p>a &amp; b &amp;amp; &amp;lt; &amp;#123;</p>'
+    assert _html('<a href="?a=1&amp;b=&amp;amp;">x</a>') == '<a href="?a=1&amp;b=&amp;amp;">x</a>'
+
+
+def test_entities():
+    assert _html('<p>&lt;vector&gt; "x" \'y\'</p>') == '<p>&lt;vector&gt; "x" \'y\'</p>'
+    assert _html('<p title="&lt;&quot;&gt;"> あ</p>') == '<p title="&lt;&quot;&gt;"> あ</p>'
+    # script と style の本文は実体参照にしない
+    assert _html('<script>if (a &lt; b &amp;&amp; c) {}</script>') == '<script>if (a < b && c) {}</script>'
+    element = etree.Element('div')
+    element.append(etree.Comment(' a < b '))
+    assert html_serializer.to_html_string(element) == '<div><!-- a &lt; b --></div>'
+
+
+def test_sorted_attributes():
+    element = etree.Element('a')
+    element.set('title', 't')
+    element.set('href', 'h')
+    element.set('class', 'c')
+    assert html_serializer.to_html_string(element) == '<a class="c" href="h" title="t"></a>'
+    assert html_serializer.to_html_string(element) == serializers.to_xhtml_string(element)
+    # html では名前と値が等しい属性は論理属性として出力する
+    element = etree.fromstring('<input type="checkbox" checked="checked" disabled="disabled" />')
+    assert html_serializer.to_html_string(element, 'html') == '<input checked disabled type="checkbox">'
+    assert html_serializer.to_html_string(element, 'xhtml') == '<input checked="checked" disabled="disabled" type="checkbox" />'
+
+
+def test_void_elements():
+    source = '<p>a<br />b<img src="x.png" /><hr /><span></span><td></td></p>'
+    assert _html(source) == '<p>a<br />b<img src="x.png" /><hr /><span></span><td></td></p>'
+    assert _html(source, 'html') == '<p>a<br>b<img src="x.png"><hr><span></span><td></td></p>'
+    # 空要素でない要素は空でも閉じタグを出力する
+    assert _html('<div />') == '<div></div>'
+
+
+def test_text_and_tail():
+    element = etree.fromstring('<div>head<p>text<b>bold</b>tail &amp; b</p>after&lt;</div>')
+    assert html_serializer.to_html_string(element) == '<div>head<p>text<b>bold</b>tail &amp; b</p>after&lt;</div>'
+    # 要素自身の tail も出力する
+    p = element[0]
+    assert html_serializer.to_html_string(p) == '<p>text<b>bold</b>tail &amp; b</p>after&lt;'
+    # tag が None の要素は子だけを出力する
+    root = etree.Element(None)
+    root.text = 'x & y'
+    root.append(etree.fromstring('<br />'))
+    root[0].tail = 'z'
+    assert html_serializer.to_html_string(root) == 'x &amp; y<br />z'
+
+
+def test_same_as_markdown_serializer():
+    sources = [
+        '<div class="a" id="b"><p>text <code>a &lt; b</code> <em>x</em></p><br /></div>',
+        '<table border="1"><tr><td>1</td><td></td></tr></table>',
+        '<pre><code class="cpp">int main() { return a &gt; b; }\n</code></pre>',
+    ]
+    for source in sources:
+        for format in ('xhtml', 'html'):
+            element = etree.fromstring(source)
+            to_string = serializers.to_xhtml_string if format == 'xhtml' else serializers.to_html_string
+            expected = to_string(element)
+            assert html_serializer.to_html_string(element, format) == expected
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+
+import markdown
+
+from markdown_to_html import html_attribute, links
+
+
+def _markdown(full_path, **state):
+    md = markdown.Markdown(extensions=[html_attribute.AttributeExtension(
+        base_url='https://cpprefjp.github.io', extension='.html',
+        base_path=os.path.dirname(full_path), full_path=full_path)])
+    for name, value in state.items():
+        setattr(md, '_html_attribute_' + name, value)
+    return md
+
+
+_LINKS_PAGE = '''# page
+
+- [vector](vector.md)
+- [section](vector.md#size)
+- [here](#top)
+- [none](none.md)
+- [nolink](/reference/none.nolink.md)
+- [nolink dir](vector.nolink)
+- [outside](https://example.com/)
+- [image ![alt](img.png)](missing/page.md)
+'''
+
+
+def test_patched_html_matches_eager_check():
+    pages = ['reference/page.md', 'reference/vector.md']
+    index = links.LinkIndex(['/reference/page.html', '/reference/vector.html'], '.html')
+    table = links.LinkTable()
+    eager_diagnostics = links.LinkDiagnostics()
+    deferred = {}
+    eager = {}
+    for page in pages:
+        eager[page] = _markdown(page, hrefs=index, diagnostics=eager_diagnostics).convert(_LINKS_PAGE)
+        deferred[page] = _markdown(page, link_table=table).convert(_LINKS_PAGE)
+
+    diagnostics = links.LinkDiagnostics()
+    demotions = table.validate(index, '.html', diagnostics)
+    # 存在しないページへのリンクと nolink のリンクだけが span になる
+    assert sorted(record.href for record in demotions['reference/page.md']) == [
+        '/reference/none.nolink.md', 'missing/page.md', 'none.md', 'vector.nolink']
+    for page in pages:
+        assert deferred[page] != eager[page]
+        assert links.patch_html(deferred[page], demotions[page]) == eager[page]
+    assert [d.key() for d in diagnostics.records()] == [d.key() for d in eager_diagnostics.records()]
+    assert len(diagnostics.records()) == 8
+
+    # 全てのリンク先が存在すれば書き換えない
+    assert links.patch_html(deferred['reference/page.md'], []) == deferred['reference/page.md']
+
+
+def _graph(pages):
+    graph = links.LinkGraph('.html')
+    for page, targets in pages.items():
+        graph.set_page(page, targets)
+    return graph
+
+
+def _site_graph():
+    return _graph({
+        'index.md': ['/reference/vector.html', '/reference/array.html'],
+        'reference/vector.md': ['/reference/array.html', '/reference/vector.html'],
+        'reference/array.md': [],
+        'lang/cpp11.md': ['/reference/vector.html', '/reference/none.html'],
+    })
+
+
+def test_save_load_round_trip(tmp_path):
+    graph = _site_graph()
+    path = str(tmp_path / 'graph.json')
+    graph.save(path)
+
+    loaded = links.LinkGraph.load(path, '.html')
+    assert loaded.to_dict() == graph.to_dict()
+    assert loaded.items() == graph.items()
+    assert loaded.referrers('/reference/vector.html') == ['index.md', 'lang/cpp11.md', 'reference/vector.md']
+
+    # extension や形式が異なる索引は使わない
+    assert links.LinkGraph.load(path, '').items() == []
+    assert links.LinkGraph.load(str(tmp_path / 'none.json'), '.html').items() == []
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(dict(graph.to_dict(), version=links.LinkGraph.VERSION + 1), f)
+    assert links.LinkGraph.load(path, '.html').items() == []
+
+
+def test_affected():
+    graph = _site_graph()
+    # 変更したページ自身は含まない
+    assert graph.affected(['reference/vector.md']) == ['index.md', 'lang/cpp11.md']
+    # 削除したページにリンクしているページ
+    assert graph.affected(['reference/array.md']) == ['index.md', 'reference/vector.md']
+    # 追加したページ (存在しないページへのリンクを持つページを変換し直す)
+    assert graph.affected(['reference/none.md']) == ['lang/cpp11.md']
+    # どこからもリンクされていないページ
+    assert graph.affected(['lang/cpp11.md']) == []
+    assert graph.affected([]) == []
+    assert graph.affected(['index.md', 'reference/vector.md']) == ['lang/cpp11.md']
+
+
+def test_remove_page_drops_edges():
+    graph = _site_graph()
+    graph.remove_page('lang/cpp11.md')
+    assert graph.referrers('/reference/none.html') == []
+    assert '/reference/none.html' not in graph.to_dict()['referrers']
+    assert graph.affected(['reference/vector.md']) == ['index.md']
+
+
+def test_stale_edges_dropped_when_links_change():
+    graph = links.LinkGraph('.html')
+    md = _markdown('reference/list.md', link_graph=graph)
+
+    md.convert('[a](array.md)\n[b](vector.md)\n')
+    assert graph.targets('reference/list.md') == ['/reference/array.html', '/reference/vector.html']
+    assert graph.affected(['reference/array.md']) == ['reference/list.md']
+
+    md.reset().convert('[b](vector.md)\n[c](deque.md)\n')
+    assert graph.targets('reference/list.md') == ['/reference/deque.html', '/reference/vector.html']
+    assert graph.referrers('/reference/array.html') == []
+    assert graph.affected(['reference/array.md']) == []
+    assert graph.affected(['reference/deque.md']) == ['reference/list.md']
+    assert sorted(graph.to_dict()['referrers']) == ['/reference/deque.html', '/reference/vector.html']
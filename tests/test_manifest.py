@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+from markdown.extensions.toc import TocExtension
+
+from markdown_to_html import batch
+from markdown_to_html import manifest
+
+
+def _options(**kwargs):
+    return dict(batch.DEFAULT_OPTIONS, **kwargs)
+
+
+def test_fingerprint_of_extensions():
+    # 拡張はクラスの名前と設定で区別し、インスタンスの違いには依存しない
+    a = manifest.config_fingerprint(_options(extensions=[TocExtension(permalink=True)]))
+    b = manifest.config_fingerprint(_options(extensions=[TocExtension(permalink=True)]))
+    c = manifest.config_fingerprint(_options(extensions=[TocExtension(permalink=False)]))
+    assert a == b
+    assert a != c
+
+
+def test_fingerprint_rejects_unknown_values():
+    with pytest.raises(TypeError):
+        manifest.config_fingerprint(_options(extensions=[object()]))
+
+
+def test_fingerprint_includes_code_version(monkeypatch):
+    before = manifest.config_fingerprint(_options())
+    monkeypatch.setattr(manifest, '_CODE_VERSION', 'changed')
+    assert manifest.config_fingerprint(_options()) != before
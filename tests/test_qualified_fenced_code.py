@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+import random
+import sqlite3
+import time
+
+import markdown
+import regex as re
+
+from markdown_to_html.qualified_fenced_code import HighlightCache
+from markdown_to_html.qualified_fenced_code import QualifiedFencedCodeExtension
+from markdown_to_html.qualified_fenced_code import _iterFencedBlocks
+
+BLOCK = 'text\n\n```cpp example\nint main() { std::sort(v.begin(), v.end()); }\n```\n* std::sort[link /x.md]\n\n'
+
+
+def _run(text):
+    md = markdown.Markdown(extensions=[QualifiedFencedCodeExtension('')])
+    start = time.perf_counter()
+    lines = md.preprocessors['qualified_fenced_code'].run(text.split('\n'))
+    return lines, md, time.perf_counter() - start
+
+
+def test_many_blocks():
+    lines, md, elapsed = _run(BLOCK * 1000)
+    assert len(md.htmlStash.rawHtmlBlocks) == 1000
+    assert len(md._example_codes) == 1000
+    assert lines.count('text') == 1000
+    assert not any('```' in line for line in lines)
+    assert elapsed < 2.0
+
+
+def test_unterminated_fence():
+    # 閉じられていない fence に対して、以前の正規表現は行数の二乗以上の時間が掛かった
+    text = '```cpp\n' + 'int x; // ``\n' * 2000 + '\n\n'
+    lines, md, elapsed = _run(text)
+    assert md.htmlStash.rawHtmlBlocks == []
+    assert lines == text.split('\n')
+    assert elapsed < 1.0
+
+
+def test_unterminated_fence_after_blocks():
+    text = BLOCK * 10 + '```cpp\n' + 'int x;\n' * 100
+    lines, md, elapsed = _run(text)
+    assert len(md.htmlStash.rawHtmlBlocks) == 10
+    assert lines[-102:] == ['```cpp'] + ['int x;'] * 100 + ['']
+
+
+_OLD_FENCED_BLOCK_RE = re.compile(
+    r'(?P<fence>`{3,})[ ]*(?P<lang>[a-zA-Z0-9_+-]*)(?P<lang_meta>.*?)\n(?P<code>.*?)(?<=\n)'
+    r'(?P<indent>[ \t]*)(?P=fence)[ ]*\n(?:(?=\n)|(?P<qualifies>.*?\n(?=\s*\n)))',
+    re.MULTILINE | re.DOTALL)
+
+
+def _old_blocks(text):
+    blocks = []
+    while True:
+        m = _OLD_FENCED_BLOCK_RE.search(text)
+        if not m:
+            return text, blocks
+        blocks.append(m.group('lang', 'lang_meta', 'code', 'indent', 'qualifies'))
+        text = '%s\n<P%d>\n%s' % (text[:m.start()], len(blocks) - 1, text[m.end():])
+
+
+def _new_blocks(text):
+    blocks = []
+    output = []
+    pos = 0
+    for m in _iterFencedBlocks(text):
+        output.append(text[pos:m.start])
+        output.append('\n<P%d>\n' % len(blocks))
+        blocks.append((m.lang, m.lang_meta, m.code, m.indent, m.qualifies))
+        pos = m.end
+    output.append(text[pos:])
+    return ''.join(output), blocks
+
+
+def test_same_blocks_as_regex():
+    # 開始のフェンスの前に空白しかない文書では、以前の実装と同じ一致になる
+    tokens = ['```', '````', '```cpp', '```cpp example', ' ```', '\t```', '``` ', '```\t', ' ```` ', '`````',
+              'code', 'x `` y', '`` ``', '', '', '  ', '* a[italic]', '* std::sort[link /x.md]']
+    rnd = random.Random(0)
+    for _ in range(5000):
+        lines = [rnd.choice(tokens) for _ in range(rnd.randint(0, 14))]
+        text = '\n'.join(lines) + rnd.choice(['', '\n', '\n\n'])
+        assert _new_blocks(text) == _old_blocks(text), text
+
+
+def test_fence_after_text():
+    # 行の途中から始まるフェンス
+    assert _new_blocks('text ```` x\ncode\n````\n\n') == ('text \n<P0>\n\n', [('x', '', 'code\n', '', None)])
+
+    # 前の "```" と、行の途中の "````" の前に残る "``` " を組にしない。以前の実装
+    # では組にして、一つ目のブロックのプレースホルダを修飾として失っていた
+    text = '```\na\n``` ````\ncode\n````\n\n'
+    assert _new_blocks(text) == ('```\na\n``` \n<P0>\n\n', [('', '', 'code\n', '', None)])
+    assert _old_blocks(text) == ('\n<P1>\n\n', [('', '', 'code\n', '', None), ('', '', 'a\n', '', '<P0>\n')])
+
+
+def test_highlight_cache_bound(tmp_path):
+    path = str(tmp_path / 'highlight.sqlite3')
+    html = 'x' * 1000
+    # インスタンス毎の書き込みは少ないが、合計は max_bytes を大きく超える
+    caches = [HighlightCache(path, max_bytes=20000) for _ in range(4)]
+    for i in range(30):
+        for n, cache in enumerate(caches):
+            cache.put('{0}-{1}'.format(n, i), html)
+            assert cache.stats()['bytes'] <= 20000
+    for cache in caches:
+        cache.close()
+
+    conn = sqlite3.connect(path)
+    total, entries = conn.execute('SELECT SUM(size), COUNT(*) FROM highlight').fetchone()
+    recorded = conn.execute('SELECT total FROM highlight_size').fetchone()[0]
+    conn.close()
+    assert total == recorded <= 20000
+    assert entries == 20
+    # 最後に書き込んだものは残る
+    assert caches[3].get('3-29') == html
+
+
+def test_highlight_cache_replace(tmp_path):
+    cache = HighlightCache(str(tmp_path / 'highlight.sqlite3'), max_bytes=20000)
+    cache.put('a', 'x' * 100)
+    cache.put('a', 'y' * 300)
+    assert cache.get('a') == 'y' * 300
+    assert cache.stats()['bytes'] == 300
+
+
+def test_highlight_cache_shared_per_path(tmp_path):
+    path = str(tmp_path / 'highlight.sqlite3')
+    a = QualifiedFencedCodeExtension('', highlight_cache=path)
+    b = QualifiedFencedCodeExtension('', highlight_cache=path)
+    assert a.highlight_cache is b.highlight_cache
+
+
+# 一度に一つずつブロックを置き換えて先頭から検索し直す、以前の実装の一致
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import datetime
+
+import markdown
+
+from markdown_to_html.sponsor import JST, SponsorExtension
+
+
+def _markdown(now):
+    clock = [now]
+    md = markdown.Markdown(extensions=[SponsorExtension(clock=lambda: clock[0])])
+    return md, clock
+
+
+def _at(*args):
+    return datetime.datetime(*args, tzinfo=JST)
+
+
+def test_expiry_boundary():
+    text = '[sponsor name:NAME, link:https://example.com/, period:2024-03-31]\n'
+    html = '<ul><li><a href="https://example.com/">NAME</a></li></ul>'
+    md, clock = _markdown(_at(2024, 3, 31, 23, 59, 59))
+    # 掲載期限の日の終わりまでは表示する
+    assert html in md.convert(text)
+    assert md._sponsor_next_expiry == _at(2024, 3, 31, 23, 59, 59)
+
+    clock[0] = _at(2024, 3, 31, 23, 59, 59, 1)
+    assert 'NAME' not in md.reset().convert(text)
+    assert md._sponsor_next_expiry is None
+
+
+def test_next_expiry_is_earliest_future_period():
+    text = '\n\n'.join([
+        '[sponsor name:A, period:2024-06-30]',
+        '[sponsor name:B, period:2024-01-31]',
+        '[sponsor name:C, period:2023-12-31]',
+        '[sponsor name:D]',
+        '[sponsor name:E, period:2024-02-29]',
+    ]) + '\n'
+    md, clock = _markdown(_at(2024, 1, 1))
+    html = md.convert(text)
+    assert [name in html for name in 'ABCDE'] == [True, True, False, True, True]
+    assert md._sponsor_next_expiry == _at(2024, 1, 31, 23, 59, 59)
+
+    clock[0] = _at(2024, 2, 1)
+    html = md.reset().convert(text)
+    assert [name in html for name in 'ABCDE'] == [True, False, False, True, True]
+    assert md._sponsor_next_expiry == _at(2024, 2, 29, 23, 59, 59)
+
+
+def test_reset_clears_next_expiry():
+    md, clock = _markdown(_at(2024, 1, 1))
+    md.convert('[sponsor name:A, period:2024-06-30]\n')
+    assert md._sponsor_next_expiry == _at(2024, 6, 30, 23, 59, 59)
+
+    # 期限のない文書やスポンサーのない文書に前の文書の期限が残らない
+    md.reset().convert('[sponsor name:B]\n')
+    assert md._sponsor_next_expiry is None
+    md.reset().convert('[sponsor name:A, period:2024-06-30]\n')
+    md.reset()
+    assert md._sponsor_next_expiry is None
+    md.convert('text\n')
+    assert md._sponsor_next_expiry is None
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+import datetime
+import io
+import json
+import os
+
+from markdown_to_html import batch
+from markdown_to_html import watch
+
+
+def test_changed_words():
+    old = {
+        '不定値': {'link': '/a.md'},
+        '未定義動作': {'link': '/b.md'},
+        'UB': {'redirect': '未定義動作'},
+        '適格': {'desc': 'x'},
+    }
+    new = dict(old)
+    new['未定義動作'] = {'link': '/c.md'}
+    new['ill-formed'] = {'desc': 'y'}
+    del new['適格']
+    # リダイレクト先の変更はリダイレクト元の変更として扱う
+    assert watch.changed_words(old, new, 'https://x', '.html') == {'未定義動作', 'UB', 'ill-formed', '適格'}
+    assert watch.changed_words(old, dict(old), 'https://x', '.html') == set()
+
+
+def test_changed_qualifier_targets():
+    old = '* std::sort[link /sort.md]\n* std::vector[link /vector.md]\n* std::move[italic]\n'
+    assert watch.changed_qualifier_targets(old, old) == set()
+
+    new = old.replace('* std::move[italic]', '* std::move[bold]')
+    assert watch.changed_qualifier_targets(old, new) == {'std::move'}
+
+    new = old + '* std::find[link /find.md]\n'
+    assert watch.changed_qualifier_targets(old, new) == {'std::find'}
+
+    # 順番の入れ替わった修飾の対象も含める
+    new = '* std::vector[link /vector.md]\n* std::sort[link /sort.md]\n* std::move[italic]\n'
+    assert watch.changed_qualifier_targets(old, new) == {'std::sort', 'std::vector'}
+
+
+def test_contains_any():
+    assert watch.contains_any('a foo_bar b', {'foo_bar'})
+    assert watch.contains_any('a foo\\_bar b', {'foo_bar'})
+    assert watch.contains_any('a &amp;&amp; b', {'&&'})
+    assert watch.contains_any('&#x4e0d;定値', {'不定値'})
+    assert not watch.contains_any('a foo\\_baz b', {'foo_bar'})
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def _watcher(tmp_path, options=None):
+    source = str(tmp_path / 'site')
+    output = str(tmp_path / 'out')
+    config = str(tmp_path / 'options.json')
+    _write(os.path.join(source, 'a.md'), '# a\n\n[sponsor name:A, period:2030-01-01]\n')
+    _write(os.path.join(source, 'reference', 'b.md'), '# b\n\ntext\n')
+    _write(config, json.dumps(options or {}))
+    watcher = watch.Watcher(source, output, config_path=config, processes=1, log=io.StringIO())
+    watcher.build_all()
+    return watcher, source, output, config
+
+
+def test_error_forgets_expiry(tmp_path):
+    watcher, source, output, config = _watcher(tmp_path)
+    assert 'a.md' in watcher._expires
+
+    def fail(job):
+        return batch.ConversionResult(job.full_path, None, None, None, None, [], None, None, 'error\n')
+
+    watcher._converter.convert_job = fail
+    now = datetime.datetime(2031, 1, 1, tzinfo=datetime.timezone.utc)
+    assert watcher.poll(now) == {'a.md'}
+    # 失敗した後は、ソースが変わるまで変換し直さない
+    assert watcher.poll(now) == set()
+
+
+def test_extension_change_removes_old_outputs(tmp_path):
+    watcher, source, output, config = _watcher(tmp_path)
+    assert os.path.exists(os.path.join(output, 'reference', 'b.html'))
+
+    _write(config, json.dumps({'extension': '.htm'}))
+    os.utime(config, ns=(0, 0))
+    watcher.poll()
+    assert sorted(os.listdir(output)) == ['a.htm', 'reference']
+    assert os.listdir(os.path.join(output, 'reference')) == ['b.htm']
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+ソースの木の監視と変換
+=========================================
+
+ソースの木を定期的に調べ、変更されたページだけを変換し直す。Converter は一度だ
+け構築して使い回すので、一つのページの変更は数十ミリ秒で出力に反映される。
+
+    $ python -m markdown_to_html.watch --source-dir site --output out --config options.json --check-links
+
+起動時に全てのページを変換した後、interval 秒毎に以下を調べる。
+
+* 変更・追加されたページは、そのページだけを変換し直す
+* --check-links の場合、ページを追加・削除すると、そのページにリンクしているペー
+  ジ (links.LinkGraph) も変換し直す。削除したページの出力は削除する
+* 設定ファイル (--config) が変わった場合、変更が定義語の辞書 (defined_words) と
+  global_qualify_list だけであれば、変わった定義語・修飾の対象を含むページだけ
+  を変換し直す。それ以外の設定が変わった場合は全てのページを変換し直す。
+  extension が変わった場合は古い拡張子の出力を削除する
+* スポンサーの掲載期限 (ConversionResult.expires) を過ぎたページを変換し直す
+
+定義語・修飾の対象を含むかどうかはソースの文字列で判断する。Markdown のエスケー
+プ (\\_) と文字参照 (&amp;) を戻した文字列でも探すが、拡張が生成する文字列の様
+に、ソースに現れない文字列での一致は検出できない。その場合はウォッチャーを起動
+し直すと全てのページが変換される。
+
+出力は一時ファイルに書いてから置き換えるので、読み手が書きかけのファイルを見る
+ことはない。
+"""
+
+import argparse
+import datetime
+import html
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+
+from . import batch
+from . import defined_words
+from . import links
+from . import qualified_fenced_code
+
+
+# 変更されても、その内容を含むページだけを変換し直せばよい設定
+PARTIAL_OPTIONS = ('defined_words', 'global_qualify_list')
+
+
+def write_file_atomic(path, text):
+    """path に text を書く。書き込みは一時ファイルを介して原子的に行う"""
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def changed_words(old_words, new_words, base_url, extension):
+    """定義語の辞書の変更で変換結果が変わり得る定義語の集合を返す
+
+    リダイレクトを解決した後の項目で比較するので、リダイレクト先の変更はリダイレ
+    クト元の変更として扱う。
+    """
+    old = defined_words.get_dictionary(old_words, base_url, extension).entries
+    new = defined_words.get_dictionary(new_words, base_url, extension).entries
+    return set(word for word in set(old) | set(new) if old.get(word) != new.get(word))
+
+
+def changed_qualifier_targets(old_text, new_text):
+    """global_qualify_list の変更で変換結果が変わり得る修飾の対象の集合を返す
+
+    同じ位置で複数の対象が一致する場合は先に書かれた修飾が優先されるので、追加・
+    削除された修飾に加えて、順番の入れ替わった修飾の対象も含める。
+    """
+    old = qualified_fenced_code.get_global_qualifiers(old_text).qualifiers
+    new = qualified_fenced_code.get_global_qualifiers(new_text).qualifiers
+    old_lines = set(q.line for q in old)
+    new_lines = set(q.line for q in new)
+    targets = set(q.target for q in old if q.line not in new_lines)
+    targets.update(q.target for q in new if q.line not in old_lines)
+
+    old_common = [q for q in old if q.line in new_lines]
+    new_common = [q for q in new if q.line in old_lines]
+    for a, b in zip(old_common, new_common):
+        if a.line != b.line:
+            targets.add(a.target)
+            targets.add(b.target)
+    return targets
+
+
+def _read_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+# Markdown のバックスラッシュによるエスケープ
+_ESCAPE_RE = re.compile(r'\\(.)')
+
+
+def _unescape(text):
+    """Markdown のエスケープと HTML の文字参照を戻した文字列を返す"""
+    if '\\' in text:
+        text = _ESCAPE_RE.sub(r'\1', text)
+    if '&' in text:
+        text = html.unescape(text)
+    return text
+
+
+def contains_any(text, needles):
+    """ソースの文字列 text が needles のいずれかを含み得るかを返す
+
+    text そのものと、エスケープ・文字参照を戻した文字列 (_unescape) の両方から探
+    す。
+    """
+    if any(needle in text for needle in needles):
+        return True
+    unescaped = _unescape(text)
+    return unescaped != text and any(needle in unescaped for needle in needles)
+
+
+class Watcher(object):
+    """ソースの木 source_dir を監視し、変換結果を output_dir に書き出す
+
+    options は batch.Converter のオプション、config_path はそれを読み込む JSON
+    ファイルである (両方を指定した場合は config_path の内容で上書きする)。
+    check_links が真の場合は source_dir のページの集合でサイト内リンクを確認する。
+    """
+
+    def __init__(self, source_dir, output_dir, options=None, config_path=None,
+                 check_links=False, processes=None, log=None):
+        self.source_dir = source_dir
+        self.output_dir = output_dir
+        self.config_path = config_path
+        self.check_links = check_links
+        self.processes = processes
+        self.log = log or sys.stderr
+
+        self._base_options = dict(options or {})
+        self._config_stamp = None
+        self.options = self._load_options()
+        self.extension = self.options['extension']
+
+        # ページ (full_path) → (source_path, mtime_ns, size)
+        self._sources = {}
+        # ページ → スポンサーの掲載期限により変換結果が変わる時刻
+        self._expires = {}
+        self._hrefs = set()
+        self._graph = links.LinkGraph(self.extension)
+        self._converter = None
+
+    def _stat_config(self):
+        if self.config_path is None:
+            return None
+        try:
+            st = os.stat(self.config_path)
+        except OSError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _load_options(self):
+        options = dict(batch.DEFAULT_OPTIONS)
+        options.update(self._base_options)
+        self._config_stamp = self._stat_config()
+        if self.config_path is not None:
+            with open(self.config_path, encoding='utf-8') as f:
+                options.update(json.load(f))
+        options.pop('hrefs', None)
+        return options
+
+    def _converter_options(self, options):
+        options = dict(options)
+        if self.check_links:
+            # self._hrefs は共有され、ページの追加・削除がそのまま反映される
+            options['hrefs'] = links.LinkIndex(self._hrefs, self.extension)
+        return options
+
+    def _scan(self):
+        sources = {}
+        for job in batch.find_jobs(self.source_dir):
+            try:
+                st = os.stat(job.source_path)
+            except OSError:
+                continue
+            sources[job.full_path] = (job.source_path, st.st_mtime_ns, st.st_size)
+        return sources
+
+    def _job(self, page):
+        return batch.Job(self._sources[page][0], os.path.dirname(page), page)
+
+    def _apply(self, result, start=None):
+        page = result.full_path
+        if result.error is not None:
+            self.log.write('Error: [{0}]\n{1}'.format(page, result.error))
+            # 掲載期限による変換し直しを繰り返さないように、期限は忘れる。ソースが
+            # 変更されると変換し直す
+            self._expires.pop(page, None)
+            return
+        write_file_atomic(batch.output_path(self.output_dir, page, self.extension), result.html)
+        self._graph.set_page(page, result.link_targets)
+        if result.expires is not None:
+            self._expires[page] = result.expires
+        else:
+            self._expires.pop(page, None)
+        for d in result.diagnostics:
+            self.log.write(d.message() + '\n')
+        if start is not None:
+            self.log.write('Updated {0} ({1:.0f} ms)\n'.format(page, (time.perf_counter() - start) * 1000.0))
+
+    def build_all(self):
+        """全てのページを変換する"""
+        start = time.perf_counter()
+        self._sources = self._scan()
+        self._hrefs.clear()
+        self._hrefs.update(links.page_path(page, self.extension) for page in self._sources)
+        self._graph = links.LinkGraph(self.extension)
+        self._expires = {}
+
+        options = self._converter_options(self.options)
+        jobs = [self._job(page) for page in sorted(self._sources)]
+        for result in batch.convert_all(jobs, options, self.processes):
+            self._apply(result)
+        self._converter = batch.Converter(options)
+        self.log.write('Built {0} pages ({1:.0f} ms)\n'.format(len(jobs), (time.perf_counter() - start) * 1000.0))
+
+    def render(self, pages):
+        """pages を現在の Converter で変換し直す"""
+        for page in sorted(pages):
+            if page not in self._sources:
+                continue
+            start = time.perf_counter()
+            self._apply(self._converter.convert_job(self._job(page)), start)
+
+    def _remove_outputs(self, pages):
+        """pages の現在の拡張子の出力を削除する"""
+        for page in pages:
+            path = batch.output_path(self.output_dir, page, self.extension)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _pages_containing(self, needles):
+        if not needles:
+            return set()
+        pages = set()
+        for page, (source_path, _, _) in self._sources.items():
+            try:
+                text = _read_text(source_path)
+            except OSError:
+                continue
+            if contains_any(text, needles):
+                pages.add(page)
+        return pages
+
+    def _reload_config(self):
+        """設定ファイルを読み直し、変換し直すべきページを返す"""
+        old = self.options
+        try:
+            new = self._load_options()
+        except (OSError, ValueError) as e:
+            self.log.write('Error: [{0}] {1}\n'.format(self.config_path, e))
+            return set()
+
+        keys = set(old) | set(new)
+        if any(old.get(key) != new.get(key) for key in keys if key not in PARTIAL_OPTIONS):
+            self.log.write('Configuration changed: rebuilding all pages\n')
+            if new['extension'] != self.extension:
+                self._remove_outputs(self._sources)
+            self.options = new
+            self.extension = new['extension']
+            self.build_all()
+            return set()
+
+        try:
+            needles = set()
+            if old['defined_words'] != new['defined_words']:
+                needles.update(changed_words(old['defined_words'], new['defined_words'],
+                                             new['base_url'], new['extension']))
+            if old['global_qualify_list'] != new['global_qualify_list']:
+                needles.update(changed_qualifier_targets(old['global_qualify_list'], new['global_qualify_list']))
+            converter = batch.Converter(self._converter_options(new))
+        except Exception as e:
+            self.log.write('Error: [{0}] {1}\n'.format(self.config_path, e))
+            return set()
+
+        self.options = new
+        self._converter = converter
+        return self._pages_containing(needles)
+
+    def poll(self, now=None):
+        """一度だけ変更を調べ、変換し直したページを返す"""
+        pages = set()
+        if self._stat_config() != self._config_stamp:
+            pages.update(self._reload_config())
+
+        sources = self._scan()
+        added = set(sources) - set(self._sources)
+        removed = set(self._sources) - set(sources)
+        changed = set(page for page in sources if page in self._sources and sources[page] != self._sources[page])
+        self._sources = sources
+
+        pages.update(added)
+        pages.update(changed)
+        if added or removed:
+            for page in added:
+                self._hrefs.add(links.page_path(page, self.extension))
+            for page in removed:
+                self._hrefs.discard(links.page_path(page, self.extension))
+                self._graph.remove_page(page)
+                self._expires.pop(page, None)
+                self._remove_outputs([page])
+                self.log.write('Removed {0}\n'.format(page))
+            if self.check_links:
+                pages.update(self._graph.affected(added | removed))
+
+        if now is None:
+            now = datetime.datetime.now(datetime.timezone.utc)
+        pages.update(page for page, expires in self._expires.items() if now > expires)
+
+        self.render(pages)
+        return pages
+
+    def run(self, interval=0.05):
+        self.build_all()
+        while True:
+            time.sleep(interval)
+            self.poll()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Watch markdown sources and convert changed pages.')
+    parser.add_argument('--source-dir', required=True, help='directory of the .md files to watch')
+    parser.add_argument('--output', required=True, help='output directory')
+    parser.add_argument('--config', help='JSON file of converter options (reloaded when changed)')
+    parser.add_argument('--check-links', action='store_true', help='check internal links against the source tree')
+    parser.add_argument('--interval', type=float, default=0.05, help='polling interval in seconds')
+    parser.add_argument('-j', '--processes', type=int, default=None, help='number of worker processes for the initial build')
+    args = parser.parse_args(argv)
+
+    watcher = Watcher(args.source_dir, args.output, config_path=args.config,
+                      check_links=args.check_links, processes=args.processes)
+    try:
+        watcher.run(args.interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())